@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*
+"""
+Deliver decoded frames to apps without stalling the parser.
+The parser publishes one read-only Record per frame, which only wraps the tuple returned by
+packet_decoder. Each app has one AppChannel: a bounded queue and a thread which hands
+batches of records to app.on_messages(). When an app falls behind, records are dropped
+by the channel's policy and counted.
+"""
+
+import threading
+import collections
+import operator
+import packet_decoder
+
+MAX_RECORDS = 1000  # default max records waiting in a channel.
+BATCH_SIZE = 100  # max records per on_messages() call.
+POLICIES = ('drop_oldest', 'drop_newest', 'block')
+
+
+class Record(tuple):
+    '''
+    Read-only view of one decoded frame: (sn, version, type, pc_tm, values, index).
+    values: tuple from packet_decoder, index: field name -> position in values.
+    '''
+    __slots__ = ()
+
+    def __new__(cls, sn, version, packet_type, pc_tm, values, index):
+        return tuple.__new__(cls, (sn, version, packet_type, pc_tm, values, index))
+
+    sn = property(operator.itemgetter(0))
+    version = property(operator.itemgetter(1))
+    type = property(operator.itemgetter(2))
+    pc_tm = property(operator.itemgetter(3))
+    values = property(operator.itemgetter(4))
+
+    def get(self, name):
+        '''
+        returns: value of field name, eg. record.get('roll').
+        '''
+        return self[4][self[5][name]]
+
+    def to_message(self):
+        '''
+        returns: message dict of on_message().
+        '''
+        data = collections.OrderedDict()
+        data['pc_tm'] = self[3]
+        for name, v in zip(self[5], self[4]):
+            data[name] = v
+        msg = {}
+        msg['sn'] = self[0]
+        msg['version'] = self[1]
+        msg['type'] = self[2]
+        msg['data'] = data
+        return msg
+
+
+_field_indexes = {}
+
+
+def field_index(packet_type):
+    '''
+    returns: shared dict of field name -> position of packet_type.
+    '''
+    index = _field_indexes.get(packet_type)
+    if index is None:
+        fields = packet_decoder.PACKET_FORMATS[packet_type].fields
+        index = collections.OrderedDict((name, i) for i, name in enumerate(fields))
+        _field_indexes[packet_type] = index
+    return index
+
+
+class AppChannel():
+    '''
+    Bounded queue and delivery thread of one app.
+    policy: 'drop_oldest' or 'drop_newest' when queue is full, or 'block' the publisher until there is room.
+    '''
+    def __init__(self, app, max_records=MAX_RECORDS, policy='drop_oldest', batch_size=BATCH_SIZE):
+        if policy not in POLICIES:
+            raise ValueError('Unknown policy {0}, must be one of {1}.'.format(policy, POLICIES))
+        self.app = app
+        self.max_records = max_records
+        self.policy = policy
+        self.batch_size = batch_size
+        self.records = collections.deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.running = True
+        # statistics
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.max_lag = 0  # max records waiting in queue.
+        self.errors = 0
+        self.thread = threading.Thread(target=self.deliver, name='app-{0}'.format(type(app).__name__))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def publish(self, record):
+        '''
+        queue one record, never waits unless policy is 'block'.
+        '''
+        with self.lock:
+            self.published += 1
+            if len(self.records) >= self.max_records:
+                if self.policy == 'drop_newest':
+                    self.dropped += 1
+                    return
+                if self.policy == 'drop_oldest':
+                    self.records.popleft()
+                    self.dropped += 1
+                else:
+                    while self.running and len(self.records) >= self.max_records:
+                        self.not_full.wait()
+            self.records.append(record)
+            if len(self.records) > self.max_lag:
+                self.max_lag = len(self.records)
+            self.not_empty.notify()
+
+    def deliver(self):
+        while True:
+            with self.lock:
+                while self.running and not self.records:
+                    self.not_empty.wait()
+                if not self.records:
+                    return
+                n = min(len(self.records), self.batch_size)
+                batch = [self.records.popleft() for _ in range(n)]
+                self.not_full.notify_all()
+            try:
+                if hasattr(self.app, 'on_messages'):
+                    self.app.on_messages(batch)
+                else:  # app is not derived from ApplicationBase.
+                    for record in batch:
+                        self.app.on_message(record.to_message())
+            except Exception as e:
+                self.errors += 1
+                print('App {0} error: {1}'.format(type(self.app).__name__, e))
+            self.delivered += n
+
+    def lag(self):
+        '''
+        returns: records waiting in queue.
+        '''
+        return len(self.records)
+
+    def close(self):
+        '''
+        deliver pending records and stop the thread.
+        '''
+        with self.lock:
+            self.running = False
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+        self.thread.join()
+
+    def stats(self):
+        return {
+            'app': type(self.app).__name__,
+            'published': self.published,
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'lag': self.lag(),
+            'max_lag': self.max_lag,
+            'errors': self.errors,
+            }
+
+
+_channels = {}  # id(app) -> AppChannel, an app shared by several loggers has one channel.
+_channels_lock = threading.Lock()
+
+
+def get_channel(app, max_records=MAX_RECORDS, policy='drop_oldest', batch_size=BATCH_SIZE):
+    '''
+    returns: the AppChannel of app, created by the first call.
+    '''
+    with _channels_lock:
+        channel = _channels.get(id(app))
+        if channel is None:
+            channel = AppChannel(app, max_records, policy, batch_size)
+            _channels[id(app)] = channel
+        return channel
+
+
+def close_channels():
+    with _channels_lock:
+        channels = list(_channels.values())
+        _channels.clear()
+    for channel in channels:
+        channel.close()
@@ -20,3 +20,11 @@ class ApplicationBase():
         on_message will be invoked when driver parse a whole frame successful.
         '''
         pass
+
+    def on_messages(self, batch):
+        '''
+        on_messages will be invoked on the app's own thread with a list of app_dispatcher.Record.
+        Override it to handle records in batch, by default each record is passed to on_message as a dict.
+        '''
+        for record in batch:
+            self.on_message(record.to_message())
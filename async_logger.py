@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*
+"""
+Log multi-IMUs data on one asyncio event loop.
+Each device is a coroutine reading its communicator with aread(), so dozens of serial
+ports, TCP connections and data files share one thread. Other coroutines, eg. servers
+for network clients, can run on the same loop.
+"""
+
+import sys
+import datetime
+import asyncio
+import communicator
+import imu_logger
+
+RETRY_INTERVAL = 1.0  # seconds between retries of opening a device, same as imu_logger.run().
+READ_SIZE = 4096  # max bytes read from a device per call.
+
+
+async def collect(logger):
+    '''
+    open logger.cmt, read and parse data until the device is disconnected or logger is stopped.
+    returns: False when a data file reaches its end, otherwise True.
+    '''
+    logger.reinit()
+    if not await logger.cmt.aopen():
+        return True
+    print("Device[{0}] start at:[{1}].".format(logger.cmt.port, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+    try:
+        while not logger.exit_event.is_set():
+            data = await logger.cmt.aread(READ_SIZE)
+            if not data:  # end of data file.
+                return False
+            logger.process_data(data)
+    finally:
+        logger.flush_data_file()
+        logger.close_raw_tee()
+        await logger.cmt.aclose()
+        print("Device[{0}] stop at:[{1}].".format(logger.cmt.port, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+    return True
+
+
+async def poll(logger):
+    '''
+    flush buffered rows of logger while no data comes.
+    '''
+    while True:
+        await asyncio.sleep(logger.flush_interval)
+        logger.poll_data_files()
+
+
+async def run_logger(logger):
+    '''
+    collect data of logger, retry after RETRY_INTERVAL, or the backoff delay of its communicator, when the device is disconnected.
+    '''
+    poller = asyncio.ensure_future(poll(logger))
+    try:
+        while True:
+            try:
+                if not await collect(logger):
+                    return
+            except Exception as e:
+                print(e)
+            print("retry start_collection ...")
+            sys.stdout.flush()
+            await asyncio.sleep(logger.cmt.retry_delay() or RETRY_INTERVAL)
+    finally:
+        poller.cancel()
+
+
+def new_logger(cmt, b_rst=False, apps=None, output_mode='csv'):
+    logger = imu_logger.IMULogger()
+    if apps is not None:
+        for app in apps:
+            logger.add_app(app)
+    logger.set_reset_flag(b_rst) # True: reset IMU when receive the first packet.
+    logger.set_output_mode(output_mode)
+    logger.cmt = cmt
+    return logger
+
+
+def serial_logger(port, baud, b_rst=False, apps=None, output_mode='csv'):
+    cmt = communicator.SerialPort()
+    cmt.port = port
+    cmt.baud = baud
+    return new_logger(cmt, b_rst, apps, output_mode)
+
+
+def tcpip_logger(host, port, b_rst=False, apps=None, output_mode='csv'):
+    return new_logger(communicator.TCPIP(host, port), b_rst, apps, output_mode)
+
+
+def file_logger(data_file, apps=None, output_mode='csv'):
+    cmt = communicator.DataFile(data_file)
+    cmt.port = 'file'
+    return new_logger(cmt, False, apps, output_mode)
+
+
+async def run_loggers(loggers):
+    await asyncio.gather(*[run_logger(logger) for logger in loggers])
+
+
+def run(args):
+    '''
+    wrapper, args: list of (port, baud, b_rst, apps) same as imu_logger.run().
+    returns False when user trigger KeyboardInterrupt to stop this program.
+    '''
+    loggers = [serial_logger(*arg) for arg in args]
+    try:
+        asyncio.run(run_loggers(loggers))
+    except KeyboardInterrupt:  # response for KeyboardInterrupt such as Ctrl+C
+        print('User stop this program by KeyboardInterrupt! File:[{0}], Line:[{1}]'.format(__file__, sys._getframe().f_lineno))
+        return False
+    return True
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*
+"""
+Throughput benchmark of the IMU logging pipeline with synthetic frames.
+
+Stages, measured on the same generated data in memory:
+    scan:   FrameScanner splits chunks into frames.
+    crc:    crc16.check_frame of every frame.
+    decode: packet_decoder.decode of every good frame.
+    parse:  IMULogger.process_data, the whole parser including handlers and log files.
+    memory: peak traced allocations of parse.
+End-to-end paths, IMULogger receiver + parser threads reading from:
+    file:   communicator.DataFile
+    pty:    communicator.SerialPort on a pseudo terminal (POSIX)
+    tcp:    communicator.TCPIP from a local server
+
+Usage:
+    python benchmark.py -n 200000 --mix A1:3,S1:1 --corrupt bad_crc:0.001,garbage:0.001 --save base.json
+    python benchmark.py -n 200000 --mix A1:3,S1:1 --baseline base.json
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import threading
+import contextlib
+import tracemalloc
+import frame_generator
+import frame_scanner
+import crc16
+import packet_decoder
+import communicator
+import imu_logger
+import metrics
+
+CHUNK_SIZE = 4096
+IDLE_TIMEOUT = 2.0  # seconds without new frames to end an end-to-end run.
+DEFAULT_MIX = 'a1:1,a2:1,z1:1,s1:1,S1:1,A1:1,A2:1,A3:1,d1:1,d2:1,e2:1'
+
+
+def chunks(data, size=CHUNK_SIZE):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def quiet(verbose):
+    '''
+    silence prints of loggers unless verbose.
+    '''
+    if verbose:
+        return contextlib.ExitStack()
+    return contextlib.redirect_stdout(open(os.devnull, 'w'))
+
+
+def new_logger():
+    '''
+    returns: IMULogger with its own metrics registry, so counters of runs are not mixed.
+    '''
+    logger = imu_logger.IMULogger()
+    logger.metrics_registry = metrics.Registry()
+    return logger
+
+
+def frames_of(logger):
+    '''
+    returns: good frames parsed by logger, excluding 'ID'.
+    '''
+    if logger.metrics is None:
+        return 0
+    return sum(c.value for tp, c in logger.metrics.frames.items() if tp != 'ID')
+
+
+def result(name, seconds, frames, nbytes, **extra):
+    r = {
+        'seconds': seconds,
+        'frames': frames,
+        'frames_per_second': frames / seconds if seconds > 0 else 0.0,
+        'mb_per_second': nbytes / seconds / 1e6 if seconds > 0 else 0.0,
+        }
+    r.update(extra)
+    return name, r
+
+
+def bench_stages(data, output_mode, verbose):
+    results = []
+    blocks = chunks(data)
+
+    start = time.perf_counter()
+    scanner = frame_scanner.FrameScanner(payload_lengths=packet_decoder.PAYLOAD_LENGTHS)
+    frames = []
+    for block in blocks:
+        scanner.feed(block)
+        frames.extend(scanner.frames())
+    results.append(result('scan', time.perf_counter() - start, len(frames), len(data)))
+
+    start = time.perf_counter()
+    good = [f for f in frames if crc16.check_frame(f)]
+    results.append(result('crc', time.perf_counter() - start, len(frames), len(data), crc_errors=len(frames) - len(good)))
+
+    start = time.perf_counter()
+    decoded = 0
+    for f in good:
+        tp = f[2:4].decode()
+        if tp in packet_decoder.PACKET_FORMATS:
+            packet_decoder.decode(tp, f)
+            decoded += 1
+    results.append(result('decode', time.perf_counter() - start, decoded, len(data)))
+
+    def parse():
+        logger = new_logger()
+        logger.get_data_from_file(os.devnull)
+        logger.set_output_mode(output_mode)
+        for block in blocks:
+            logger.process_data(block)
+        logger.flush_data_file()
+        return logger
+
+    with quiet(verbose):
+        start = time.perf_counter()
+        logger = parse()
+        seconds = time.perf_counter() - start
+    results.append(result('parse', seconds, frames_of(logger), len(data),
+                          crc_errors=logger.metrics.crc_errors.value, resyncs=logger.metrics.resyncs.value))
+
+    with quiet(verbose):
+        tracemalloc.start()
+        logger = parse()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    results.append(('memory', {'parse_peak_bytes': peak, 'input_bytes': len(data)}))
+    return results
+
+
+def wait_frames(logger, expected, timeout=IDLE_TIMEOUT):
+    '''
+    wait until logger parsed expected frames or no frame arrived for timeout seconds.
+    returns: seconds from call until the last frame.
+    '''
+    start = time.perf_counter()
+    last, last_time = -1, start
+    while True:
+        n = frames_of(logger)
+        now = time.perf_counter()
+        if n != last:
+            last, last_time = n, now
+        if n >= expected or now - last_time > timeout:
+            return last_time - start
+        time.sleep(0.005)
+
+
+def run_logger(logger, output_mode):
+    logger.set_output_mode(output_mode)
+    logger.reinit()
+    t = threading.Thread(target=logger.start_collection)
+    t.daemon = True
+    t.start()
+    return t
+
+
+def latency(logger):
+    h = logger.metrics.latency.get() if logger.metrics else None
+    if not h or not h['count']:
+        return {}
+    p99 = None
+    for le, n in h['buckets'].items():
+        if n >= 0.99 * h['count']:
+            p99 = le
+            break
+    return {'latency_mean_ms': h['sum'] / h['count'] * 1e3, 'latency_p99_le_s': p99}
+
+
+def bench_file(data, expected, output_mode, verbose):
+    with tempfile.NamedTemporaryFile(suffix='.bin', delete=False) as f:
+        f.write(data)
+    try:
+        with quiet(verbose):
+            logger = new_logger()
+            logger.get_data_from_file(f.name)
+            t = run_logger(logger, output_mode)
+            seconds = wait_frames(logger, expected)
+            logger.stop()
+            t.join(5)
+    finally:
+        os.unlink(f.name)
+    return result('file', seconds, frames_of(logger), len(data), **latency(logger))
+
+
+def feed(write, data, rate, frame_count):
+    '''
+    write data in chunks, paced to rate frames per second if rate > 0.
+    '''
+    blocks = chunks(data)
+    per_block = frame_count / float(len(blocks)) if blocks else 0
+    start = time.perf_counter()
+    for i, block in enumerate(blocks):
+        if rate > 0:
+            delay = start + i * per_block / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        write(block)
+
+
+def bench_pty(data, expected, output_mode, rate, verbose):
+    import pty
+    import tty
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    name = os.ttyname(slave)
+    try:
+        with quiet(verbose):
+            logger = new_logger()
+            logger.get_data_from_serial_port(name, 115200)
+            t = run_logger(logger, output_mode)
+            time.sleep(0.3)  # wait for the port to open.
+            w = threading.Thread(target=feed, args=(lambda b: os.write(master, b), data, rate, expected))
+            w.daemon = True
+            w.start()
+            seconds = wait_frames(logger, expected)
+            logger.stop()
+            t.join(5)
+    finally:
+        os.close(master)
+        os.close(slave)
+    return result('pty', seconds, frames_of(logger), len(data), **latency(logger))
+
+
+def bench_tcp(data, expected, output_mode, rate, verbose):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+
+    def serve():
+        conn, _ = server.accept()
+        with conn:
+            feed(conn.sendall, data, rate, expected)
+            time.sleep(IDLE_TIMEOUT + 1)  # keep connection until the logger is stopped.
+
+    w = threading.Thread(target=serve)
+    w.daemon = True
+    w.start()
+    try:
+        with quiet(verbose):
+            logger = new_logger()
+            logger.cmt = communicator.TCPIP('127.0.0.1', server.getsockname()[1])
+            t = run_logger(logger, output_mode)
+            seconds = wait_frames(logger, expected)
+            logger.stop()
+            t.join(5)
+    finally:
+        server.close()
+    return result('tcp', seconds, frames_of(logger), len(data), **latency(logger))
+
+
+def compare(results, baseline):
+    '''
+    print ratio of frames/s and memory to baseline, > 1.0 is faster or smaller.
+    '''
+    print('\nCompared with baseline (> 1.00 is better):')
+    for name, r in results.items():
+        b = baseline.get(name)
+        if not b:
+            continue
+        if 'frames_per_second' in r and b.get('frames_per_second'):
+            print('  {0:8s} {1:6.2f}x frames/s'.format(name, r['frames_per_second'] / b['frames_per_second']))
+        if 'parse_peak_bytes' in r and r['parse_peak_bytes']:
+            print('  {0:8s} {1:6.2f}x peak memory'.format(name, b['parse_peak_bytes'] / float(r['parse_peak_bytes'])))
+
+
+def parse_corruption(text):
+    return dict((k, float(v)) for k, v in frame_generator.parse_mix(text).items()) if text else {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark IMU frame parsing with synthetic data.')
+    parser.add_argument('-n', '--frames', type=int, default=100000, help='number of frames')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='packet types and weights, eg. A1:3,S1:1')
+    parser.add_argument('--corrupt', default='', help='probabilities, eg. bad_crc:0.001,truncated:0.001,garbage:0.001')
+    parser.add_argument('--rate', type=float, default=0, help='frames/s of pty and tcp paths, 0: as fast as possible')
+    parser.add_argument('--paths', default='stages,file,pty,tcp', help='which benchmarks to run')
+    parser.add_argument('--output', default='csv', choices=['csv', 'bin', 'both'], help='output mode of IMULogger')
+    parser.add_argument('--save', help='save results to a JSON file, eg. as baseline')
+    parser.add_argument('--baseline', help='compare with results saved by --save')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-v', '--verbose', action='store_true', help='show prints of loggers')
+    args = parser.parse_args()
+
+    gen = frame_generator.FrameGenerator(frame_generator.parse_mix(args.mix), args.rate, parse_corruption(args.corrupt), args.seed)
+    data = gen.generate(args.frames)
+    expected = gen.expected_frames()
+    print('Generated {0} frames, {1} bytes, {2} good frames, corrupted: {3}'.format(args.frames, len(data), expected, gen.corrupted))
+
+    paths = args.paths.split(',')
+    results = []
+    workdir = tempfile.mkdtemp(prefix='imu_bench_')  # log files of IMULogger go to workdir/data
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        if 'stages' in paths:
+            results.extend(bench_stages(data, args.output, args.verbose))
+        if 'file' in paths:
+            results.append(bench_file(data, expected, args.output, args.verbose))
+        if 'pty' in paths and os.name == 'posix':
+            results.append(bench_pty(data, expected, args.output, args.rate, args.verbose))
+        if 'tcp' in paths:
+            results.append(bench_tcp(data, expected, args.output, args.rate, args.verbose))
+    finally:
+        os.chdir(cwd)
+
+    for name, r in results:
+        print('{0:8s} '.format(name) + ', '.join('{0}={1}'.format(k, '{0:.4g}'.format(v) if isinstance(v, float) else v) for k, v in r.items()))
+    print('Log files: {0}'.format(workdir))
+
+    results = dict(results)
+    results['config'] = vars(args)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
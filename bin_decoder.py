@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*
+"""
+Decode a whole IMU .bin capture offline with NumPy.
+The file is mapped into memory, all 'UU' frames are located in bulk, grouped by
+packet type, CRC checked, decoded and scaled as whole arrays.
+"""
+
+import os
+import mmap
+import sys
+import datetime
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+import crc16
+import packet_decoder
+import raw_tee
+from frame_scanner import PAYLOAD_IDX, FRAME_OVERHEAD, MAX_FRAME_LIMIT
+
+BLOCK_SIZE = 64*1024*1024  # bytes searched at once, limits memory used by masks.
+
+def type_code(packet_type):
+    '''packet type such as 'a1' to the big endian uint16 at frame[2:4].
+    '''
+    return (ord(packet_type[0]) << 8) | ord(packet_type[1])
+
+
+class BinDecoder():
+    '''
+    Locate, check and decode all frames of a .bin capture.
+    '''
+    def __init__(self, file_name, block_size=BLOCK_SIZE):
+        self.file_name = file_name
+        self.block_size = block_size
+        self.data = None
+        self.offsets = {}  # packet type -> offsets of good frames.
+        self.pc_time_ns = {}  # packet type -> PC times of good frames, only when read from a raw_tee index.
+        self.crc_errors = 0
+
+    def open(self):
+        if os.path.getsize(self.file_name) == 0:
+            self.data = np.zeros(0, dtype=np.uint8)
+        else:
+            self.data = np.memmap(self.file_name, dtype=np.uint8, mode='r')
+        return self.data
+
+    def find_frames(self, packet_types=None):
+        '''
+        Find offsets of all good frames, grouped by packet type.
+        returns: {packet type: int64 array of offsets of header 'UU'}
+        '''
+        if self.data is None:
+            self.open()
+        data = self.data
+        if packet_types is None:
+            packet_types = [k for k in packet_decoder.PACKET_FORMATS if k != 'ID']
+
+        found = dict((k, []) for k in packet_types)
+        last_end = 0  # end of last good frame, frames starting inside it are dropped.
+        for block_start in range(0, len(data), self.block_size):
+            # window overlaps next block, so frames starting in this block are complete.
+            window = data[block_start : block_start + self.block_size + MAX_FRAME_LIMIT]
+            n = min(self.block_size, len(window) - 1)
+            cand = np.flatnonzero((window[:n] == 0X55) & (window[1:n+1] == 0X55))
+            cand = cand[cand + PAYLOAD_IDX <= len(window)]
+            tp = (window[cand + 2].astype(np.uint16) << 8) | window[cand + 3]
+            payload_len = window[cand + 4]
+
+            starts, ends, types = [], [], []
+            for i, k in enumerate(packet_types):
+                size = packet_decoder.PACKET_FORMATS[k].size
+                sel = (tp == type_code(k)) & (payload_len == size) \
+                    & (cand + size + FRAME_OVERHEAD <= len(window))
+                offs = cand[sel]
+                if len(offs) == 0:
+                    continue
+                ok = crc16.check_frames_batch(window, offs, size)
+                self.crc_errors += int(len(ok) - np.count_nonzero(ok))
+                offs = offs[ok] + block_start
+                starts.append(offs)
+                ends.append(offs + size + FRAME_OVERHEAD)
+                types.append(np.full(len(offs), i, dtype=np.int64))
+            if not starts:
+                continue
+
+            starts = np.concatenate(starts)
+            ends = np.concatenate(ends)
+            types = np.concatenate(types)
+            order = np.argsort(starts, kind='stable')
+            starts, ends, types = starts[order], ends[order], types[order]
+
+            # drop 'UU' matched inside the payload of a previous good frame.
+            prev_end = np.maximum.accumulate(np.concatenate(([last_end], ends[:-1])))
+            keep = starts >= prev_end
+            starts, ends, types = starts[keep], ends[keep], types[keep]
+            if len(ends):
+                last_end = max(last_end, int(ends.max()))
+
+            for i, k in enumerate(packet_types):
+                found[k].append(starts[types == i])
+
+        self.offsets = {}
+        for k, v in found.items():
+            offs = np.concatenate(v) if v else np.zeros(0, dtype=np.int64)
+            if len(offs):
+                self.offsets[k] = offs
+        return self.offsets
+
+    def use_index(self, index, packet_types=None):
+        '''
+        Take offsets and PC times of good frames from a raw_tee index instead of searching them.
+        returns: {packet type: int64 array of offsets of header 'UU'}
+        '''
+        if self.data is None:
+            self.open()
+        if packet_types is None:
+            packet_types = [k for k in packet_decoder.PACKET_FORMATS if k != 'ID']
+        self.offsets = {}
+        self.pc_time_ns = {}
+        for k in packet_types:
+            size = packet_decoder.PACKET_FORMATS[k].size
+            sel = (index['packet_type'] == k.encode()) & (index['length'] == size + FRAME_OVERHEAD) \
+                & (index['offset'] + size + FRAME_OVERHEAD <= len(self.data))
+            if np.any(sel):
+                self.offsets[k] = index['offset'][sel].astype(np.int64)
+                self.pc_time_ns[k] = index['pc_time_ns'][sel]
+        return self.offsets
+
+    def decode(self, packet_type):
+        '''
+        Decode all good frames of packet_type.
+        returns: structured array with raw values of each field.
+        '''
+        fmt = packet_decoder.PACKET_FORMATS[packet_type]
+        offs = self.offsets.get(packet_type, np.zeros(0, dtype=np.int64))
+        if len(offs) == 0 or len(self.data) < fmt.size:
+            return np.zeros(0, dtype=fmt.dtype())
+        # row i of windows is data[i:i + size], a view without copy, so only the selected payloads are copied
+        # and the index is one offset per frame instead of one per byte.
+        windows = as_strided(self.data, shape=(len(self.data) - fmt.size + 1, fmt.size), strides=(1, 1), writeable=False)
+        rows = windows[offs + PAYLOAD_IDX]
+        return rows.view(fmt.dtype()).reshape(-1)
+
+    def read_device_info(self):
+        '''
+        returns: (sn, version) of the first good 'ID' frame, (None, None) if not found.
+        '''
+        if len(self.data) == 0:
+            return None, None
+        fmt = packet_decoder.PACKET_FORMATS['ID']
+        with open(self.file_name, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                off = mm.find(b'\x55\x55\x49\x44') # 'UUID'
+                while off >= 0:
+                    frame = mm[off : off + mm[off + 4] + FRAME_OVERHEAD] if off + 4 < len(mm) else b''
+                    if len(frame) > PAYLOAD_IDX + fmt.size and crc16.check_frame(frame):
+                        sn = fmt.unpack(frame)[0]
+                        version = frame[PAYLOAD_IDX + fmt.size : -2].decode(errors='ignore').replace('\x00','')
+                        return sn, version
+                    off = mm.find(b'\x55\x55\x49\x44', off + 2)
+            finally:
+                mm.close()
+        return None, None
+
+
+def scale(fmt, raw):
+    '''
+    Apply scale factors of a PacketFormat to a structured array of raw values.
+    returns: structured array, scaled fields are float64.
+    '''
+    if fmt.scales is None:
+        return raw
+    descr = [(name, 'f8' if s != 1 else raw.dtype[name].newbyteorder('='))
+             for name, s in zip(fmt.fields, fmt.scales)]
+    out = np.empty(len(raw), dtype=descr)
+    for name, s in zip(fmt.fields, fmt.scales):
+        out[name] = raw[name] * s if s != 1 else raw[name]
+    return out
+
+
+def save_csv(file_dir, values, pc_tm):
+    '''
+    Write a structured array as CSV in the same layout as IMULogger, the whole array is formatted by numpy.savetxt.
+    pc_tm: one string for all rows, or an array of strings, one per row.
+    '''
+    names = values.dtype.names
+    header = ','.join(('pc_tm',) + names)
+    fmt = [('%f' if values.dtype[name].kind == 'f' else '%d') for name in names]
+    if isinstance(pc_tm, str):
+        fmt = pc_tm.replace('%', '%%') + ',' + ','.join(fmt)
+    else:
+        rows = np.empty(len(values), dtype=[('pc_tm', np.asarray(pc_tm).dtype)] + [(name, values.dtype[name]) for name in names])
+        rows['pc_tm'] = pc_tm
+        for name in names:
+            rows[name] = values[name]
+        values = rows
+        fmt = '%s,' + ','.join(fmt)
+    np.savetxt(file_dir, values, fmt=fmt, header=header, comments='')
+
+
+def decode_bin_file(file_name, output='csv', out_dir='data', use_index=True):
+    '''
+    Decode a whole .bin capture offline.
+    parameters:
+        output – 'csv' or 'npy'.
+        use_index – take frames and their PC times from the raw_tee index of the capture if it exists.
+    returns: {packet type: structured array of scaled values}
+    '''
+    start_time = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+    pc_tm = datetime.datetime.now().strftime('%H:%M:%S.%f')[:-3]
+    name = os.path.splitext(os.path.basename(file_name))[0]
+
+    decoder = BinDecoder(file_name)
+    decoder.open()
+    index = raw_tee.load_index(file_name) if use_index else []
+    if len(index):
+        decoder.use_index(index)
+        print('Frames of {0} are taken from {1}'.format(file_name, raw_tee.index_name(file_name)))
+    else:
+        decoder.find_frames()
+    sn, version = decoder.read_device_info()
+    print('Decode {0}, SN: {1}, Version: {2}, CRC error: {3}'.format(file_name, sn, version, decoder.crc_errors))
+
+    if not os.path.exists(out_dir):
+        os.mkdir(out_dir)
+
+    result = {}
+    for packet_type in decoder.offsets:
+        fmt = packet_decoder.PACKET_FORMATS[packet_type]
+        values = scale(fmt, decoder.decode(packet_type))
+        result[packet_type] = values
+
+        file_dir = os.path.join(out_dir, packet_type + '_' + start_time + '_' + name + '.' + output)
+        if output == 'npy':
+            np.save(file_dir, values)
+        elif packet_type in decoder.pc_time_ns:
+            import binary_log
+            save_csv(file_dir, values, binary_log.format_pc_tm(decoder.pc_time_ns[packet_type]))
+        else:
+            save_csv(file_dir, values, pc_tm)
+        print('{0}: {1} frames -> {2}'.format(packet_type, len(values), file_dir))
+    sys.stdout.flush()
+    return result
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: python bin_decoder.py capture.bin [csv|npy]')
+    else:
+        decode_bin_file(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else 'csv')
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*
+"""
+Compact binary log of IMU packets, one file per packet type.
+
+File layout:
+    MAGIC (8 bytes) + header len (uint32, little endian) + JSON header (padded with spaces)
+    + fixed-width records: pc_time_ns (int64) + raw payload in the packet's native layout.
+The data offset is aligned to 64 bytes, so a file can be mapped with numpy.memmap directly.
+Values are stored unscaled, the scale factors are kept in the JSON header.
+Compressed segments of data_sink.RotatingSink (.imubin.gz, .imubin.xz) are loaded into memory instead.
+"""
+
+import os
+import sys
+import json
+import time
+import struct
+import numpy as np
+from numpy.lib import recfunctions
+import packet_decoder
+import bin_decoder
+import data_sink
+
+MAGIC = b'IMUBIN1\n'
+HEADER_ALIGN = 64
+TIME_FIELD = 'pc_time_ns'
+EXTENSION = '.imubin'
+PAYLOAD_IDX = packet_decoder.PAYLOAD_IDX
+
+_LEN = struct.Struct('<I')
+_TIME = struct.Struct('<q')
+
+
+def record_dtype(fmt):
+    '''
+    dtype of one record: pc_time_ns + fields of PacketFormat fmt.
+    '''
+    return np.dtype([(TIME_FIELD, '<i8')] + fmt.dtype().descr)
+
+
+def make_header(fmt):
+    '''
+    returns: bytes of file header, len is a multiple of HEADER_ALIGN.
+    '''
+    spec = fmt.struct.format
+    if isinstance(spec, bytes):
+        spec = spec.decode()
+    header = {
+        'packet_type': fmt.packet_type,
+        'format': spec,
+        'fields': list(fmt.fields),
+        'scales': list(fmt.scales) if fmt.scales is not None else None,
+        'units': list(fmt.units) if fmt.units is not None else None,
+        'dtype': [list(d) for d in record_dtype(fmt).descr],
+        'record_size': record_dtype(fmt).itemsize,
+        }
+    js = json.dumps(header).encode()
+    pad = -(len(MAGIC) + _LEN.size + len(js)) % HEADER_ALIGN
+    js += b' ' * pad
+    return MAGIC + _LEN.pack(len(js)) + js
+
+
+class BinaryLogWriter():
+    '''
+    Append fixed-width records of one packet type through a BufferedSink.
+    '''
+    def __init__(self, file_name, fmt, flush_bytes=data_sink.FLUSH_BYTES, flush_interval=data_sink.FLUSH_INTERVAL, rotation=None):
+        self.fmt = fmt
+        self.size = fmt.size
+        self.sink = data_sink.open_sink(file_name, 'wb', flush_bytes, flush_interval, rotation)
+        self.sink.write(make_header(fmt))
+        self.sink.flush()
+        self.records = 0
+
+    def write(self, frame, pc_time_ns):
+        '''
+        append payload of a whole frame with its PC time in ns.
+        '''
+        self.sink.write(_TIME.pack(pc_time_ns) + frame[PAYLOAD_IDX : PAYLOAD_IDX + self.size])
+        self.records += 1
+
+    def poll(self):
+        self.sink.poll()
+
+    def flush(self):
+        self.sink.flush()
+
+    def close(self):
+        self.sink.close()
+
+
+def open_log(file_name):
+    '''
+    open a binary log, or a compressed segment of it, for reading.
+    '''
+    for compression, (open_func, suffix) in data_sink.COMPRESSIONS.items():
+        if compression and file_name.endswith(suffix):
+            return open_func(file_name, 'rb')
+    return open(file_name, 'rb')
+
+
+def read_header(file_name):
+    '''
+    returns: (header dict, offset of the first record)
+    '''
+    with open_log(file_name) as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{0} is not a binary IMU log.'.format(file_name))
+        (n,) = _LEN.unpack(f.read(_LEN.size))
+        header = json.loads(f.read(n).decode())
+    return header, len(MAGIC) + _LEN.size + n
+
+
+def load(file_name):
+    '''
+    Map all complete records of a binary log.
+    returns: (header dict, structured numpy.memmap of raw records)
+    '''
+    header, offset = read_header(file_name)
+    dtype = np.dtype([tuple(d) for d in header['dtype']])
+    if not file_name.endswith(EXTENSION):  # compressed segment
+        with open_log(file_name) as f:
+            data = f.read()
+        count = (len(data) - offset) // dtype.itemsize
+        return header, np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+    count = (os.path.getsize(file_name) - offset) // dtype.itemsize  # ignore a partly written last record.
+    if count == 0:
+        return header, np.zeros(0, dtype=dtype)
+    return header, np.memmap(file_name, dtype=dtype, mode='r', offset=offset, shape=(count,))
+
+
+def format_pc_tm(pc_time_ns):
+    '''
+    local time of int64 ns array to 'HH:MM:SS.mmm' strings, same as pc_tm of CSV logs.
+    '''
+    if len(pc_time_ns) == 0:
+        return np.zeros(0, dtype='U12')
+    utc_offset = time.localtime(pc_time_ns[0] / 1e9).tm_gmtoff
+    t = (np.asarray(pc_time_ns, dtype=np.int64) + utc_offset * 1000000000).astype('datetime64[ns]')
+    s = np.datetime_as_string(t, unit='ms')  # 'YYYY-MM-DDTHH:MM:SS.mmm'
+    return np.ascontiguousarray(s.astype('U23').view('U1').reshape(-1, 23)[:, 11:]).view('U12').reshape(-1)
+
+
+def to_csv(file_name, csv_name=None):
+    '''
+    Convert a binary log to CSV with the same columns as IMULogger.
+    returns: name of CSV file.
+    '''
+    header, records = load(file_name)
+    fmt = packet_decoder.PacketFormat(header['packet_type'], header['format'], header['fields'], header['scales'], header.get('units'))
+    values = bin_decoder.scale(fmt, recfunctions.repack_fields(records[list(fmt.fields)]))
+    if csv_name is None:
+        csv_name = file_name[:file_name.rindex(EXTENSION)] if EXTENSION in file_name else os.path.splitext(file_name)[0]
+        csv_name += '.csv'
+    bin_decoder.save_csv(csv_name, values, format_pc_tm(records[TIME_FIELD]))
+    return csv_name
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: python binary_log.py log{0} [log.csv]'.format(EXTENSION))
+    else:
+        print(to_csv(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None))
@@ -25,6 +25,7 @@ import datetime
 from can.io.blf import BLFReader
 from can.io.asc import ASCReader
 from can_parser import PGNType, CANParser
+import metrics
 
 class CanReader():
     '''
@@ -45,7 +46,10 @@ class CanReader():
         self.log_dir_gear = None
         self.log_dir_tacho = None
 
+        self.metrics = None
+
         if file_name is not None:
+            self.metrics = metrics.CANMetrics(os.path.basename(file_name))
             self.reader_factory()
             self.create_log_files()
         pass
@@ -121,6 +125,11 @@ class CanReader():
         '''
         can_parser = CANParser()
         (_Priority, _PGN, _PF, _PS, _SA) = can_parser.parse_PDU(msg.arbitration_id)
+        if self.metrics is not None:
+            if msg.is_error_frame:  # counted only as an error, not as a message.
+                self.metrics.error_frames.inc()
+            else:
+                self.metrics.message(_PGN, len(msg.data))
 
         data = None
         # timestamp, channel, id, PGN
@@ -14,6 +14,8 @@ import threading
 import time
 from can.protocols import j1939
 from can_parser import PGNType, CarolaCANID, CANParser
+import metrics
+import data_sink
 
 
 class CANReceiver:
@@ -31,6 +33,15 @@ class CANReceiver:
         ## show details can0 for debug.
         # os.system('sudo ip -details link show can0')
 
+        self.log_lock = threading.Lock()
+        self.rotation = data_sink.ROTATION  # None: one plain file per message type, eg. {'max_bytes': 64*1024*1024, 'compression': 'gzip'}
+        self.create_log_files()
+        self.can_parser = CANParser()
+        self.last_speed_65215 = 0
+        self.last_gear = 0
+        self.idx = 0
+        self.metrics = metrics.CANMetrics('can0')
+        # handlers are called from the Notifier thread as soon as it is set up.
         if 0:
             ## set up CAN Bus of J1939
             self.bus = j1939.Bus(channel='can0', bustype='socketcan_native')
@@ -42,15 +53,17 @@ class CANReceiver:
             ## set up Notifier
             self.notifier = can.Notifier(self.can0, [self.msg_handler])
 
-        self.create_log_files()
-        self.can_parser = CANParser()
-        self.last_speed_65215 = 0
-        self.last_gear = 0
-        self.idx = 0
-
     def msg_handler(self,msg):
+        with self.log_lock:  # log files are also polled by the main thread.
+            self.handle_msg(msg)
+
+    def handle_msg(self,msg):
         self.idx += 1
+        if msg.is_error_frame:
+            self.metrics.error_frames.inc()
+            return
         (_Priority, _PGN, _PF, _PS, _SA) = self.can_parser.parse_PDU(msg.arbitration_id)
+        self.metrics.message(_PGN, len(msg.data))
         
         if msg.arbitration_id == CarolaCANID.WS.value:      # Carola wheel speed.
             self.handle_Carola_wheel_speed(msg)
@@ -69,7 +82,7 @@ class CANReceiver:
             pass
         else:
             pass
-        pass
+        self.metrics.latency.observe(time.time() - msg.timestamp)  # socketcan timestamps are epoch seconds.
 
     def handle_Carola_wheel_speed(self,msg):    # Carola wheel speed.
         '''
@@ -79,7 +92,6 @@ class CANReceiver:
         data = self.can_parser.parse_wheel_speed_carola(msg.data)
         str += ','.join('{0:f}'.format(i) for i in data) + '\n'
         self.log_file_carola_vel.write(str )
-        self.log_file_carola_vel.flush()
 
         # Test
         (speed_fr, speed_fl, speed_rr, speed_rl) = data
@@ -93,7 +105,6 @@ class CANReceiver:
         data = self.can_parser.parse_gear_carola(msg.data)
         str += ','.join('{0:f}'.format(i) for i in data) + '\n'
         self.log_file_carola_gear.write(str )
-        self.log_file_carola_gear.flush()
 
         # Test
         (gear,) = data
@@ -107,7 +118,6 @@ class CANReceiver:
         data = self.can_parser.parse_velocity2(msg.data)
         str += ','.join('{0:f}'.format(i) for i in data) + '\n'
         self.log_file_65215_vel.write(str )
-        self.log_file_65215_vel.flush()
 
         # Test
         (front_axle_speed, front_left_wheel_speed, front_right_wheel_speed, \
@@ -127,7 +137,6 @@ class CANReceiver:
         data = self.can_parser.parse_velocity1(msg.data)
         str += ','.join('{0:f}'.format(i) for i in data) + '\n'
         self.log_file_65265_vel.write(str )
-        self.log_file_65265_vel.flush()
         pass
 
     def handle_J1939_gear(self,msg):    # PGN 61445
@@ -138,7 +147,6 @@ class CANReceiver:
         data = self.can_parser.parse_gear(msg.data)
         str += ','.join('{0:f}'.format(i) for i in data) + '\n'
         self.log_file_61445_gear.write(str )
-        self.log_file_61445_gear.flush()
         pass
 
     def create_log_files (self):
@@ -157,11 +165,11 @@ class CANReceiver:
         file_dir_61445_gear    = os.path.join('data', start_time + '_61445_gear' + '.csv')
 
         # self.log_file_all   = open(file_dir, 'w')
-        self.log_file_carola_vel   = open(file_dir_carola_vel, 'w')
-        self.log_file_carola_gear  = open(file_dir_carola_gear, 'w')
-        self.log_file_65215_vel    = open(file_dir_65215_vel, 'w')
-        self.log_file_65265_vel    = open(file_dir_65265_vel, 'w')
-        self.log_file_61445_gear   = open(file_dir_61445_gear, 'w')
+        self.log_file_carola_vel   = data_sink.open_sink(file_dir_carola_vel, 'w', rotation=self.rotation)
+        self.log_file_carola_gear  = data_sink.open_sink(file_dir_carola_gear, 'w', rotation=self.rotation)
+        self.log_file_65215_vel    = data_sink.open_sink(file_dir_65215_vel, 'w', rotation=self.rotation)
+        self.log_file_65265_vel    = data_sink.open_sink(file_dir_65265_vel, 'w', rotation=self.rotation)
+        self.log_file_61445_gear   = data_sink.open_sink(file_dir_61445_gear, 'w', rotation=self.rotation)
 
         # print('Start logging: {0}'.format(file_dir))
         # header = 'time, payload'.replace(' ', '')
@@ -170,26 +178,30 @@ class CANReceiver:
 
         header = 'time, speed_fr, speed_fl, speed_rr, speed_rl, gear'.replace(' ', '')
         self.log_file_carola_vel.write(header + '\n')
-        self.log_file_carola_vel.flush()
 
         header = 'time, gear'.replace(' ', '')
         self.log_file_carola_gear.write(header + '\n')
-        self.log_file_carola_gear.flush()
 
         header = 'time, speed_fa, speed_fl, speed_fr, speed_rl1, speed_rr1, speed_rl2, speed_rr2, gear'.replace(' ', '')
         self.log_file_65215_vel.write(header + '\n')
-        self.log_file_65215_vel.flush()
 
         header = 'time, speed, gear'.replace(' ', '')
         self.log_file_65265_vel.write(header + '\n')
-        self.log_file_65265_vel.flush()
 
         header = 'time, gear'.replace(' ', '')
         self.log_file_61445_gear.write(header + '\n')
-        self.log_file_61445_gear.flush()
 
         pass
 
+    def poll_log_files(self):
+        '''
+        write buffered rows which wait longer than data_sink.FLUSH_INTERVAL, call it when no message comes.
+        '''
+        with self.log_lock:
+            for f in (self.log_file_carola_vel, self.log_file_carola_gear, self.log_file_65215_vel,
+                      self.log_file_65265_vel, self.log_file_61445_gear):
+                f.poll()
+
     def close_log_files (self):
         # self.log_file_all.close()
         self.log_file_carola_vel.close()
@@ -204,3 +216,4 @@ if __name__ == "__main__":
 
     while 1:
         time.sleep(1)
+        receiver.poll_log_files()
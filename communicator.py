@@ -8,13 +8,32 @@ Created on 2020-3-11
 import sys
 import os
 import socket
-import select
+import random
 import time
 import datetime
 import json
 import glob
+import asyncio
+import threading
+import concurrent.futures
 import serial
 import serial.tools.list_ports
+import crc16
+import frame_scanner
+
+AUTOBAUD_RATES = [230400, 115200]
+PROBE_TIMEOUT = 1.0  # seconds to wait for a header on one port and baud, probing stops as soon as it is found.
+PROBE_BYTES = 300  # Assume max_len of a frame is less than 300 bytes, more bytes without a header means a wrong baud.
+PROBE_WORKERS = 16  # ports probed at the same time.
+STREAM_HEADERS = (b'\xAF\x20\x05', b'\xAF\x20\x06', b'\xAF\x20\x07')
+GP_REQUEST = bytes([0X55,0X55,0X47,0X50,0X02,0X49,0X44,0X23,0X3d])  # Get Packet Request of 'ID'
+ID_HEADER = b'\x55\x55\x49\x44'  # 'UUID'
+TCP_READ_SIZE = 64*1024  # bytes of the preallocated receive buffer of TCPIP, max bytes per read.
+TCP_RCVBUF = 1024*1024  # SO_RCVBUF of TCPIP sockets, None: OS default.
+TCP_READ_TIMEOUT = 0.1  # seconds a read waits for data, same as the timeout of serial ports.
+TCP_CONNECT_TIMEOUT = 5.0
+RECONNECT_MIN = 0.5  # seconds before the first reconnect, doubled after each failure up to RECONNECT_MAX.
+RECONNECT_MAX = 30.0
 
 class Communicator():
     '''
@@ -36,10 +55,45 @@ class Communicator():
 
     def write(self,data):
         pass
+
+    def retry_delay(self):
+        '''
+        returns: seconds to wait before opening again after a failure, None: the caller's default.
+        '''
+        return None
     
     def read(self,size):
         pass
 
+    def read_some(self,size):
+        '''
+        read up to size bytes, return as soon as any data is available.
+        '''
+        return self.read(size)
+
+    def fileno(self):
+        '''
+        returns: file descriptor which can be registered with selectors, None if not supported.
+        '''
+        return None
+
+    # asyncio versions, the defaults run the blocking methods in the loop's default executor.
+    async def aopen(self):
+        return await asyncio.get_running_loop().run_in_executor(None, self.open)
+
+    async def aclose(self):
+        return self.close()
+
+    async def awrite(self, data):
+        return await asyncio.get_running_loop().run_in_executor(None, self.write, data)
+
+    async def aread(self, size):
+        '''
+        read at least 1 and at most size bytes.
+        returns: bytes, empty at the end of a file.
+        '''
+        return await asyncio.get_running_loop().run_in_executor(None, self.read_some, size)
+
 
 class SerialPort(Communicator):
     def __init__(self):
@@ -48,13 +102,15 @@ class SerialPort(Communicator):
         self.port = None
         self.baud = None
         self.read_size = 100
+        self.device_cache = DeviceCache(os.path.join(self.setting_folder, 'devices.json'))
         pass
 
     def find_device(self):
-        ''' Finds active ports and then autobauds units
+        ''' Finds active ports and then autobauds units.
+            Known devices in the device cache and the last port are tried first.
         '''
         try:
-            if self.try_last_port():
+            if self.try_cached_devices() or self.try_last_port():
                 pass
             else:
                 while not self.autobaud(self.find_ports()):
@@ -87,36 +143,43 @@ class SerialPort(Communicator):
             raise EnvironmentError('Unsupported platform')
 
         print(ports)
-        result = []
-        for port in ports:
-            try:
-                print('Trying: ' + port)
-                s = serial.Serial(port)
-                s.close()
-                result.append(port)
-            except (OSError, serial.SerialException):
-                pass
-        return result
+        if not ports:
+            return []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(PROBE_WORKERS, len(ports))) as pool:
+            openable = list(pool.map(can_open, ports))
+        return [port for port, ok in zip(ports, openable) if ok]
 
     def autobaud(self, ports):
-        '''Autobauds unit - first check for stream_mode / continuous data, then check by polling unit
-           Converts resets polled unit (temporarily) to 100Hz ODR
+        '''Autobauds unit - check for stream_mode / continuous data on all ports at the same time,
+           each port tries the bauds of AUTOBAUD_RATES in turn. Stops as soon as one port finds a header.
            :returns:
                 true when successful
         '''
-        for port in ports:
-            for baud in [230400, 115200]:
-                self.open_serial_port(port, baud, 1.0)  # Assume at least one whole frame can be grabed in 1 seconds.
-                if self.ser:
-                    serial_data = bytearray(self.ser.read(300))  # Assume max_len of a frame is less than 300 bytes.
-                    self.ser.close()
-                    if self.find_header(serial_data):
-                        self.port = port
-                        self.baud = baud
-                        print('Connected: {0}  {1}'.format(self.port, self.baud))
-                        self.save_last_port()
-                        return True
-        return False
+        found = probe_ports([(port, AUTOBAUD_RATES) for port in ports], self.find_header)
+        if not found:
+            return False
+        self.port, self.baud, _ = found[0]
+        print('Connected: {0}  {1}'.format(self.port, self.baud))
+        self.save_last_port()
+        return True
+
+    def try_cached_devices(self):
+        '''try the USB serial ports whose serial number is in the device cache, at their cached baud.
+           A known device is found even if it is now on another port name, eg. /dev/ttyUSB1 instead of /dev/ttyUSB0.
+           returns: True if a header is found on one of them.
+        '''
+        candidates = []
+        for port, usb_sn in usb_serial_numbers().items():
+            device = self.device_cache.get(usb_sn)
+            if device:
+                candidates.append((port, [device['baud']]))
+        found = probe_ports(candidates, self.find_header)
+        if not found:
+            return False
+        self.port, self.baud, _ = found[0]
+        print('Connected: {0}  {1} (cached)'.format(self.port, self.baud))
+        self.save_last_port()
+        return True
 
     def try_last_port(self):
         '''try to open serial port based on the port and baud read from connection.json.
@@ -124,35 +187,30 @@ class SerialPort(Communicator):
            returns: True if find header
                     False if not find header.
         '''
-        connection = None
         try:
             with open(self.connection_file) as json_data:
                 connection = json.load(json_data)
-            if connection:
-                self.open_serial_port(port=connection['port'], baud=connection['baud'], timeout=1)
-                if self.ser:
-                    serial_data = bytearray(self.ser.read(300))  # Assume max_len of a frame is less than 300 bytes.
-                    self.ser.close()
-                    if self.find_header(serial_data):
-                        self.port = connection['port']
-                        self.baud = connection['baud']
-                        print('Connected: {0}  {1}'.format(self.port, self.baud))
-                        return True
-                    else:
-                        return False
-                else:
-                    return False
+            if not connection or not probe_port(connection['port'], [connection['baud']], self.find_header):
+                return False
+            self.port = connection['port']
+            self.baud = connection['baud']
+            print('Connected: {0}  {1}'.format(self.port, self.baud))
+            return True
         except:
             return False
 
     def save_last_port(self):
+        usb_sn = usb_serial_numbers().get(self.port)
+        if usb_sn:
+            self.device_cache.put(usb_sn, self.port, self.baud)
+
         if not os.path.exists(self.setting_folder):
             try:
                 os.mkdir(self.setting_folder)
             except:
                 return
 
-        connection = {"port" : self.ser.port, "baud" : self.ser.baudrate }
+        connection = {"port" : self.port, "baud" : self.baud }
         try:
             with open(self.connection_file, 'w') as outfile:
                 json.dump(connection, outfile)
@@ -186,10 +244,7 @@ class SerialPort(Communicator):
                 True: Successful.
                 False: Failed.
         '''
-        rev = True if (data.find(b'\xAF\x20\x05') > -1  \
-                    or data.find(b'\xAF\x20\x06') > -1  \
-                    or data.find(b'\xAF\x20\x07') > -1) else False
-        return rev
+        return find_header(data)
 
     def write(self,data):
         '''
@@ -221,20 +276,288 @@ class SerialPort(Communicator):
             # print(e)
             raise
 
+    def read_some(self,size):
+        '''
+        read at least 1 and at most size bytes from the serial port.
+        Unlike read(), it returns as soon as data arrives instead of waiting for size bytes,
+        and only blocks up to the read timeout when there is no data.
+        returns: bytes read from the port.
+        '''
+        data = self.read(1)
+        if data:
+            n = min(self.ser.in_waiting, size - 1)
+            if n > 0:
+                data += self.read(n)
+        return data
+
+    def fileno(self):
+        '''
+        returns: file descriptor of the serial port, None if it is not opened or not supported, eg. on Windows.
+        '''
+        try:
+            return self.ser.fileno() if self.ser else None
+        except Exception:
+            return None
+
     def open(self):
         return self.open_serial_port(self.port, self.baud, timeout=0.1)
 
     def close(self):
         return self.close_serial_port()
 
+    async def aopen(self):
+        return self.open()
+
+    async def aclose(self):
+        return self.close()
+
+    async def wait_fd(self, fd, writable=False):
+        '''
+        wait until fd is ready, fd is registered with the loop only while waiting.
+        '''
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        add, remove = (loop.add_writer, loop.remove_writer) if writable else (loop.add_reader, loop.remove_reader)
+        add(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            remove(fd)
+
+    async def aread(self, size):
+        '''
+        read at least 1 and at most size bytes from the non-blocking file descriptor of the port.
+        Falls back to a thread when the port has no file descriptor, eg. on Windows.
+        '''
+        fd = self.fileno() if os.name == 'posix' else None
+        if fd is None:
+            return await Communicator.aread(self, size)
+        ready = False
+        while True:
+            try:
+                data = os.read(fd, size)  # pyserial opens the port with O_NONBLOCK and VMIN=0 on POSIX.
+            except BlockingIOError:
+                data = b''
+            if data:
+                return data
+            if ready:  # readable but no data, same as pyserial the device is disconnected.
+                raise serial.SerialException('Serial port {0} is disconnected.'.format(self.port))
+            await self.wait_fd(fd)
+            ready = True
+
+    async def awrite(self, data):
+        fd = self.fileno() if os.name == 'posix' else None
+        if fd is None:
+            return await Communicator.awrite(self, data)
+        view = memoryview(data)
+        while view:
+            try:
+                n = os.write(fd, view)
+            except BlockingIOError:
+                n = 0
+            view = view[n:]
+            if view:
+                await self.wait_fd(fd, True)
+        return len(data)
+
+
+def can_open(port):
+    '''
+    returns: True if port can be opened.
+    '''
+    try:
+        s = serial.Serial(port)
+        s.close()
+        return True
+    except (OSError, serial.SerialException, ValueError):
+        return False
+
+
+def find_header(data):
+    '''
+    returns: True if data contains a header of streaming packets.
+    '''
+    for header in STREAM_HEADERS:
+        if data.find(header) > -1:
+            return True
+    return False
+
+
+def find_id_frame(data):
+    '''
+    returns: the first 'ID' frame with correct CRC in data, None if not found.
+    '''
+    scanner = frame_scanner.FrameScanner(ID_HEADER)
+    scanner.feed(data)
+    for frame in scanner.frames():
+        if crc16.check_frame(frame):
+            return frame
+    return None
+
+
+def usb_serial_numbers():
+    '''
+    returns: dict of port -> serial number of USB serial ports which report one.
+    '''
+    try:
+        return dict((p.device, p.serial_number) for p in serial.tools.list_ports.comports() if p.serial_number)
+    except Exception:
+        return {}
+
+
+def probe_port(port, bauds, match, request=None, timeout=PROBE_TIMEOUT, max_bytes=PROBE_BYTES, stop_event=None):
+    '''
+    Open port at each baud in turn, send request if any, and read until match(data) is true.
+    Reading stops as soon as match succeeds, after timeout or max_bytes, or when stop_event is set.
+    returns: (baud, data) of the first baud which matches, None if no baud matches.
+    '''
+    for baud in bauds:
+        if stop_event is not None and stop_event.is_set():
+            return None
+        try:
+            ser = serial.Serial(port, baud, timeout=0.05)
+        except (OSError, serial.SerialException, ValueError):
+            return None
+        try:
+            if request:
+                ser.reset_input_buffer()
+                ser.write(request)
+            data = bytearray()
+            deadline = time.time() + timeout
+            while time.time() < deadline and len(data) < max_bytes:
+                if stop_event is not None and stop_event.is_set():
+                    return None
+                data += ser.read(max(1, min(ser.in_waiting, max_bytes - len(data))))
+                if match(data):
+                    return baud, bytes(data)
+        except (OSError, serial.SerialException):
+            pass
+        finally:
+            ser.close()
+    return None
+
+
+def probe_ports(candidates, match, request=None, timeout=PROBE_TIMEOUT, max_bytes=PROBE_BYTES, first_only=True, workers=PROBE_WORKERS):
+    '''
+    Probe ports at the same time in a thread pool, see probe_port.
+    candidates: list of (port, list of bauds).
+    first_only: stop all probes when one port matches.
+    returns: list of (port, baud, data) of matched ports, in order of candidates.
+    '''
+    if not candidates:
+        return []
+    stop_event = threading.Event() if first_only else None
+    found = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(candidates))) as pool:
+        futures = dict((pool.submit(probe_port, port, bauds, match, request, timeout, max_bytes, stop_event), port)
+                       for port, bauds in candidates)
+        for f in concurrent.futures.as_completed(futures):
+            result = f.result()
+            if result is None:
+                continue
+            found[futures[f]] = result
+            if first_only:
+                stop_event.set()
+                break
+    return [(port, found[port][0], found[port][1]) for port, _ in candidates if port in found]
+
+
+class DeviceCache():
+    '''
+    Baud and info of known devices keyed by USB serial number, saved as JSON.
+    The file is re-read before every update, so loggers in other threads or processes do not lose entries.
+    '''
+    lock = threading.Lock()
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+    def load(self):
+        try:
+            with open(self.file_name) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def get(self, usb_sn):
+        '''
+        returns: dict of port, baud and info of the device, None if unknown.
+        '''
+        return self.load().get(usb_sn)
+
+    def put(self, usb_sn, port, baud, **info):
+        with DeviceCache.lock:
+            devices = self.load()
+            device = devices.get(usb_sn, {})
+            device.update(info)
+            device.update({'port': port, 'baud': baud, 'time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')})
+            devices[usb_sn] = device
+            try:
+                folder = os.path.dirname(self.file_name)
+                if folder and not os.path.exists(folder):
+                    os.makedirs(folder)
+                tmp = self.file_name + '.tmp'
+                with open(tmp, 'w') as f:
+                    json.dump(devices, f, indent=1)
+                os.replace(tmp, self.file_name)
+            except (IOError, OSError) as e:
+                print('Save device cache error: {0}'.format(e))
+
+
+class Backoff():
+    '''
+    Delays between reconnects: doubled from min_delay after each failure up to max_delay,
+    and shortened by a random part of up to jitter, so clients of one host do not retry at the same time.
+    '''
+    def __init__(self, min_delay=RECONNECT_MIN, max_delay=RECONNECT_MAX, jitter=0.5):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.failures = 0
+        self.delay = min_delay
+
+    def next_delay(self):
+        '''
+        count a failure.
+        returns: seconds to wait before the next attempt.
+        '''
+        delay = min(self.max_delay, self.min_delay * (2 ** min(self.failures, 30)))
+        self.failures += 1
+        self.delay = delay * (1 - self.jitter * random.random())
+        return self.delay
+
+    def reset(self):
+        self.failures = 0
+        self.delay = self.min_delay
+
 
 class TCPIP(Communicator):
-    def __init__(self, host ='127.0.0.1', port=8888):#'127.0.0.1'  '192.168.31.223'
+    '''
+    TCP client of a network-attached IMU bridge.
+    Data is received with recv_into() into one preallocated buffer, a read waits at most .timeout for data,
+    and failed connects are retried with exponential backoff and jitter.
+    '''
+    def __init__(self, host ='127.0.0.1', port=8888, read_size=TCP_READ_SIZE, rcvbuf=TCP_RCVBUF, sndbuf=None, timeout=TCP_READ_TIMEOUT):#'127.0.0.1'  '192.168.31.223'
         Communicator.__init__(self)
         self.host = host
         self.port = port
         self.sock = None
-        self.read_size = 1024
+        self.reader = None  # asyncio streams, set by aopen().
+        self.writer = None
+        self.read_size = read_size
+        self.rcvbuf = rcvbuf
+        self.sndbuf = sndbuf
+        self.timeout = timeout
+        self.buffer = bytearray(read_size)
+        self.view = memoryview(self.buffer)
+        self.backoff = Backoff()
+        # statistics
+        self.bytes_received = 0
+        self.recv_calls = 0
+        self.timeouts = 0  # reads without data within .timeout
+        self.connects = 0
+        self.reconnects = 0  # connects after the first one
+        self.connect_failures = 0
         pass
 
     def find_device(self):
@@ -246,14 +569,19 @@ class TCPIP(Communicator):
                     print(datetime.datetime.now().strftime('[%Y_%m_%d %H_%M_%S]:') + 'connect {0}:{1} successfully.'.format(self.host,self.port))
                     # self.close()
                     return True
-                except socket.error :
-                    time.sleep(1)
+                except socket.error as e:
+                    print('{0}, retry in {1:.1f} s.'.format(e, self.backoff.delay))
+                    time.sleep(self.backoff.delay)
                 except Exception as e:
                     print(e)
+                    time.sleep(self.backoff.delay)
         except KeyboardInterrupt:  # response for KeyboardInterrupt such as Ctrl+C
             print('User stop this program by KeyboardInterrupt! File:[{0}], Line:[{1}]'.format(__file__, sys._getframe().f_lineno))
             return False
 
+    def retry_delay(self):
+        return self.backoff.delay if self.backoff.failures else None
+
     def write(self,data):
         '''
         write the bytes data to host.
@@ -263,6 +591,9 @@ class TCPIP(Communicator):
                 False: Exception when sending data, eg. host has closed.
         '''
         try:
+            if self.writer is not None:  # opened by aopen(), data is buffered by the transport.
+                self.writer.write(data)
+                return len(data)
             return self.sock.send(data)
         except socket.error :
             print ("socket error,do reconnect.")
@@ -271,56 +602,133 @@ class TCPIP(Communicator):
             print(e)
             raise
 
+    def readinto(self, buffer):
+        '''
+        receive into buffer, eg. a memoryview, without allocating.
+        returns: number of bytes received, 0 if no data arrived within .timeout.
+        raises: socket.error when the host has closed the connection or the socket fails.
+        '''
+        self.recv_calls += 1
+        try:
+            n = self.sock.recv_into(buffer)
+        except socket.timeout:
+            self.timeouts += 1
+            return 0
+        if n == 0:
+            raise socket.error('Can not connect to server[{0}:{1}]'.format(self.host, self.port))#server closed.
+        self.bytes_received += n
+        return n
+
     def read(self,size):
         '''
-        read size bytes via TCPIP. 
-        parameters: size – number of bytes to read.
-        returns: bytes read from the port.
+        read up to size bytes via TCPIP, returns as soon as any data is available.
+        parameters: size – max number of bytes to read.
+        returns: bytes read from the port, empty if no data arrived within .timeout.
         return type: bytes
         '''
-        try:
-            flag = True
-            to_read, to_write, in_error = select.select([self.sock], [self.sock], [], 0.001) 
-            if self.sock not in to_read: 
-                flag = False
-
-            data = self.sock.recv(size)
-            if not flag and len(data) == 0:
-                raise socket.error ('Can not connect to server[{0}:{1}]'.format(self.host, self.port))#server closed.
-            else:
-                return data
-        except socket.error as e:
-            print(e)
-            print ("socket error,do reconnect.")
-            raise
-        except Exception as e:
-            print(e)
-            raise
-        except :
-            raise
+        view = self.view if size >= len(self.buffer) else self.view[:size]
+        n = self.readinto(view)
+        return bytes(view[:n])  # the only copy, blocks are queued while the buffer is reused.
+
+    def read_some(self,size):
+        return self.read(size)
+
+    def stats(self):
+        '''
+        returns: dict of receive and connection counters.
+        '''
+        return {
+            'bytes_received': self.bytes_received,
+            'recv_calls': self.recv_calls,
+            'bytes_per_call': self.bytes_received / float(self.recv_calls) if self.recv_calls else 0.0,
+            'timeouts': self.timeouts,
+            'connects': self.connects,
+            'reconnects': self.reconnects,
+            'connect_failures': self.connect_failures,
+            }
+
+    def fileno(self):
+        return self.sock.fileno() if self.sock else None
 
     def open(self):
         if self.sock:
             return True
 
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
-            self.sock.connect((self.host, self.port))
-            return True
-        except socket.error :
-            self.sock = None
-            raise
-        except socket.timeout as e:
-            print(e)
-        except Exception as e:
-            self.sock = None
+            if self.rcvbuf:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)  # before connect, so the window scale fits.
+            if self.sndbuf:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.settimeout(TCP_CONNECT_TIMEOUT)
+            sock.connect((self.host, self.port))
+            sock.settimeout(self.timeout)
+        except Exception:
+            sock.close()
+            self.connect_failures += 1
+            self.backoff.next_delay()
             raise
+        self.sock = sock
+        self.connected()
+        return True
+
+    def connected(self):
+        if self.connects:
+            self.reconnects += 1
+        self.connects += 1
+        self.backoff.reset()
 
     def close(self):
+        if self.writer:
+            self.writer.close()
+            self.reader = None
+            self.writer = None
         if self.sock:
             self.sock.close()
             self.sock = None
 
+    async def aopen(self):
+        if self.writer:
+            return True
+        try:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port, limit=self.read_size)
+        except Exception:
+            self.connect_failures += 1
+            self.backoff.next_delay()
+            raise
+        sock = self.writer.get_extra_info('socket')
+        if sock is not None and self.rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        self.connected()
+        return True
+
+    async def aclose(self):
+        writer = self.writer
+        self.close()
+        if writer:
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def awrite(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+        return len(data)
+
+    async def aread(self, size):
+        '''
+        read at least 1 and at most size bytes from host.
+        raises socket.error when host has closed the connection.
+        '''
+        self.recv_calls += 1
+        data = await self.reader.read(size)
+        if not data:
+            raise socket.error('Can not connect to server[{0}:{1}]'.format(self.host, self.port))
+        self.bytes_received += len(data)
+        return data
+
 class DataFile(Communicator):
     def __init__(self, file_name):
         Communicator.__init__(self)
@@ -362,3 +770,9 @@ class DataFile(Communicator):
         if self.file:
             self.file.close()
             self.file = None
+
+    async def aread(self, size):
+        '''
+        read up to size bytes in a worker thread, returns empty bytes at the end of file.
+        '''
+        return await asyncio.get_running_loop().run_in_executor(None, self.read, size)
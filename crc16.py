@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*
+"""
+CRC-16 (CCITT, polynomial 0x1021, init 0x1D0F) of 'UU' frames per 380 manual.
+Single frames use the table driven CRC of binascii,
+many frames of a .bin capture can be checked at once with NumPy.
+"""
+
+import binascii
+import numpy as np
+
+CRC_INIT = 0x1D0F
+CRC_POLY = 0x1021
+
+PACKET_TYPE_IDX = 2
+
+
+def make_table(poly=CRC_POLY):
+    '''
+    Build the 256-entry lookup table: CRC of each possible high byte.
+    '''
+    table = []
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = (crc << 1) ^ poly
+            else:
+                crc = crc << 1
+        table.append(crc & 0xffff)
+    return table
+
+CRC_TABLE = make_table()
+_NP_CRC_TABLE = np.array(CRC_TABLE, dtype=np.uint16)
+
+
+def crc16(data, crc=CRC_INIT):
+    '''
+    Calculates CRC of data.
+    parameters: data – bytes, bytearray or memoryview. Slice a memoryview to avoid copies.
+    returns: crc in [0, 0xffff].
+    '''
+    return binascii.crc_hqx(data, crc)
+
+
+def check_frame(frame):
+    '''
+    Check CRC of a whole frame: 'UU' + packet type + payload len + payload + crc(big endian).
+    returns: True if CRC is correct.
+    '''
+    view = memoryview(frame)
+    return binascii.crc_hqx(view[PACKET_TYPE_IDX:-2], CRC_INIT) == (frame[-2] << 8 | frame[-1])
+
+
+def crc16_batch(data, offsets, length, crc=CRC_INIT):
+    '''
+    Calculates CRC of many blocks with the same length at once.
+    parameters:
+        data – 1-D uint8 array, eg. numpy.memmap of a .bin capture.
+        offsets – start index of each block in data.
+        length – len of each block.
+    returns: uint16 array, CRC of each block.
+    '''
+    offsets = np.asarray(offsets, dtype=np.int64)
+    crc = np.full(len(offsets), crc, dtype=np.uint16)
+    for i in range(length):
+        idx = (crc >> 8) ^ data[offsets + i]
+        crc = (crc << 8) ^ _NP_CRC_TABLE[idx]
+    return crc
+
+
+def check_frames_batch(data, offsets, payload_len):
+    '''
+    Check CRC of many frames with the same payload len at once.
+    parameters:
+        data – 1-D uint8 array.
+        offsets – index of header 'UU' of each frame.
+        payload_len – payload len of these frames.
+    returns: bool array, True if CRC of the frame is correct.
+    '''
+    offsets = np.asarray(offsets, dtype=np.int64)
+    crc = crc16_batch(data, offsets + PACKET_TYPE_IDX, 2 + 1 + payload_len)  # 2: package type; 1: payload len.
+    crc_idx = offsets + 5 + payload_len
+    packet_crc = (data[crc_idx].astype(np.uint16) << 8) | data[crc_idx + 1]
+    return crc == packet_crc
@@ -0,0 +1,453 @@
+# -*- coding: utf-8 -*
+"""
+Buffered writers of log files.
+Rows are grouped in memory and written with one write + flush when the buffered
+bytes exceed flush_bytes or flush_interval seconds passed since the last flush.
+RotatingSink also splits long logs into compressed segments, see open_sink().
+SinkRouter keeps one lazily opened sink per key, eg. (port, packet type), and closes idle ones.
+"""
+
+import os
+import gzip
+import lzma
+import json
+import time
+import queue
+import atexit
+import weakref
+import datetime
+import threading
+
+FLUSH_BYTES = 64*1024  # flush when buffered bytes exceed it.
+FLUSH_INTERVAL = 1.0   # seconds, max time rows stay in memory while data keeps coming.
+ROTATE_BYTES = 100*1024*1024  # start a new segment when the uncompressed bytes of a segment exceed it.
+ROTATE_SECONDS = 3600  # or when the segment is older than it, 0: no time limit.
+COMPRESSIONS = {None: (open, ''), 'gzip': (gzip.open, '.gz'), 'lzma': (lzma.open, '.xz')}
+OPEN_SINKS = weakref.WeakSet()  # RotatingSinks to close at exit, so queued blocks are not lost.
+IDLE_TIMEOUT = 60.0  # seconds without new rows before SinkRouter closes a sink.
+IDLE_CHECK_INTERVAL = 1.0  # seconds between idle checks of SinkRouter.
+ROTATION = None  # default rotation of loggers, eg. {'max_bytes': ROTATE_BYTES, 'max_seconds': ROTATE_SECONDS, 'compression': 'gzip'}
+
+
+def open_sink(file_name, mode='w', flush_bytes=FLUSH_BYTES, flush_interval=FLUSH_INTERVAL, rotation=None):
+    '''
+    rotation: None for one plain file, or a dict of RotatingSink arguments, eg. {'max_bytes': 64*1024*1024, 'compression': 'lzma'}.
+    returns: BufferedSink or RotatingSink.
+    '''
+    if rotation is None:
+        return BufferedSink(file_name, mode, flush_bytes, flush_interval)
+    return RotatingSink(file_name, mode, flush_bytes, flush_interval, **rotation)
+
+
+class BufferedSink():
+    '''
+    Group rows into large buffers before writing them to file.
+    Durability window: at most flush_interval seconds or flush_bytes bytes of rows
+    are lost if the process is killed.
+    '''
+    def __init__(self, file_name, mode='w', flush_bytes=FLUSH_BYTES, flush_interval=FLUSH_INTERVAL):
+        self.file_name = file_name
+        self.file = open(file_name, mode)
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.rows = []
+        self.pending_bytes = 0  # bytes waiting in .rows
+        self.last_flush = time.time()
+        # statistics
+        self.written_bytes = 0
+        self.flush_count = 0
+        self.last_flush_duration = 0.0  # seconds
+        self.max_flush_duration = 0.0
+        self.total_flush_duration = 0.0
+
+    def write(self, data):
+        '''
+        buffer one row, flush if the size or time threshold is reached.
+        '''
+        self.rows.append(data)
+        self.pending_bytes += len(data)
+        if self.pending_bytes >= self.flush_bytes or time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def poll(self):
+        '''
+        flush if rows are waiting longer than flush_interval, call it when no data comes.
+        '''
+        if self.rows and time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        start = time.time()
+        if self.rows:
+            self.file.write(self.rows[0][:0].join(self.rows))
+            self.rows = []
+        self.file.flush()
+        end = time.time()
+
+        self.written_bytes += self.pending_bytes
+        self.pending_bytes = 0
+        self.last_flush = end
+        self.flush_count += 1
+        self.last_flush_duration = end - start
+        self.max_flush_duration = max(self.max_flush_duration, self.last_flush_duration)
+        self.total_flush_duration += self.last_flush_duration
+
+    def close(self):
+        if self.file is None:
+            return
+        self.flush()
+        self.file.close()
+        self.file = None
+
+    def stats(self):
+        '''
+        returns: dict of pending bytes and flush durations.
+        '''
+        return {
+            'file': self.file_name,
+            'pending_bytes': self.pending_bytes,
+            'written_bytes': self.written_bytes,
+            'flush_count': self.flush_count,
+            'last_flush_duration': self.last_flush_duration,
+            'max_flush_duration': self.max_flush_duration,
+            'avg_flush_duration': self.total_flush_duration / self.flush_count if self.flush_count else 0.0,
+            }
+
+
+class RotatingSink():
+    '''
+    Split a log into segments by size or age, eg. data/a1.csv -> data/a1.0000.csv.gz, data/a1.0001.csv.gz ...
+    Rows are grouped like BufferedSink and handed to a background thread which compresses and writes
+    them, so the writer never waits on compression or disk.
+    The first row, ie. the header, is repeated at the start of every segment, so each segment can be used alone,
+    unless header is False, eg. for raw bytes.
+    next_segment() rotates on demand, eg. to keep segments of several logs aligned.
+    Closed segments are appended to <name>.manifest.jsonl with their time range (shared by logs whose names
+    differ only in extension), and can be shipped off while logging continues.
+    '''
+    def __init__(self, file_name, mode='w', flush_bytes=FLUSH_BYTES, flush_interval=FLUSH_INTERVAL,
+                 max_bytes=ROTATE_BYTES, max_seconds=ROTATE_SECONDS, compression='gzip', level=None, header=True):
+        if compression not in COMPRESSIONS:
+            raise ValueError('Unknown compression {0}, must be one of {1}.'.format(compression, list(COMPRESSIONS)))
+        self.root, self.ext = os.path.splitext(file_name)
+        self.binary = 'b' in mode
+        self.compression = compression
+        self.level = level
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.manifest_name = self.root + '.manifest.jsonl'
+        self.repeat_header = header
+        self.header = None
+        self.rows = []
+        self.pending_bytes = 0  # bytes waiting in .rows
+        self.last_flush = time.time()
+        self.index = 0  # index of the current segment
+        if 'a' in mode:  # continue after existing segments, eg. a log reopened by SinkRouter.
+            while os.path.exists(self.segment_name(self.index)):
+                self.index += 1
+        self.segment_bytes = 0  # uncompressed bytes of the current segment
+        self.segment_rows = 0  # rows of the current segment except the header
+        self.segment_start = None  # time of the first and the last row of the current segment
+        self.segment_end = None
+        self.file_name = self.segment_name(0)
+        self.lock = threading.Lock()  # rows are flushed by the writer and by the background thread when idle
+        self.blocks = queue.Queue()  # (command, arg) for the background thread
+        # statistics
+        self.written_bytes = 0  # uncompressed bytes handed to the background thread
+        self.compressed_bytes = 0  # bytes of closed segments
+        self.segments = 0  # closed segments
+        self.flush_count = 0
+        self.last_flush_duration = 0.0  # seconds
+        self.max_flush_duration = 0.0
+        self.total_flush_duration = 0.0
+        self.thread = threading.Thread(target=self.writer, name='sink-' + os.path.basename(self.root))
+        self.thread.daemon = True
+        self.thread.start()
+        OPEN_SINKS.add(self)
+
+    def segment_name(self, index):
+        return '{0}.{1:04d}{2}{3}'.format(self.root, index, self.ext, COMPRESSIONS[self.compression][1])
+
+    def write(self, data):
+        '''
+        buffer one row, start a new segment or hand rows to the background thread if a threshold is reached.
+        '''
+        now = time.time()
+        with self.lock:
+            if self.header is None and self.repeat_header:
+                self.header = data
+            elif self.segment_rows and (self.segment_bytes >= self.max_bytes or
+                                        (self.max_seconds and now - self.segment_start >= self.max_seconds)):
+                self.rotate()
+            if self.segment_start is None:
+                self.segment_start = now
+            self.segment_end = now
+            self.rows.append(data)
+            self.pending_bytes += len(data)
+            self.segment_bytes += len(data)
+            if data is not self.header:
+                self.segment_rows += 1
+            if self.pending_bytes >= self.flush_bytes or now - self.last_flush >= self.flush_interval:
+                self.hand_off(now)
+
+    def hand_off(self, now):
+        '''
+        pass buffered rows to the background thread, call it with .lock held.
+        '''
+        if self.rows:
+            start = time.time()
+            self.blocks.put(('data', (self.index, self.rows[0][:0].join(self.rows))))
+            self.rows = []
+            self.written_bytes += self.pending_bytes
+            self.pending_bytes = 0
+            self.flush_count += 1
+            self.last_flush_duration = time.time() - start
+            self.max_flush_duration = max(self.max_flush_duration, self.last_flush_duration)
+            self.total_flush_duration += self.last_flush_duration
+        self.last_flush = now
+
+    def rotate(self):
+        '''
+        close the current segment and start the next one with the header, call it with .lock held.
+        '''
+        self.hand_off(time.time())
+        self.blocks.put(('close', {
+            'segment': os.path.basename(self.segment_name(self.index)),
+            'index': self.index,
+            'start': self.segment_start,
+            'end': self.segment_end,
+            'rows': self.segment_rows,
+            'bytes': self.segment_bytes,
+            }))
+        self.index += 1
+        self.file_name = self.segment_name(self.index)
+        self.segment_bytes = 0
+        self.segment_rows = 0
+        self.segment_start = None
+        self.segment_end = None
+        if self.header is not None:
+            self.rows.append(self.header)
+            self.pending_bytes += len(self.header)
+            self.segment_bytes += len(self.header)
+
+    def next_segment(self):
+        '''
+        close the current segment, even if it is empty, and start the next one.
+        '''
+        with self.lock:
+            self.rotate()
+
+    def poll(self):
+        '''
+        hand off rows waiting longer than flush_interval and rotate an old segment,
+        called by the background thread, so rows are written even when no data comes.
+        '''
+        now = time.time()
+        with self.lock:
+            if self.segment_rows and self.max_seconds and now - self.segment_start >= self.max_seconds:
+                self.rotate()
+            if self.rows and now - self.last_flush >= self.flush_interval:
+                self.hand_off(now)
+
+    def flush(self):
+        '''
+        hand off buffered rows and flush the compressed stream, eg. when shutdown or occur SerialException.
+        '''
+        with self.lock:
+            self.hand_off(time.time())
+            self.blocks.put(('sync', None))
+
+    def close(self):
+        if self.thread is None:
+            return
+        with self.lock:
+            if self.segment_rows or self.index == 0:
+                self.rotate()
+            self.rows = []  # only the header of the next segment is left.
+            self.pending_bytes = 0
+            self.blocks.put(('exit', None))
+        self.thread.join()
+        self.thread = None
+        OPEN_SINKS.discard(self)
+
+    def open_segment(self, index):
+        name = self.segment_name(index)
+        open_func = COMPRESSIONS[self.compression][0]
+        if self.compression is None:
+            return open_func(name, 'wb')
+        if self.level is not None:
+            return open_func(name, 'wb', self.level) if self.compression == 'gzip' else open_func(name, 'wb', preset=self.level)
+        return open_func(name, 'wb')
+
+    def close_segment(self, f, info):
+        f.close()
+        info['compressed_bytes'] = os.path.getsize(self.segment_name(info['index']))
+        info['start_time'] = datetime.datetime.fromtimestamp(info['start']).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3] if info['start'] else None
+        self.compressed_bytes += info['compressed_bytes']
+        self.segments += 1
+        with open(self.manifest_name, 'a') as manifest:
+            manifest.write(json.dumps(info) + '\n')
+
+    def writer(self):
+        '''
+        background thread: compress and write blocks, close segments and update the manifest.
+        '''
+        f = None
+        while True:
+            try:
+                command, arg = self.blocks.get(timeout=self.flush_interval)
+            except queue.Empty:
+                self.poll()
+                continue
+            try:
+                if command == 'data':
+                    index, block = arg
+                    if f is None:
+                        f = self.open_segment(index)
+                    f.write(block if self.binary else block.encode())
+                elif command == 'sync':
+                    if f is not None:
+                        f.flush()
+                elif command == 'close':
+                    if f is not None:
+                        self.close_segment(f, arg)
+                        f = None
+                elif command == 'exit':
+                    if f is not None:
+                        f.close()
+                    return
+            except Exception as e:
+                print('Write {0} error: {1}'.format(self.file_name, e))
+
+    def stats(self):
+        '''
+        returns: dict of pending bytes, flush durations and segments.
+        '''
+        return {
+            'file': self.file_name,
+            'pending_bytes': self.pending_bytes,
+            'written_bytes': self.written_bytes,
+            'flush_count': self.flush_count,
+            'last_flush_duration': self.last_flush_duration,
+            'max_flush_duration': self.max_flush_duration,
+            'avg_flush_duration': self.total_flush_duration / self.flush_count if self.flush_count else 0.0,
+            'queued_blocks': self.blocks.qsize(),
+            'segments': self.segments,
+            'compressed_bytes': self.compressed_bytes,
+            }
+
+
+def close_all():
+    '''
+    close open RotatingSinks, called at exit.
+    '''
+    for sink in list(OPEN_SINKS):
+        sink.close()
+
+
+atexit.register(close_all)
+
+
+class NullSink():
+    '''
+    Discard all rows, used when a kind of output is disabled.
+    '''
+    def __init__(self):
+        self.file_name = None
+        self.pending_bytes = 0
+        self.written_bytes = 0
+
+    def write(self, data):
+        pass
+
+    def poll(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def stats(self):
+        return {'file': None, 'pending_bytes': 0}
+
+
+class SinkRouter():
+    '''
+    One lazily opened sink per key, eg. (port, packet type), so each kind of rows goes to its own log.
+    get(key) is the hot path, a plain dict lookup which returns None until open(key) is called.
+    open_func(key, reopen) returns a new sink, reopen is True if the sink of key was closed before,
+    eg. for idle, and should be appended to.
+    Sinks without new rows for idle_timeout seconds are closed by close_idle().
+    '''
+    def __init__(self, open_func, idle_timeout=IDLE_TIMEOUT):
+        self.open_func = open_func
+        self.idle_timeout = idle_timeout
+        self.sinks = {}
+        self.get = self.sinks.get
+        self.activity = {}  # key -> (written + pending bytes, time.monotonic() when they changed)
+        self.opened = set()  # keys opened at least once
+        self.last_check = time.monotonic()
+        # statistics
+        self.opens = 0
+        self.idle_closes = 0
+
+    def open(self, key):
+        sink = self.sinks.get(key)
+        if sink is None:
+            sink = self.open_func(key, key in self.opened)
+            self.sinks[key] = sink
+            self.opened.add(key)
+            self.activity[key] = (-1, time.monotonic())
+            self.opens += 1
+        return sink
+
+    def close_idle(self):
+        '''
+        close sinks without new rows for idle_timeout seconds, checked at most every IDLE_CHECK_INTERVAL.
+        '''
+        now = time.monotonic()
+        if now - self.last_check < IDLE_CHECK_INTERVAL:
+            return
+        self.last_check = now
+        for key, sink in list(self.sinks.items()):
+            n = sink.written_bytes + sink.pending_bytes
+            last_n, since = self.activity[key]
+            if n != last_n:
+                self.activity[key] = (n, now)
+            elif now - since >= self.idle_timeout:
+                sink.close()
+                del self.sinks[key]
+                del self.activity[key]
+                self.idle_closes += 1
+
+    def poll(self):
+        '''
+        flush rows waiting longer than the flush interval of their sinks and close idle sinks, call it when no data comes.
+        '''
+        for sink in self.sinks.values():
+            sink.poll()
+        self.close_idle()
+
+    def flush(self):
+        for sink in self.sinks.values():
+            sink.flush()
+
+    def close(self):
+        for sink in self.sinks.values():
+            sink.close()
+        self.sinks.clear()
+        self.activity.clear()
+
+    def stats(self):
+        '''
+        returns: dict of open sinks by key, and open/close counters.
+        '''
+        return {
+            'sinks': dict((str(key), sink.stats()) for key, sink in self.sinks.items()),
+            'opens': self.opens,
+            'idle_closes': self.idle_closes,
+            }
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*
+"""
+Generate synthetic 'UU' frames of every packet type in packet_decoder.PACKET_FORMATS.
+Frames carry CRC-correct payloads with plausible values, and can be corrupted on purpose
+(bad CRC, truncated frames, garbage between frames) to exercise resync paths.
+Used by benchmark.py and replay_server.py.
+"""
+
+import re
+import struct
+import random
+import crc16
+import packet_decoder
+
+DEFAULT_SN = 1808541032
+DEFAULT_VERSION = 'MTLT305D-400 5020-1382-01 19.1.6'
+CORRUPTIONS = ('bad_crc', 'truncated', 'garbage')
+
+
+def build_frame(packet_type, payload):
+    '''
+    returns: 'UU' + packet type + payload len + payload + crc.
+    '''
+    body = packet_type.encode() + bytes([len(payload)]) + payload
+    return b'UU' + body + struct.pack('>H', crc16.crc16(body))
+
+
+def id_frame(sn=DEFAULT_SN, version=DEFAULT_VERSION):
+    '''
+    returns: 'ID' frame which tells IMULogger the sn and version of device.
+    '''
+    return build_frame('ID', struct.pack('>I', sn) + version.encode() + b'\x00')
+
+
+class FrameGenerator():
+    '''
+    Generate frames by a mix of packet types.
+    mix: dict of packet type -> weight, eg. {'a1': 1} or {'A1': 3, 'S1': 1}.
+    rate: frames per second, used for the timestamps of frames().
+    corruption: dict of 'bad_crc'/'truncated'/'garbage' -> probability per frame.
+    '''
+    def __init__(self, mix=None, rate=100.0, corruption=None, seed=0):
+        self.mix = mix if mix else {'a1': 1}
+        for tp in self.mix:
+            if tp not in packet_decoder.PACKET_FORMATS or tp == 'ID':
+                raise ValueError('Unsupported packet type: {0}'.format(tp))
+        self.rate = rate
+        self.corruption = corruption if corruption else {}
+        for kind in self.corruption:
+            if kind not in CORRUPTIONS:
+                raise ValueError('Unknown corruption {0}, must be one of {1}.'.format(kind, CORRUPTIONS))
+        self.random = random.Random(seed)
+        self.types = list(self.mix.keys())
+        self.weights = [self.mix[tp] for tp in self.types]
+        self.index = 0
+        # statistics
+        self.counts = dict((tp, 0) for tp in self.types)  # good frames by packet type
+        self.corrupted = dict((kind, 0) for kind in CORRUPTIONS)
+
+    def values(self, fmt, i):
+        '''
+        returns: list of plausible values for PacketFormat fmt of the i-th frame.
+        '''
+        spec = fmt.struct.format
+        if isinstance(spec, bytes):
+            spec = spec.decode()
+        values = []
+        first_int = True
+        codes = ''.join(c * int(n or 1) for n, c in re.findall(r'(\d*)([a-zA-Z?])', spec))
+        for c in codes:
+            if c == 'I':
+                values.append((i * 10) & 0xFFFFFFFF if first_int else self.random.randint(0, 0xFFFF))  # itow in ms
+                first_int = False
+            elif c == 'd':
+                values.append(i * 0.01)
+            elif c == 'f':
+                values.append(self.random.uniform(-10.0, 10.0))
+            elif c == 'h':
+                values.append(self.random.randint(-20000, 20000))
+            elif c == 'H':
+                values.append(i & 0xFFFF)
+            elif c == 'B':
+                values.append(self.random.randint(0, 1))
+            else:
+                raise ValueError('Unsupported format {0} of {1}'.format(c, fmt.packet_type))
+        return values
+
+    def frame(self, packet_type, i):
+        '''
+        returns: a valid frame of packet_type.
+        '''
+        fmt = packet_decoder.PACKET_FORMATS[packet_type]
+        return build_frame(packet_type, fmt.struct.pack(*self.values(fmt, i)))
+
+    def corrupt(self, frame):
+        '''
+        returns: frame after corruption picked by .corruption, and the kind of corruption or None.
+        '''
+        for kind in CORRUPTIONS:
+            p = self.corruption.get(kind, 0)
+            if p <= 0 or self.random.random() >= p:
+                continue
+            self.corrupted[kind] += 1
+            if kind == 'bad_crc':
+                return frame[:-1] + bytes([frame[-1] ^ 0xFF]), kind
+            if kind == 'truncated':
+                return frame[:self.random.randint(3, len(frame) - 1)], kind
+            garbage = bytes(self.random.getrandbits(8) for _ in range(self.random.randint(1, 32)))
+            return garbage + frame, kind
+        return frame, None
+
+    def next_frame(self):
+        '''
+        returns: (packet type, bytes of next frame, kind of corruption or None)
+        '''
+        tp = self.random.choices(self.types, self.weights)[0] if len(self.types) > 1 else self.types[0]
+        frame, kind = self.corrupt(self.frame(tp, self.index))
+        self.index += 1
+        if kind in (None, 'garbage'):
+            self.counts[tp] += 1
+        return tp, frame, kind
+
+    def frames(self, n):
+        '''
+        iterate n frames as (time in seconds since the first frame, bytes).
+        '''
+        for i in range(n):
+            t = i / self.rate if self.rate else 0.0
+            yield t, self.next_frame()[1]
+
+    def generate(self, n, with_id=True):
+        '''
+        returns: bytes of an 'ID' frame (optional) followed by n frames.
+        '''
+        data = [id_frame()] if with_id else []
+        data.extend(self.next_frame()[1] for _ in range(n))
+        return b''.join(data)
+
+    def expected_frames(self):
+        '''
+        returns: number of good frames generated, excluding 'ID'.
+        '''
+        return sum(self.counts.values())
+
+
+def parse_mix(text):
+    '''
+    'A1:3,S1:1' -> {'A1': 3.0, 'S1': 1.0}
+    '''
+    mix = {}
+    for item in text.split(','):
+        if not item:
+            continue
+        tp, _, weight = item.partition(':')
+        mix[tp] = float(weight) if weight else 1.0
+    return mix
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*
+"""
+Chunk based frame scanner for 'UU' framed IMU packets.
+The receiver hands whole byte blocks to a ChunkBuffer, the parser feeds them
+into a FrameScanner which slices complete frames out of one growing bytearray.
+"""
+
+import time
+import threading
+import collections
+import tempfile
+
+HEADER = b'\x55\x55'
+PACKET_TYPE_IDX = 2
+PAYLOAD_LEN_IDX = 4
+PAYLOAD_IDX = 5
+FRAME_OVERHEAD = 7  # 2: len of header 'UU'; 2: package type 'a1'; 1: payload len; 2:len of checksum.
+MAX_FRAME_LIMIT = 256  # assume max len of frame is smaller than MAX_FRAME_LIMIT.
+MAX_BUFFER_BYTES = 4*1024*1024  # default capacity of ChunkBuffer.
+BUFFER_POLICIES = ('block', 'drop_oldest', 'spill')
+
+
+class ChunkBuffer():
+    '''
+    FIFO of raw byte blocks between thread receiver and thread parser, bounded by max_bytes.
+    Both sides block on a condition instead of polling, wake() releases them on shutdown.
+    When the buffer is full, policy decides what happens to new data:
+        'block': put() waits until the parser catches up.
+        'drop_oldest': the oldest blocks are discarded, the parser resyncs on the next header.
+        'spill': new blocks are appended to a temporary file and read back in order.
+    '''
+    def __init__(self, max_bytes=MAX_BUFFER_BYTES, policy='block', spill_dir=None):
+        if policy not in BUFFER_POLICIES:
+            raise ValueError('Unknown policy {0}, must be one of {1}.'.format(policy, BUFFER_POLICIES))
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.spill_dir = spill_dir
+        self.chunks = collections.deque()
+        self.size = 0  # bytes in .chunks
+        self.spill_file = None
+        self.spill_read_pos = 0
+        self.spill_write_pos = 0
+        self.oldest_ns = 0  # time.monotonic_ns() when the oldest pending block was put.
+        self.get_put_ns = 0  # put time of the oldest block returned by the last get().
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        # statistics
+        self.high_water_bytes = 0
+        self.dropped_bytes = 0
+        self.spilled_bytes = 0
+
+    def full(self, n):
+        return self.size > 0 and self.size + n > self.max_bytes
+
+    def put(self, data, timeout=0):
+        '''
+        push one block of bytes, wait up to timeout seconds (None: forever) while buffer is full and policy is 'block'.
+        returns: False if buffer is still full, caller should retry later.
+        '''
+        n = len(data)
+        with self.lock:
+            if self.size == 0 and not self.spill_pending():
+                self.oldest_ns = time.monotonic_ns()
+            if self.spill_pending() or (self.policy == 'spill' and self.full(n)):
+                self.spill(data)  # keep order, once spilled new blocks go to file until it is read back.
+            else:
+                if self.full(n):
+                    if self.policy == 'block':
+                        if timeout != 0:
+                            self.not_full.wait(timeout)
+                        if self.full(n):
+                            return False
+                    else:  # drop_oldest
+                        while self.full(n):
+                            dropped = self.chunks.popleft()
+                            self.size -= len(dropped)
+                            self.dropped_bytes += len(dropped)
+                self.chunks.append(data)
+                self.size += n
+                if self.size > self.high_water_bytes:
+                    self.high_water_bytes = self.size
+            self.not_empty.notify()
+            return True
+
+    def spill(self, data):
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile(prefix='imu_spill_', dir=self.spill_dir)
+        self.spill_file.seek(self.spill_write_pos)
+        self.spill_file.write(data)
+        self.spill_write_pos += len(data)
+        self.spilled_bytes += len(data)
+
+    def spill_pending(self):
+        '''
+        returns: bytes in spill file which have not been read back.
+        '''
+        return self.spill_write_pos - self.spill_read_pos
+
+    def read_spill(self):
+        self.spill_file.flush()
+        self.spill_file.seek(self.spill_read_pos)
+        data = self.spill_file.read(min(self.spill_pending(), self.max_bytes))
+        self.spill_read_pos += len(data)
+        if self.spill_pending() == 0:  # all read back, reuse file from the beginning.
+            self.spill_file.truncate(0)
+            self.spill_read_pos = 0
+            self.spill_write_pos = 0
+        return data
+
+    def get(self, timeout=0):
+        '''
+        pop all pending blocks, wait up to timeout seconds (None: forever) while buffer is empty.
+        returns: bytes, empty when there is no pending data.
+        '''
+        with self.lock:
+            if not self.chunks and not self.spill_pending() and timeout != 0:
+                self.not_empty.wait(timeout)
+            if self.chunks:
+                if len(self.chunks) == 1:
+                    data = self.chunks.popleft()
+                else:
+                    data = b''.join(self.chunks)
+                    self.chunks.clear()
+                self.size = 0
+            elif self.spill_pending():
+                data = self.read_spill()
+            else:
+                return b''
+            self.get_put_ns = self.oldest_ns
+            if self.spill_pending():
+                self.oldest_ns = time.monotonic_ns()  # blocks left in spill file, put times are not kept.
+            self.not_full.notify()
+            return data
+
+    def wake(self):
+        '''
+        release threads waiting in put() or get(), eg. when shutdown.
+        '''
+        with self.lock:
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+
+    def empty(self):
+        return len(self.chunks) == 0 and self.spill_pending() == 0
+
+    def clear(self):
+        with self.lock:
+            self.chunks.clear()
+            self.size = 0
+            if self.spill_file is not None:
+                self.spill_file.close()
+                self.spill_file = None
+            self.spill_read_pos = 0
+            self.spill_write_pos = 0
+            self.not_full.notify_all()
+
+    def stats(self):
+        '''
+        returns: dict of buffered bytes and overflow counters.
+        '''
+        return {
+            'policy': self.policy,
+            'max_bytes': self.max_bytes,
+            'buffered_bytes': self.size,
+            'high_water_bytes': self.high_water_bytes,
+            'dropped_bytes': self.dropped_bytes,
+            'spilled_bytes': self.spilled_bytes,
+            'spill_pending_bytes': self.spill_pending(),
+            }
+
+
+class FrameScanner():
+    '''
+    Find header 'UU' in a growing bytearray and slice out complete frames by the payload length byte.
+    A frame is: 'UU' + packet type(2 bytes) + payload len(1 byte) + payload + crc(2 bytes, big endian).
+    payload_lengths: optional dict of packet type (bytes) -> payload len, eg. packet_decoder.PAYLOAD_LENGTHS,
+                     a header followed by a known type with another len is skipped at once.
+    '''
+    def __init__(self, header=HEADER, payload_lengths=None):
+        self.header = header
+        # keyed by the packet type as big endian uint16, cheaper than slicing bytes of every frame.
+        self.payload_lengths = dict(((k[0] << 8) | k[1], n) for k, n in payload_lengths.items()) if payload_lengths else None
+        self.buf = bytearray()
+        self.pos = 0  # start of unparsed data in .buf
+        self.base = 0  # offset of .buf[0] in the whole received stream
+        self.frame_start = 0  # offset of the last returned frame in the whole received stream
+        # statistics, kept by reset()
+        self.resyncs = 0  # times bytes were skipped to find a header
+        self.skipped_bytes = 0
+        self.skipping = False
+        self.rejected = 0  # frames rejected by reject(), eg. CRC errors
+        self.bad_lengths = 0  # headers skipped for an impossible payload len
+
+    def feed(self, data):
+        '''append received bytes.
+        '''
+        if self.pos:
+            del self.buf[:self.pos]  # drop consumed bytes once per block, not once per frame.
+            self.base += self.pos
+            self.pos = 0
+        self.buf += data
+
+    def reset(self):
+        self.base += len(self.buf)  # dropped bytes still count in stream offsets.
+        self.buf = bytearray()
+        self.pos = 0
+        self.skipping = False
+
+    def skip(self, n):
+        self.skipped_bytes += n
+        if not self.skipping:
+            self.skipping = True
+            self.resyncs += 1
+
+    def next_frame(self):
+        '''
+        returns: next complete candidate frame as bytes (crc is NOT checked),
+                 None if more data is required.
+        '''
+        buf = self.buf
+        while True:
+            start = buf.find(self.header, self.pos)
+            if start < 0:
+                # keep the last byte, it may be the first half of header.
+                if len(buf) - 1 > self.pos:
+                    self.skip(len(buf) - 1 - self.pos)
+                    self.pos = len(buf) - 1
+                return None
+            if start > self.pos:
+                self.skip(start - self.pos)
+
+            if len(buf) < start + PAYLOAD_IDX:
+                self.pos = start
+                return None
+
+            frame_len = buf[start + PAYLOAD_LEN_IDX] + FRAME_OVERHEAD
+            if self.payload_lengths is not None:
+                expected = self.payload_lengths.get((buf[start + PACKET_TYPE_IDX] << 8) | buf[start + PACKET_TYPE_IDX + 1])
+                if expected is not None and expected + FRAME_OVERHEAD != frame_len:
+                    frame_len = MAX_FRAME_LIMIT + 1
+                    self.bad_lengths += 1
+            if frame_len > MAX_FRAME_LIMIT:
+                self.skip(1)
+                self.pos = start + 1  # invalid length, search next header, it may start at the 2nd byte of 'UUU'.
+                continue
+
+            end = start + frame_len
+            if len(buf) < end:
+                self.pos = start
+                return None
+
+            self.pos = end
+            self.skipping = False
+            self.frame_start = self.base + start
+            return bytes(buf[start:end])
+
+    def reject(self):
+        '''
+        the last returned frame is bad, eg. wrong CRC. Search the next header inside its bytes
+        instead of after them, so a good frame overlapped by a corrupted or truncated one is not lost.
+        Call it before the next call of next_frame() or feed().
+        '''
+        self.rejected += 1
+        self.pos = self.frame_start - self.base + 1
+        self.skip(1)
+
+    def frames(self):
+        '''iterate all complete frames in buffer.
+        '''
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
@@ -10,39 +10,62 @@ import os
 import threading
 import datetime
 import time
-import operator
-import struct
 import glob
 import math
 import json
-import collections
 import serial
 import serial.tools.list_ports
-if sys.version_info[0] > 2:
-    from queue import Queue
-else:
-    from Queue import Queue
 import communicator
+import frame_scanner
+import crc16
+import packet_decoder
+import data_sink
+import raw_tee
+import binary_log
+import pc_clock
+import app_dispatcher
+import metrics
 
 D2R = 0.017453292519943
 R2D = 57.29577951308232
 GRAVITY = 9.80665
+ERROR_REPORT_INTERVAL = 5 * 1000000000  # ns, CRC errors are counted and printed at most once per interval.
+BATCH_MIN_FRAMES = 8  # fixed-point frames of a chunk are decoded by NumPy in one block from this many on.
+BATCH_MAX_FRAMES = 1024
 
 class IMULogger:
+    IDLE_WAIT = 0.1  # seconds to wait when there is no data, eg. end of data file.
+
     def __init__(self):
         ''' initialization
         '''
         # self.cmt = communicator.SerialPort()
         self.cmt = None
         self.threads = []  # thread of receiver and paser
-        self.exit_thread = False  # flag of exit threads
-        self.exit_lock = threading.Lock()  # lock of exit_thread
-        self.data_queue = Queue()  # data container
-        self.data_lock = threading.Lock()  # lock of data_queue
+        self.exit_event = threading.Event()  # set to notice threads to exit
+        self.data_queue = frame_scanner.ChunkBuffer()  # received byte blocks, bounded by bytes, see set_ingest_buffer()
+        self.frame_scanner = frame_scanner.FrameScanner(payload_lengths=packet_decoder.PAYLOAD_LENGTHS)  # split byte blocks into frames
+        self.last_error_report = 0  # monotonic ns of the last print of CRC errors
+        self.reported_errors = 0  # CRC errors in the last print
+        self.pc_clock = pc_clock.PCClock()  # PC timestamp of the chunk being parsed
+        self.metrics = None  # metrics.IMUMetrics, registered when the first data arrives.
+        self.metrics_registry = metrics.REGISTRY  # loggers with the same port name share metrics in one registry.
+        self.scanner_counts = (0, 0, 0)  # resyncs, skipped bytes and bad lengths of frame_scanner added to metrics
+        self.unwritten = {}  # sink -> [its flush_count, monotonic ns when its oldest buffered row was received]
         self.apps = []
-        self.first_line = True
+        self.channels = []  # app_dispatcher.AppChannel of apps
         self.packet_type = None
-        self.data_file = None
+        self.data_files = data_sink.SinkRouter(self.open_csv)  # (port, packet type) -> CSV sink
+        self.batches = {}  # packet_decoder.PacketFormat -> frames of fixed-point packets waiting for flush_batches()
+        self.flush_bytes = data_sink.FLUSH_BYTES  # flush data_files when buffered rows exceed it.
+        self.flush_interval = data_sink.FLUSH_INTERVAL  # or when rows are buffered longer than it, in seconds.
+        self.rotation = data_sink.ROTATION  # None: one file per packet type, see set_rotation().
+        self.output_mode = 'csv'  # 'csv', 'bin' or 'both'
+        self.binary_logs = {}  # (port, packet type) -> binary_log.BinaryLogWriter, same keys as .data_files
+        self.tee_raw = True  # write received bytes of live sessions to data/raw_*.bin with a frame index, see raw_tee.py
+        self.raw_tee = None
+        self.raw_tee_base = 0  # stream offset of frame_scanner at offset 0 of the raw tee file or segment
+        self.raw_tee_files = set()  # raw tee files opened before, continued when the device reconnects.
         self.log_file = None
         self.lines = 0
         self.b_send_reset_cmd = False
@@ -51,9 +74,18 @@ class IMULogger:
         self.version = None
         self.odr = 0
         self.start_time = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        self.packet_handlers = {
+            'ID': self.handle_packet_ID,
+            'PK': self.handle_packet_PK,
+            'SR': self.handle_packet_RST,
+            'AR': self.handle_packet_RST,
+            }  # packet type -> handler
+        for tp in packet_decoder.PACKET_FORMATS:  # data packets are logged by their schema.
+            self.packet_handlers.setdefault(tp, self.handle_packet)
+        self.binary_packet_types = set(k for k in packet_decoder.PACKET_FORMATS if k != 'ID')
         print('IMU driver start at:{0}'.format(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
         # # create log file.
-        # self.port = self.cmt.port.split(os.sep)[-1] # /dev/cu.usbserial-143200
+        # self.port = self.get_port_name() # /dev/cu.usbserial-143200
         # file_dir = os.path.join('data', self.start_time+'_' + self.port + '.log')
         # self.log_file = open(file_dir, 'w')
 
@@ -62,138 +94,280 @@ class IMULogger:
         '''
         # DO NOT send reset cmmond when re-init logger.
         self.cmt.close()
-        self.data_lock.acquire()
-        while not self.data_queue.empty():
-            self.data_queue.get()
-        self.data_lock.release()
-        self.exit_thread = False
+        self.flush_data_file()
+        self.close_raw_tee()
+        self.data_queue.clear()
+        self.frame_scanner.reset()
+        self.port = None  # the device may come back on another port, its rows go to new logs.
+        self.exit_event.clear()
         self.threads = []  # clear threads
         self.odr = 0
 
-    def add_app(self, app):
+    def add_app(self, app, max_records=app_dispatcher.MAX_RECORDS, policy='drop_oldest'):
+        '''
+        app receives records on its own thread, see app_dispatcher.AppChannel for max_records and policy.
+        '''
         if app is not None:
             self.apps.append(app)
+            self.channels.append(app_dispatcher.get_channel(app, max_records, policy))
 
     def clean_apps(self):
         self.apps = []
+        self.channels = []
+
+    def publish_record(self, tm_ms, values, packet_type=None):
+        '''
+        hand decoded values of a frame to the channels of apps, packet_type: default the type of current frame.
+        '''
+        packet_type = packet_type or self.packet_type
+        record = app_dispatcher.Record(self.sn, self.version, packet_type, tm_ms, values,
+                                       app_dispatcher.field_index(packet_type))
+        for channel in self.channels:
+            channel.publish(record)
 
     def receiver(self):
         ''' receive IMU data and push data into data_queue.
             return when occur Exception
         '''
-        while True:
-            self.exit_lock.acquire()
-            if self.exit_thread:
-                self.exit_lock.release()
-                self.cmt.close()
-                return
-            self.exit_lock.release()
-
+        while not self.exit_event.is_set():
             try:
-                data = bytearray(self.cmt.read(self.cmt.read_size))
+                data = self.cmt.read_some(self.cmt.read_size)  # block until data arrives or read timeout.
             except Exception as e:
-                self.exit_lock.acquire()
-                self.exit_thread = True  # Notice thread paser to exit.
-                self.exit_lock.release()
+                self.stop()  # Notice thread paser to exit.
                 return  # exit thread receiver
 
             if len(data):
                 # print(datetime.datetime.now().strftime('%Y_%m_%d_%H_%M_%S:') + ' '.join('0X{0:x}'.format(data[i]) for i in range(len(data))))
-                self.data_lock.acquire()
-                for d in data:
-                    self.data_queue.put(d)
-                self.data_lock.release()
+                while not self.data_queue.put(data, self.IDLE_WAIT):  # parser falls behind, wait until it catches up.
+                    if self.exit_event.is_set():
+                        break
             else:
-                time.sleep(0.001)
+                self.exit_event.wait(self.IDLE_WAIT)  # eg. end of data file.
+
+        self.cmt.close()
 
     def parser(self):
         ''' get IMU data from data_queue and parse data into one whole frame.
             return when occur Exception in thread receiver.
         '''
-        HEADER = [0X55, 0X55]
-        PACKAGE_TYPE_IDX = 2
-        PAYLOAD_LEN_IDX = 4
-        MAX_FRAME_LIMIT = 256  # assume max len of frame is smaller than MAX_FRAME_LIMIT.
+        while not self.exit_event.is_set():
+            data = self.data_queue.get(self.flush_interval)  # wake up as soon as data arrives.
+            if not data:
+                self.poll_data_files()
+                continue
 
-        sync_pattern = collections.deque(2*[0], 2)
-        find_header = False
-        frame = []
-        payload_len = 0
+            self.process_data(data, self.data_queue.get_put_ns)
+
+        self.flush_data_file()
+        self.close_raw_tee()
+
+    def process_data(self, data, read_ns = None):
+        ''' split received bytes into frames, check and parse each whole frame.
+            read_ns: time.monotonic_ns() when data was received, default now.
+        '''
+        self.pc_clock.sample()  # all frames of a chunk share one PC timestamp.
+        counters = self.metrics if self.metrics is not None else self.init_metrics()
+        counters.bytes.value += len(data)
+        if self.raw_tee is None and self.tee_raw and not isinstance(self.cmt, communicator.DataFile):
+            self.open_raw_tee()
+        tee = self.raw_tee
+        if tee is not None:
+            if tee.rotation_due():  # the unparsed tail is repeated in the next segment, so no frame is cut.
+                scanner = self.frame_scanner
+                tee.next_segment(bytes(scanner.buf[scanner.pos:]))
+                self.raw_tee_base = scanner.base + scanner.pos
+            tee.write(data)
+        self.frame_scanner.feed(data)
+        for frame in self.frame_scanner.frames():
+            # checksum
+            if crc16.check_frame(frame):
+                if tee is not None:
+                    tee.add_frame(self.frame_scanner.frame_start - self.raw_tee_base, frame, self.pc_clock.now_ns)
+                # find a whole frame
+                self.parse_frame(frame)
+                self.odr += 1
+
+                # query sn if .cmt is not 'communicator.DataFile'
+                if self.sn is None and not isinstance(self.cmt, communicator.DataFile):
+                    self.send_packet_GP() # send 'GP' command if hasn't got sn info.
+
+                # # Reset IMU to start logging from 1st packet.
+                # 1. For MTLT, it just repond SR msg, but not reset indeed, so user should as fllows to log from 1st packet:
+                #   a. run imu_logger.py and recognize serial port at first.
+                #   b. power on MTLT.
+                # 2. For other devices, they can respond SR and actually reset, so, no matter run imu_logger.py or power on device firstly, user can get and log from the 1st packet.
+                if self.b_send_reset_cmd: 
+                    self.send_packet_reset() # just send reset command once.
 
-        while True:
-            self.exit_lock.acquire()
-            if self.exit_thread:
-                self.exit_lock.release()
-                return  # exit thread parser
-            self.exit_lock.release()
-
-            self.data_lock.acquire()
-            if self.data_queue.empty():
-                self.data_lock.release()
-                time.sleep(0.001)
-                continue
             else:
-                data = self.data_queue.get()
-                self.data_lock.release()
-                # print(datetime.datetime.now().strftime('%Y_%m_%d_%H_%M_%S:') + hex(data))
-
-                if find_header:
-                    frame.append(data)
-                    if PAYLOAD_LEN_IDX + 1 == len(frame):
-                        payload_len = frame[PAYLOAD_LEN_IDX]
-                    elif 2 + 2 + 1 + payload_len + 2 == len(frame):  # 2: len of header 'UU'; 2: package type 'a1'; 1: payload len; 2:len of checksum.
-                        find_header = False
-                        # checksum
-                        packet_crc = 256 * frame[-2] + frame[-1]
-                        if packet_crc == self.calc_crc(frame[PACKAGE_TYPE_IDX : -2]):
-                            # find a whole frame
-                            self.parse_frame(frame)
-                            self.odr += 1
-
-                            # query sn if .cmt is not 'communicator.DataFile'
-                            if self.sn is None and not isinstance(self.cmt, communicator.DataFile):
-                                self.send_packet_GP() # send 'GP' command if hasn't got sn info.
-
-                            # # Reset IMU to start logging from 1st packet.
-                            # 1. For MTLT, it just repond SR msg, but not reset indeed, so user should as fllows to log from 1st packet:
-                            #   a. run imu_logger.py and recognize serial port at first.
-                            #   b. power on MTLT.
-                            # 2. For other devices, they can respond SR and actually reset, so, no matter run imu_logger.py or power on device firstly, user can get and log from the 1st packet.
-                            if self.b_send_reset_cmd: 
-                                self.send_packet_reset() # just send reset command once.
-
-                        else:
-                            print("CRC error!")
-                            sentence = "CRC error!"
-                            threading.Thread(target=play_sound, args=(sentence,)).start()
-                            error_data = ' '.join(["%02X" % x for x in frame]).strip()
-                            # cerror_datamd = [hex(d) for d in frame]
-                            print(error_data)
-
-                    else:
-                        pass
-
-                    if payload_len > MAX_FRAME_LIMIT or len(frame) > MAX_FRAME_LIMIT:
-                        find_header = False
-                        payload_len = 0
-
-                else:  # if hasn't found header 'UU'
-                    sync_pattern.append(data)
-                    if operator.eq(list(sync_pattern), HEADER):
-                        frame = HEADER[:]
-                        find_header = True
-                        sync_pattern.append(0)
-                    else:
-                        pass
+                counters.crc_errors.value += 1
+                self.frame_scanner.reject()  # a good frame may start inside the rejected bytes.
+        if self.batches:
+            self.flush_batches()
+        self.data_files.close_idle()
+
+        scanner = self.frame_scanner
+        counts = (scanner.resyncs, scanner.skipped_bytes, scanner.bad_lengths)
+        if counts != self.scanner_counts:  # add, counters may be shared with other loggers of the port.
+            counters.resyncs.value += counts[0] - self.scanner_counts[0]
+            counters.skipped_bytes.value += counts[1] - self.scanner_counts[1]
+            counters.bad_lengths.value += counts[2] - self.scanner_counts[2]
+            self.scanner_counts = counts
+        if scanner.rejected != self.reported_errors and self.pc_clock.mono_ns - self.last_error_report >= ERROR_REPORT_INTERVAL:
+            self.report_errors()
+        self.observe_latency(read_ns or self.pc_clock.mono_ns)
+
+    def observe_latency(self, read_ns=None):
+        '''
+        observe read-to-write latency: when a sink writes its buffered rows, the time since the oldest of them was received.
+        read_ns: monotonic ns when the rows just handed to sinks were received, None when only flushing.
+        '''
+        if self.metrics is None:
+            return
+        now = time.monotonic_ns()
+        sinks = list(self.data_files.sinks.values())
+        sinks.extend(writer.sink for writer in self.binary_logs.values())
+        for sink in sinks:
+            state = self.unwritten.get(sink)
+            if state is not None and sink.flush_count != state[0]:
+                self.metrics.latency.observe((now - state[1]) / 1e9)
+                state = None
+            if sink.pending_bytes and read_ns is not None:
+                if state is None:
+                    self.unwritten[sink] = [sink.flush_count, read_ns]
+            elif state is None:
+                self.unwritten.pop(sink, None)
+        if len(self.unwritten) > len(sinks):  # sinks closed for idle wrote their rows.
+            for sink in [s for s in self.unwritten if s not in sinks]:
+                self.metrics.latency.observe((now - self.unwritten.pop(sink)[1]) / 1e9)
+
+    def report_errors(self):
+        '''
+        print counters of bad data, at most once per ERROR_REPORT_INTERVAL instead of once per error.
+        '''
+        self.last_error_report = self.pc_clock.mono_ns
+        self.reported_errors = self.frame_scanner.rejected
+        print('[{0}]: {1}, CRC errors: {2}, bad lengths: {3}, skipped bytes: {4}'.format(
+            self.pc_clock.tm_ms(), self.get_port_name(), self.frame_scanner.rejected,
+            self.frame_scanner.bad_lengths, self.frame_scanner.skipped_bytes))
+        sys.stdout.flush()
+
+    def open_raw_tee(self):
+        '''
+        open data/raw_<start time>_<port>.bin and its index for received bytes from now on.
+        '''
+        if not os.path.exists('data/'):
+            os.mkdir('data/')
+        file_dir = os.path.join('data', 'raw_' + self.start_time + '_' + self.get_port_name() + '.bin')
+        reopen = file_dir in self.raw_tee_files
+        print('{0} logging:{1}'.format('Resume' if reopen else 'Start', file_dir))
+        self.raw_tee = raw_tee.RawTee(file_dir, raw_tee.RAW_FLUSH_BYTES, self.flush_interval, self.rotation, 'ab' if reopen else 'wb')
+        self.raw_tee_files.add(file_dir)
+        self.raw_tee_base = self.frame_scanner.base + len(self.frame_scanner.buf) - self.raw_tee.offset
+        return self.raw_tee
+
+    def close_raw_tee(self):
+        '''
+        close the raw tee, eg. when the device is disconnected or at shutdown, it is reopened by new data.
+        '''
+        if self.raw_tee is not None:
+            self.raw_tee.close()
+            self.raw_tee = None
+
+    def init_metrics(self):
+        '''
+        register metrics of this logger, labelled with port name.
+        '''
+        self.metrics = metrics.IMUMetrics(self.get_port_name(), lambda: self.data_queue.size, self.metrics_registry)
+        return self.metrics
+
+    def poll_data_files(self):
+        ''' flush buffered rows which wait longer than .flush_interval, call it when no data comes.
+        '''
+        self.data_files.poll()
+        for writer in self.binary_logs.values():
+            writer.poll()
+        if self.raw_tee:
+            self.raw_tee.poll()
+        self.observe_latency()
 
     def write(self,n):
         try:
             self.cmt.write(n)
         except Exception as e:
             print(e)
-            self.exit_lock.acquire()
-            self.exit_thread = True  # Notice thread paser and receiver to exit.
-            self.exit_lock.release()
+            self.stop()  # Notice thread paser and receiver to exit.
+
+    def stop(self):
+        '''
+        notice threads receiver and parser to exit, and wake them up if they are waiting.
+        '''
+        self.exit_event.set()
+        self.data_queue.wake()
+
+    def open_data_file(self, file_dir, mode='w'):
+        '''
+        open a buffered CSV sink, rows are flushed every .flush_interval seconds or .flush_bytes bytes.
+        '''
+        if self.output_mode == 'bin':
+            return data_sink.NullSink()  # rows are only formatted for apps.
+        return data_sink.open_sink(file_dir, mode, self.flush_bytes, self.flush_interval, self.rotation)
+
+    def open_csv(self, key, reopen=False):
+        '''
+        open data/<packet type>_<start time>_<port>.csv of key (port, packet type) for .data_files,
+        a log closed for idle is appended to without another header.
+        '''
+        port, packet_type = key
+        if not os.path.exists('data/'):
+            os.mkdir('data/')
+        file_dir = os.path.join('data', packet_type + '_' + self.start_time + '_' + port + '.csv')
+        print('{0} logging:{1}'.format('Resume' if reopen else 'Start', file_dir))
+        sink = self.open_data_file(file_dir, 'a' if reopen else 'w')
+        if not reopen or self.rotation is not None:  # every new segment starts with the header.
+            sink.write(packet_decoder.PACKET_FORMATS[packet_type].header + '\n')
+        return sink
+
+    def flush_data_file(self):
+        '''
+        write buffered rows to disk, eg. when shutdown or occur SerialException.
+        '''
+        self.data_files.flush()
+        for writer in self.binary_logs.values():
+            writer.flush()
+        if self.raw_tee:
+            self.raw_tee.flush()
+        self.observe_latency()
+
+    def set_output_mode(self, mode = 'csv'):
+        '''
+        'csv': log CSV rows only.
+        'bin': log fixed-width binary records only, see binary_log.py.
+        'both': log both CSV rows and binary records.
+        '''
+        if mode not in ('csv', 'bin', 'both'):
+            raise ValueError('Invalid output mode: {0}'.format(mode))
+        self.output_mode = mode
+
+    def set_rotation(self, max_bytes = data_sink.ROTATE_BYTES, max_seconds = data_sink.ROTATE_SECONDS, compression = 'gzip'):
+        '''
+        split log files into segments of max_bytes or max_seconds, compressed with 'gzip', 'lzma' or None
+        in a background thread, call it before start_collection(). See data_sink.RotatingSink.
+        '''
+        self.rotation = {'max_bytes': max_bytes, 'max_seconds': max_seconds, 'compression': compression}
+
+    def set_ingest_buffer(self, max_bytes = frame_scanner.MAX_BUFFER_BYTES, policy = 'block', spill_dir = None):
+        '''
+        bound received bytes waiting for the parser, call it before start_collection().
+        policy: 'block' the receiver, 'drop_oldest' bytes or 'spill' them to a temporary file in spill_dir.
+        '''
+        self.data_queue = frame_scanner.ChunkBuffer(max_bytes, policy, spill_dir)
+
+    def ingest_stats(self):
+        '''
+        returns: dict of buffered bytes, high-water mark, dropped and spilled bytes of the ingest buffer.
+        '''
+        return self.data_queue.stats()
 
     def set_reset_flag(self, reset = False):
         '''
@@ -207,18 +381,11 @@ class IMULogger:
                      False when receiver and parser threads exit.
         '''
         while True:
-            self.exit_lock.acquire()
-            if self.exit_thread:
-                self.exit_lock.release()
-                return False  # return when receiver and parser threads exit
-            self.exit_lock.release()
-
             try:
-                time.sleep(0.1)
+                if self.exit_event.wait(0.5):
+                    return False  # return when receiver and parser threads exit
             except KeyboardInterrupt:  # response for KeyboardInterrupt such as Ctrl+C
-                self.exit_lock.acquire()
-                self.exit_thread = True  # Notice thread receiver and paser to exit.
-                self.exit_lock.release()
+                self.stop()  # Notice thread receiver and paser to exit.
                 print('User stop this program by KeyboardInterrupt! File:[{0}], Line:[{1}]'.format(__file__, sys._getframe().f_lineno))
                 return True
 
@@ -251,62 +418,50 @@ class IMULogger:
         '''Parses packet payload.
         '''
         PACKET_TYPE_IDX = 2
-        tp = '{0}{1}'.format(chr(frame[PACKET_TYPE_IDX]) ,chr(frame[PACKET_TYPE_IDX+1]))
+        tp = chr(frame[PACKET_TYPE_IDX]) + chr(frame[PACKET_TYPE_IDX+1])
+        if self.metrics is not None:
+            self.metrics.frame(tp)
         if self.packet_type != tp:
             self.packet_type = tp
-            tm_ms = datetime.datetime.now().strftime('%H:%M:%S.%f')[:-3]
+            tm_ms = self.pc_clock.tm_ms()
             print("[{0}]: PACKET TYPE: {1}".format(tm_ms, self.packet_type))
 
-        if self.packet_type == 'ID':
-            self.handle_packet_ID(frame)
-        elif self.packet_type == 'PK':
-            self.handle_packet_PK(frame)
-        elif self.packet_type == 'SR' or \
-            self.packet_type == 'AR':
-            self.handle_packet_RST(frame)
-        elif self.packet_type == 'a1':
-            self.handle_packet_a1(frame)
-        elif self.packet_type == 'a2':
-            self.handle_packet_a2(frame)
-        elif self.packet_type == 'z1':
-            self.handle_packet_z1(frame)
-        elif self.packet_type == 's1':
-            self.handle_packet_s1(frame)
-            pass
-        elif self.packet_type == 'S1':
-            self.handle_packet_S1(frame)
-            pass
-        elif self.packet_type == 's2':
-            pass
-        elif self.packet_type == 'A1': # OpenIMU335-VG
-            self.handle_packet_A1(frame)
-            pass
-        elif self.packet_type == 'A2': # MTLT-305
-            self.handle_packet_A2_and_A3(frame, 'A2')
-            pass
-        elif self.packet_type == 'A3': # MTLT-335D
-            self.handle_packet_A2_and_A3(frame, 'A3')
-            pass
-        elif self.packet_type == 'd1': # Odometer
-            self.handle_packet_d1(frame)
-        elif self.packet_type == 'd2': # Odometer
-            self.handle_packet_d2(frame)
-            pass
+        if self.output_mode != 'csv' and tp in self.binary_packet_types:
+            self.write_binary_log(frame)
+            if self.output_mode == 'bin' and len(self.apps) == 0:
+                self.count_lines(1)  # no need to format CSV rows.
+                return
+
+        handler = self.packet_handlers.get(tp)
+        if handler is not None:
+            handler(frame)
+
+    def write_binary_log(self, frame):
+        '''
+        append raw payload of frame to the binary log of current port and packet type.
+        '''
+        writer = self.binary_logs.get((self.port, self.packet_type))
+        if writer is None:
+            self.port = self.get_port_name() # /dev/cu.usbserial-143200
+            writer = self.binary_logs.get((self.port, self.packet_type))
+        if writer is None:
+            if not os.path.exists('data/'):
+                os.mkdir('data/')
+            file_dir = os.path.join('data', self.packet_type + '_' + self.start_time + '_' + self.port + binary_log.EXTENSION)
+            print('Start logging:{0}'.format(file_dir))
+            writer = binary_log.BinaryLogWriter(file_dir, packet_decoder.PACKET_FORMATS[self.packet_type], self.flush_bytes, self.flush_interval, self.rotation)
+            self.binary_logs[(self.port, self.packet_type)] = writer
+        if len(frame) < packet_decoder.PAYLOAD_IDX + writer.size + 2:
+            print("Decode payload error: {0} payload is too short".format(self.packet_type))
+            return
+        writer.write(frame, self.pc_clock.ns())
 
     def calc_crc(self,payload):
         '''Calculates CRC per 380 manual
         '''
-        crc = 0x1D0F
-        for bytedata in payload:
-           crc = crc^(bytedata << 8) 
-           for i in range(0,8):
-                if crc & 0x8000:
-                    crc = (crc << 1)^0x1021
-                else:
-                    crc = crc << 1
-
-        crc = crc & 0xffff
-        return crc
+        if isinstance(payload, list):
+            payload = bytearray(payload)
+        return crc16.crc16(payload)
 
     def send_packet_reset(self):
         '''
@@ -388,17 +543,11 @@ class IMULogger:
         # self.data_lock.release()
 
         PAYLOAD_IDX = 5
-        PAYLOAD_LEN = frame[4]
-        tm_ms = datetime.datetime.now().strftime('%H:%M:%S.%f')[:-3]
+        fmt = packet_decoder.PACKET_FORMATS['ID']
+        tm_ms = self.pc_clock.tm_ms()
 
-        pack_fmt = '>I{0}s'.format(PAYLOAD_LEN - 4) # PAYLOAD_LEN - sizeof(U4)
-        len_fmt = '{0}B'.format(PAYLOAD_LEN)
-        payload = frame[PAYLOAD_IDX : -2]
-
-        b = struct.pack(len_fmt, *payload)
-        d = struct.unpack(pack_fmt, b)
-        self.sn = d[0]
-        self.version = d[1].decode().replace('\x00','') # delete \x00 
+        self.sn = fmt.unpack(frame)[0]
+        self.version = bytes(frame[PAYLOAD_IDX + fmt.size : -2]).decode().replace('\x00','') # delete \x00 
         str = "[{0}]: {1}, Device info, SN: {2}, Version: {3}".format(tm_ms, self.port, self.sn, self.version)
         print(str)
         sys.stdout.flush()
@@ -407,760 +556,80 @@ class IMULogger:
         # self.log_file.write(str + '\n')
         pass
 
-    def handle_packet_a1(self, frame):
-        '''
-        Parse 'a1' packet.
-            typedef struct {
-                uint32_t itow;          // msec
-                double   dblItow;       // s
-                float    roll;          // deg
-                float    pitch;         // deg
-                float    corrRates[3];  // deg/s
-                float    accels[3];     // "m/s/s"
-                uint8_t  ekfOpMode;
-                uint8_t  accelLinSwitch;
-                uint8_t  turnSwitch;
-            }angle1_payload_t;
-        '''
-        PAYLOAD_IDX = 5
-        PAYLOAD_LEN = frame[4] #47
-        tm_ms = datetime.datetime.now().strftime('%H:%M:%S.%f')[:-3]
-        
-        pack_fmt = '<Id8f3B'
-        len_fmt = '{0}B'.format(PAYLOAD_LEN)
-        payload = frame[PAYLOAD_IDX : -2]
-
-        if self.first_line:
-            self.first_line = False
-            if not os.path.exists('data/'):
-                os.mkdir('data/')
-            self.port = self.cmt.port.split(os.sep)[-1] # /dev/cu.usbserial-143200
-            file_dir = os.path.join('data', self.packet_type+'_' + self.start_time + '_' + self.port + '.csv')
-            print('Start logging:{0}'.format(file_dir))
-            self.data_file = open(file_dir, 'w')
-
-            header = 'pc_tm, itow, dblItow, roll, pitch,       \
-                    gyro_x, gyro_y, gyro_z,             \
-                    acc_x, acc_y, acc_z,                \
-                    ekfOpMode, accelLinSwitch, turnSwitch'.replace(' ', '')
-            self.data_file.write(header + '\n')
-            self.data_file.flush()
-
-        try:
-            b = struct.pack(len_fmt, *payload)
-            d = struct.unpack(pack_fmt, b)
-        except Exception as e:
-            print("Decode payload error: {0}".format(e)) 
-
-        str = '{0},{1:d},{2:f},{3:f},{4:f},         \
-            {5:f},{6:f},{7:f},{8:f},{9:f},{10:f},   \
-            {11:d},{12:d},{13:d}'                   \
-            .format(tm_ms,d[0],d[1],d[2],d[3],      \
-                d[4],d[5],d[6],d[7],d[8],d[9],      \
-                d[10],d[11],d[12]).replace(' ', '')
-
-        self.data_file.write(str + '\n')
-        self.data_file.flush()
-        self.lines += 1
-
-        if len(self.apps) != 0 and self.sn is not None:
-            data = collections.OrderedDict()
-            data['pc_tm']   = tm_ms
-            data['itow']    = int(d[0])
-            data['dblItow'] = float(d[1])
-            data['roll']    = float(d[2])
-            data['pitch']   = float(d[3])
-            data['gyro_x']  = float(d[4])
-            data['gyro_y']  = float(d[5])
-            data['gyro_z']  = float(d[6])
-            data['acc_x']   = float(d[7])
-            data['acc_y']   = float(d[8])
-            data['acc_z']   = float(d[9])
-            data['ekfOpMode'] = int(d[10])
-            data['accelLinSwitch'] = int(d[11])
-            data['turnSwitch'] = int(d[12])
-            msg = {}
-            msg['sn'] = self.sn
-            msg['version'] = self.version
-            msg['type'] = 'a1'
-            msg['data'] = data
-            for app in self.apps:
-                app.on_message(msg)
-
-        if self.lines % 1000 == 0:
-            print("[{0}]:Log counter of {1}: {2}".format(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), self.port, self.lines))
-            sys.stdout.flush()
-
-    def handle_packet_a2(self, frame):
-        '''
-        Parse 'a2' packet.
-        typedef struct {
-            uint32_t itow;
-            double   dblItow;
-            float    roll;
-            float    pitch;
-            float    yaw;
-            float    corrRates[3];
-            float    accels[3];
-        }angle2_payload_t;
-        '''
-        PAYLOAD_IDX = 5
-        PAYLOAD_LEN = frame[4] #48
-        tm_ms = datetime.datetime.now().strftime('%H:%M:%S.%f')[:-3]
-
-        pack_fmt = '<Id9f'
-        len_fmt = '{0}B'.format(PAYLOAD_LEN)
-        payload = frame[PAYLOAD_IDX : -2]
-
-        if self.first_line:
-            self.first_line = False
-            if not os.path.exists('data/'):
-                os.mkdir('data/')
-            self.port = self.cmt.port.split(os.sep)[-1] # /dev/cu.usbserial-143200
-            file_dir = os.path.join('data', self.packet_type+'_' + self.start_time + '_' + self.port + '.csv')
-            print('Start logging:{0}'.format(file_dir))
-            self.data_file = open(file_dir, 'w')
-
-            header = 'pc_tm, itow, dblItow, roll, pitch, yaw      \
-                    gyro_x, gyro_y, gyro_z, acc_x, acc_y, acc_z'.replace(' ', '')
-            self.data_file.write(header + '\n')
-            self.data_file.flush()
-
-        try:
-            b = struct.pack(len_fmt, *payload)
-            d = struct.unpack(pack_fmt, b)
-        except Exception as e:
-            print("Decode payload error: {0}".format(e)) 
-
-        str = '{0},{1:d},{2:f},{3:f},{4:f},         \
-            {5:f},{6:f},{7:f},{8:f},{9:f},{10:f},   \
-            {11:f}'                   \
-            .format(tm_ms,d[0],d[1],d[2],d[3],      \
-                d[4],d[5],d[6],d[7],d[8],d[9],      \
-                d[10]).replace(' ', '')
-
-        self.data_file.write(str + '\n')
-        self.data_file.flush()
-        self.lines += 1
-
-        if len(self.apps) != 0 and self.sn is not None:
-            data = collections.OrderedDict()
-            data['pc_tm']   = tm_ms
-            data['itow']    = int(d[0])
-            data['dblItow'] = float(d[1])
-            data['roll']    = float(d[2])
-            data['pitch']   = float(d[3])
-            data['yaw']     = float(d[4])
-            data['gyro_x']  = float(d[5])
-            data['gyro_y']  = float(d[6])
-            data['gyro_z']  = float(d[7])
-            data['acc_x']   = float(d[8])
-            data['acc_y']   = float(d[9])
-            data['acc_z']   = float(d[10])
-            msg = {}
-            msg['sn'] = self.sn
-            msg['version'] = self.version
-            msg['type'] = 'a2'
-            msg['data'] = data
-            for app in self.apps:
-                app.on_message(msg)
-
-        if self.lines % 1000 == 0:
-            print("[{0}]:Log counter of {1}: {2}".format(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), self.port, self.lines))
-            sys.stdout.flush()
-
-    def handle_packet_z1(self, frame):
-        '''
-        Parse 'z1' packet.
-            typedef struct {
-                uint32_t timer;
-                float    accel_mpss[3];
-                float    rate_dps[3];
-                float    mag_G[3];
-            }data1_payload_t;
-        '''
-        PAYLOAD_IDX = 5
-        PAYLOAD_LEN = frame[4] # 40
-        tm_ms = datetime.datetime.now().strftime('%H:%M:%S.%f')[:-3]
-        
-        pack_fmt = '<I9f'
-        len_fmt = '{0}B'.format(PAYLOAD_LEN)
-        payload = frame[PAYLOAD_IDX : -2]
-
-        if self.first_line:
-            self.first_line = False
-            if not os.path.exists('data/'):
-                os.mkdir('data/')
-            self.port = self.cmt.port.split(os.sep)[-1] # /dev/cu.usbserial-143200     
-            file_dir = os.path.join('data', self.packet_type+'_' + self.start_time + '_' + self.port + '.csv')
-            print('Start logging:{0}'.format(file_dir))
-            self.data_file = open(file_dir, 'w')
-
-            header = 'pc_tm, itow,                             \
-                    accel_mpss_x, accel_mpss_y, accel_mpss_z,  \
-                    rate_dps_x, rate_dps_y, rate_dps_z,        \
-                    mag_G_x, mag_G_y, mag_G_z'.replace(' ', '')
-            self.data_file.write(header + '\n')
-            self.data_file.flush()
-
-        try:
-            b = struct.pack(len_fmt, *payload)
-            d = struct.unpack(pack_fmt, b)
-        except Exception as e:
-            print("Decode payload error: {0}".format(e)) 
-
-        str = '{0},{1:d},{2:f},{3:f},{4:f},         \
-            {5:f},{6:f},{7:f},{8:f},{9:f},{10:f}'   \
-            .format(tm_ms,d[0],d[1],d[2],d[3],      \
-                d[4],d[5],d[6],d[7],d[8],d[9]).replace(' ', '')
-
-        self.data_file.write(str + '\n')
-        self.data_file.flush()
-        self.lines += 1
-
-        if self.lines % 1000 == 0:
-            print("[{0}]:Log counter of {1}: {2}".format(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), self.port, self.lines))
-            sys.stdout.flush()
-
-    def handle_packet_A1(self, frame):
-        '''
-        Parse 'A1' packet.
-        Please refer to page 67 of DMUX80ZA manual for A1 packet format.
-        '''
-        PAYLOAD_IDX = 5
-        PAYLOAD_LEN = frame[4] # 0X20
-        tm_ms = datetime.datetime.now().strftime('%H:%M:%S.%f')[:-3]
-
-        pack_fmt = '>13hIH' # Note: Big Endian!
-        len_fmt = '{0}B'.format(PAYLOAD_LEN)
-        payload = frame[PAYLOAD_IDX : -2]
-
-        if self.first_line:
-            self.first_line = False
-            if not os.path.exists('data/'):
-                os.mkdir('data/')
-            self.port = self.cmt.port.split(os.sep)[-1] # /dev/cu.usbserial-143200     
-            file_dir = os.path.join('data', self.packet_type + '_' + self.start_time+'_' + self.port + '.csv')
-            print('Start logging:{0}'.format(file_dir))
-            self.data_file = open(file_dir, 'w')
-
-            header = 'pc_tm, roll, pitch, yaw,       \
-                    gyro_x, gyro_y, gyro_z,          \
-                    acc_x, acc_y, acc_z,             \
-                    mag_x, mag_y, mag_z,             \
-                    xRateTemp,                       \
-                    timeITOW, BITstatus'.replace(' ', '')
-            self.data_file.write(header + '\n')
-            self.data_file.flush()
-
-        try:
-            b = struct.pack(len_fmt, *payload)
-            d = struct.unpack(pack_fmt, b)
-        except Exception as e:
-            print("Decode payload error: {0}".format(e)) 
-
-        s = 360/math.pow(2, 16) # [360°/2^16]
-        roll    = d[0] * s # roll  in [deg]
-        pitch   = d[1] * s # pitch in [deg]
-        yaw = d[2] * s # yaw   in [deg]
-
-        s = 1260/math.pow(2, 16) # [1260°/2^16]
-        gyro_x = d[3] * s # Corrected gyro_x in [deg/sec]
-        gyro_y = d[4] * s # Corrected gyro_y in [deg/sec]
-        gyro_z = d[5] * s # Corrected gyro_z in [deg/sec]
-
-        s = 20/math.pow(2, 16) # [20/2^16]
-        accel_x = d[6] * s # xAccel in [g]
-        accel_y = d[7] * s # yAccel in [g]
-        accel_z = d[8] * s # zAccel in [g]
-
-        s = 20/math.pow(2, 16) # [20/2^16]
-        mag_x = d[9] * s  # X magnetometer in [Gauss]
-        mag_y = d[10] * s  # X magnetometer in [Gauss]
-        mag_z = d[11] * s  # X magnetometer in [Gauss]
-
-        s = 200/math.pow(2, 16) # [200/2^16]
-        xRateTemp = d[12] * s  # xRateTemp in [C]
-        
-        timeITOW  = d[13] # DMU ITOW in [ms]
-        BITstatus = d[14] # Master BIT and Status
-
-        str = '{0},{1:f},{2:f},{3:f},{4:f},         \
-            {5:f},{6:f},{7:f},{8:f},{9:f},{10:f},   \
-            {11:f},{12:f},{13:f},{14:d},{15:d}'     \
-            .format(tm_ms, roll, pitch, yaw,        \
-                    gyro_x, gyro_y, gyro_z,         \
-                    accel_x, accel_y, accel_z,      \
-                    mag_x, mag_y, mag_z,            \
-                    xRateTemp, timeITOW, BITstatus).replace(' ', '')
-
-        self.data_file.write(str + '\n')
-        self.data_file.flush()
-        self.lines += 1
-
-        # haven't test below code snippet
-        if len(self.apps) != 0 and self.sn is not None:
-            data = collections.OrderedDict()
-            data['pc_tm']   = tm_ms
-            data['roll']    = roll
-            data['pitch']   = pitch
-            data['yaw']   = yaw
-            data['gyro_x']  = gyro_x
-            data['gyro_y']  = gyro_y
-            data['gyro_z']  = gyro_z
-            data['acc_x']   = accel_x
-            data['acc_y']   = accel_y
-            data['acc_z']   = accel_z
-            data['mag_x']   = mag_x
-            data['mag_y']   = mag_y
-            data['mag_z']   = mag_z
-            data['xRateTemp'] = xRateTemp
-            data['timeITOW'] = timeITOW
-            data['BITstatus'] = BITstatus
-            msg = {}
-            msg['sn'] = self.sn
-            msg['version'] = self.version
-            msg['type'] = 'A1'
-            msg['data'] = data
-            for app in self.apps:
-                app.on_message(msg)
-
-        if self.lines % 1000 == 0:
-            print("[{0}]:Log counter of {1}: {2}".format(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), self.port, self.lines))
-            sys.stdout.flush()
-
-    def handle_packet_s1(self, frame):
+    def handle_packet(self, frame):
         '''
-        Parse 's1' packet.
-        
-        typedef struct {
-            uint32_t tstmp;
-            double   dbTstmp;
-            float    accel_g[3];
-            float    rate_dps[3];
-            float    mag_G[3];
-            float    temp_C;
-        }scaled1_payload_t;
+        Log a packet of any type in packet_decoder.PACKET_FORMATS to CSV by its schema:
+        one unpack and one %-format per frame. To support a new packet, add its schema there.
+        Fixed-point packets (A1, A2/A3, S1, ...) are collected and scaled in blocks by flush_batches().
         '''
-        PAYLOAD_IDX = 5
-        PAYLOAD_LEN = frame[4] #47
-        tm_ms = datetime.datetime.now().strftime('%H:%M:%S.%f')[:-3]
-        
-        pack_fmt = '<Id10f'
-        len_fmt = '{0}B'.format(PAYLOAD_LEN)
-        payload = frame[PAYLOAD_IDX : -2]
-
-        if self.first_line:
-            self.first_line = False
-            if not os.path.exists('data/'):
-                os.mkdir('data/')
-            self.port = self.cmt.port.split(os.sep)[-1] # /dev/cu.usbserial-143200
-            file_dir = os.path.join('data', self.packet_type+'_' + self.start_time + '_' + self.port + '.csv')
-            print('Start logging:{0}'.format(file_dir))
-            self.data_file = open(file_dir, 'w')
+        fmt = packet_decoder.PACKET_FORMATS[self.packet_type]
+        sink = self.data_files.get((self.port, self.packet_type))
+        if sink is None:
+            self.port = self.get_port_name() # /dev/cu.usbserial-143200
+            sink = self.data_files.open((self.port, self.packet_type))
 
-            header = 'pc_tm, tstmp, dbTstmp,            \
-                    acc_x, acc_y, acc_z,                \
-                    gyro_x, gyro_y, gyro_z,             \
-                    mag_x, mag_y, mag_z, temp_C'.replace(' ', '')
-            self.data_file.write(header + '\n')
-            self.data_file.flush()
+        if fmt.scales is not None and len(frame) == fmt.frame_size:
+            batch = self.batches.get(fmt)
+            if batch is None:
+                batch = self.batches[fmt] = []
+            batch.append(frame)  # decoded once by flush_batches() for both the CSV and apps.
+            if len(batch) >= BATCH_MAX_FRAMES:
+                self.flush_batches()
+            return
 
+        tm_ms = self.pc_clock.tm_ms()
         try:
-            b = struct.pack(len_fmt, *payload)
-            d = struct.unpack(pack_fmt, b)
+            d = fmt.decode(frame)
         except Exception as e:
-            print("Decode payload error: {0}".format(e)) 
-
-        str = '{0},{1:d},{2:f},{3:f},{4:f},         \
-            {5:f},{6:f},{7:f},{8:f},{9:f},{10:f},   \
-            {11:d},{12:d}'                   \
-            .format(tm_ms,d[0],d[1],d[2],d[3],      \
-                d[4],d[5],d[6],d[7],d[8],d[9],      \
-                d[10],d[11]).replace(' ', '')
-
-        self.data_file.write(str + '\n')
-        self.data_file.flush()
-        self.lines += 1
-
-        if self.lines % 1000 == 0:
-            print("[{0}]:Log counter of {1}: {2}".format(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), self.port, self.lines))
-            sys.stdout.flush()
-
-
-    def handle_packet_S1(self, frame):
-        '''
-        Parse 'S1' packet.
-        '''
-        PAYLOAD_IDX = 5
-        PAYLOAD_LEN = frame[4] # 0X20
-        tm_ms = datetime.datetime.now().strftime('%H:%M:%S.%f')[:-3]
-
-        pack_fmt = '>10h2H' # Note: Big Endian!
-        len_fmt = '{0}B'.format(PAYLOAD_LEN)
-        payload = frame[PAYLOAD_IDX : -2]
-
-        if self.first_line:
-            self.first_line = False
-            if not os.path.exists('data/'):
-                os.mkdir('data/')
-            self.port = self.cmt.port.split(os.sep)[-1] # /dev/cu.usbserial-143200     
-            file_dir = os.path.join('data', self.packet_type + '_' + self.start_time+'_' + self.port + '.csv')
-            print('Start logging:{0}'.format(file_dir))
-            self.data_file = open(file_dir, 'w')
-
-            header = 'pc_tm,                                    \
-                    acc_x, acc_y, acc_z,                        \
-                    gyro_x, gyro_y, gyro_z,                     \
-                    xRateTemp, yRateTemp, zRateTemp, boardTemp, \
-                    Counter, BITstatus'.replace(' ', '')
-            self.data_file.write(header + '\n')
-            self.data_file.flush()
-
-        try:
-            b = struct.pack(len_fmt, *payload)
-            d = struct.unpack(pack_fmt, b)
-        except Exception as e:
-            print("Decode payload error: {0}".format(e)) 
-
-        s = 20/math.pow(2, 16) # [20/2^16]
-        accel_x = d[0] * s # xAccel in [g]
-        accel_y = d[1] * s # yAccel in [g]
-        accel_z = d[2] * s # zAccel in [g]
-
-        s = 1260/math.pow(2, 16) # [1260°/2^16]
-        gyro_x = d[3] * s # Corrected gyro_x in [deg/sec]
-        gyro_y = d[4] * s # Corrected gyro_y in [deg/sec]
-        gyro_z = d[5] * s # Corrected gyro_z in [deg/sec]
-
-        s = 200/math.pow(2, 16) # [200/2^16]
-        xRateTemp = d[6] * s  # xRateTemp in [C]
-        yRateTemp = d[7] * s  # xRateTemp in [C]
-        zRateTemp = d[8] * s  # xRateTemp in [C]
-        boardTemp = d[9] * s  # xRateTemp in [C]
-        
-        Counter  = d[10]  # Output packet counter [ms]
-        BITstatus = d[11] # Master BIT and Status
-
-        str = '{0},{1:f},{2:f},{3:f},{4:f},         \
-            {5:f},{6:f},{7:f},{8:f},{9:f},{10:f},   \
-            {11:d},{12:d}'                          \
-            .format(tm_ms,                          \
-                    accel_x, accel_y, accel_z,      \
-                    gyro_x, gyro_y, gyro_z,         \
-                    xRateTemp, yRateTemp, zRateTemp, boardTemp,           \
-                    Counter, BITstatus).replace(' ', '')
-
-        self.data_file.write(str + '\n')
-        self.data_file.flush()
-        self.lines += 1
-
-        # haven't test below code snippet
-        if len(self.apps) != 0 and self.sn is not None:
-            data = collections.OrderedDict()
-            data['pc_tm']   = tm_ms
-            data['acc_x']   = accel_x
-            data['acc_y']   = accel_y
-            data['acc_z']   = accel_z
-            data['gyro_x']  = gyro_x
-            data['gyro_y']  = gyro_y
-            data['gyro_z']  = gyro_z
-            data['xRateTemp'] = xRateTemp
-            data['yRateTemp'] = yRateTemp
-            data['zRateTemp'] = zRateTemp
-            data['boardTemp'] = boardTemp
-            data['Counter']   = Counter
-            data['BITstatus'] = BITstatus
-            msg = {}
-            msg['sn'] = self.sn
-            msg['version'] = self.version
-            msg['type'] = 'S1'
-            msg['data'] = data
-            for app in self.apps:
-                app.on_message(msg)
-
-        if self.lines % 1000 == 0:
-            print("[{0}]:Log counter of {1}: {2}".format(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), self.port, self.lines))
-            sys.stdout.flush()
-
-    def handle_packet_A2_and_A3(self, frame, pack_tp):
-        '''
-        Parse 'A2' or ‘A3’ packet.
-        There are 3D corrected rate in 'A2' and raw rate in ‘A3’.
-        Other fields are totally the same between 'A2' and ‘A3’ packet.
-        Please refer to page 37 of MTLT305D manual for A2 packet format.
-        '''
-        PAYLOAD_IDX = 5
-        PAYLOAD_LEN = frame[4] # 0X1E
-        tm_ms = datetime.datetime.now().strftime('%H:%M:%S.%f')[:-3]
-
-        pack_fmt = '>12hIH' # Note: Big Endian!
-        len_fmt = '{0}B'.format(PAYLOAD_LEN)
-        payload = frame[PAYLOAD_IDX : -2]
-
-        if self.first_line:
-            self.first_line = False
-            if not os.path.exists('data/'):
-                os.mkdir('data/')
-            self.port = self.cmt.port.split(os.sep)[-1] # /dev/cu.usbserial-143200     
-            file_dir = os.path.join('data', self.packet_type + '_' + self.start_time+'_' + self.port + '.csv')
-            print('Start logging:{0}'.format(file_dir))
-            self.data_file = open(file_dir, 'w')
-
-            header = 'pc_tm, roll, pitch, yaw,       \
-                    gyro_x, gyro_y, gyro_z,          \
-                    acc_x, acc_y, acc_z,             \
-                    xRateTemp, yRateTemp, zRateTemp, \
-                    timeITOW, BITstatus'.replace(' ', '')
-            self.data_file.write(header + '\n')
-            self.data_file.flush()
-
-        try:
-            b = struct.pack(len_fmt, *payload)
-            d = struct.unpack(pack_fmt, b)
-        except Exception as e:
-            print("Decode payload error: {0}".format(e)) 
-
-        s = 360/math.pow(2, 16) # [360°/2^16]
-        roll    = d[0] * s # roll  in [deg]
-        pitch   = d[1] * s # pitch in [deg]
-        yaw = d[2] * s # yaw   in [deg]
-
-        s = 1260/math.pow(2, 16) # [1260°/2^16]
-        gyro_x = d[3] * s # Corrected gyro_x in [deg/sec]
-        gyro_y = d[4] * s # Corrected gyro_y in [deg/sec]
-        gyro_z = d[5] * s # Corrected gyro_z in [deg/sec]
-
-        s = 20/math.pow(2, 16) # [20/2^16]
-        accel_x = d[6] * s # xAccel in [g]
-        accel_y = d[7] * s # yAccel in [g]
-        accel_z = d[8] * s # zAccel in [g]
-
-        s = 200/math.pow(2, 16) # [200/2^16]
-        xRateTemp = d[9] * s  # xRateTemp in [C]
-        yRateTemp = d[10] * s # yRateTemp in [C]
-        zRateTemp = d[11] * s # zRateTemp in [C]
-        
-        timeITOW  = d[12] # DMU ITOW in [ms]
-        BITstatus = d[13] # Master BIT and Status
-
-        str = '{0},{1:f},{2:f},{3:f},{4:f},         \
-            {5:f},{6:f},{7:f},{8:f},{9:f},{10:f},   \
-            {11:f},{12:f},{13:d},{14:d}'            \
-            .format(tm_ms, roll, pitch, yaw,        \
-                    gyro_x, gyro_y, gyro_z,         \
-                    accel_x, accel_y, accel_z,      \
-                    xRateTemp, yRateTemp, zRateTemp,\
-                    timeITOW, BITstatus).replace(' ', '')
-
-        self.data_file.write(str + '\n')
-        self.data_file.flush()
-        self.lines += 1
-
-        # haven't test below code snippet
-        if len(self.apps) != 0 and self.sn is not None:
-            data = collections.OrderedDict()
-            data['pc_tm']   = tm_ms
-            data['roll']    = roll
-            data['pitch']   = pitch
-            data['yaw']   = yaw
-            data['gyro_x']  = gyro_x
-            data['gyro_y']  = gyro_y
-            data['gyro_z']  = gyro_z
-            data['acc_x']   = accel_x
-            data['acc_y']   = accel_y
-            data['acc_z']   = accel_z
-            data['xRateTemp'] = xRateTemp
-            data['yRateTemp'] = yRateTemp
-            data['zRateTemp'] = zRateTemp
-            data['timeITOW'] = timeITOW
-            data['BITstatus'] = BITstatus
-            msg = {}
-            msg['sn'] = self.sn
-            msg['version'] = self.version
-            msg['type'] = pack_tp
-            msg['data'] = data
-            for app in self.apps:
-                app.on_message(msg)
-
-        if self.lines % 1000 == 0:
-            print("[{0}]:Log counter of {1}: {2}".format(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), self.port, self.lines))
-            sys.stdout.flush()
-
-    def handle_packet_e2(self, frame):
-        '''
-        Parse 'e2' packet.
-
-        '''
-        PAYLOAD_IDX = 5
-        PAYLOAD_LEN = frame[4] # 0X1E
-        tm_ms = datetime.datetime.now().strftime('%H:%M:%S.%f')[:-3]
-
-        pack_fmt = '>12hIH' # Note: Big Endian!
-        len_fmt = '{0}B'.format(PAYLOAD_LEN)
-        payload = frame[PAYLOAD_IDX : -2]
-
-        if self.first_line:
-            self.first_line = False
-            if not os.path.exists('data/'):
-                os.mkdir('data/')
-            self.port = self.cmt.port.split(os.sep)[-1] # /dev/cu.usbserial-143200     
-            file_dir = os.path.join('data', self.packet_type + '_' + self.start_time+'_' + self.port + '.csv')
-            print('Start logging:{0}'.format(file_dir))
-            self.data_file = open(file_dir, 'w')
-
-            header = 'pc_tm, roll, pitch, yaw,       \
-                    gyro_x, gyro_y, gyro_z,          \
-                    acc_x, acc_y, acc_z,             \
-                    xRateTemp, yRateTemp, zRateTemp, \
-                    timeITOW, BITstatus'.replace(' ', '')
-            self.data_file.write(header + '\n')
-            self.data_file.flush()
-
-        try:
-            b = struct.pack(len_fmt, *payload)
-            d = struct.unpack(pack_fmt, b)
-        except Exception as e:
-            print("Decode payload error: {0}".format(e)) 
-
-        s = 360/math.pow(2, 16) # [360°/2^16]
-        roll    = d[0] * s # roll  in [deg]
-        pitch   = d[1] * s # pitch in [deg]
-        yaw = d[2] * s # yaw   in [deg]
-
-        s = 1260/math.pow(2, 16) # [1260°/2^16]
-        gyro_x = d[3] * s # Corrected gyro_x in [deg/sec]
-        gyro_y = d[4] * s # Corrected gyro_y in [deg/sec]
-        gyro_z = d[5] * s # Corrected gyro_z in [deg/sec]
-
-        s = 20/math.pow(2, 16) # [20/2^16]
-        accel_x = d[6] * s # xAccel in [g]
-        accel_y = d[7] * s # yAccel in [g]
-        accel_z = d[8] * s # zAccel in [g]
-
-        s = 200/math.pow(2, 16) # [200/2^16]
-        xRateTemp = d[9] * s  # xRateTemp in [C]
-        yRateTemp = d[10] * s # yRateTemp in [C]
-        zRateTemp = d[11] * s # zRateTemp in [C]
-        
-        timeITOW  = d[12] # DMU ITOW in [ms]
-        BITstatus = d[13] # Master BIT and Status
+            print("Decode payload error: {0}".format(e))
+            return
+
+        sink.write(fmt.row_template % ((tm_ms,) + d))
+        self.count_lines(1)
+
+        if self.channels and self.sn is not None:
+            self.publish_record(tm_ms, d)
+
+    def flush_batches(self):
+        '''
+        write frames collected by handle_packet(), type by type: a burst is decoded into one array,
+        scaled by one multiply and formatted by one % operation; a few frames are formatted one by one.
+        All of them come from the current chunk, so they share its PC timestamp.
+        Apps get records of the same decoded values.
+        '''
+        tm_ms = self.pc_clock.tm_ms()
+        publish = self.channels and self.sn is not None
+        for fmt, frames in self.batches.items():
+            sink = self.data_files.open((self.port, fmt.packet_type))
+            if len(frames) >= BATCH_MIN_FRAMES:
+                values = fmt.decode_frames(frames)
+                sink.write(fmt.format_rows(tm_ms, values))
+                if publish:
+                    for row in values.tolist():
+                        self.publish_record(tm_ms, tuple(row), fmt.packet_type)
+            else:
+                for frame in frames:
+                    d = fmt.decode(frame)
+                    sink.write(fmt.row_template % ((tm_ms,) + d))
+                    if publish:
+                        self.publish_record(tm_ms, d, fmt.packet_type)
+            self.count_lines(len(frames))
+        self.batches = {}
 
-    def handle_packet_d1(self, frame):
+    def count_lines(self, n):
         '''
-        Parse 'd1' packet.
-            typedef struct {
-                uint32_t itow;          // msec
-                double   dblItow;       // s
-                float    roll;          // deg
-                float    pitch;         // deg
-                float    rates[3];      // deg/s
-                float    accels[3];     // "g"
-                float    v;             // m/s
-                BOOL     update;        // flag
-            }aid1_payload_t;
+        count logged rows, print the counter every 1000 rows.
         '''
-        PAYLOAD_IDX = 5
-        PAYLOAD_LEN = frame[4] #49
-        tm_ms = datetime.datetime.now().strftime('%H:%M:%S.%f')[:-3]
-        
-        pack_fmt = '<Id9fB'
-        len_fmt = '{0}B'.format(PAYLOAD_LEN)
-        payload = frame[PAYLOAD_IDX : -2]
-
-        if self.first_line:
-            self.first_line = False
-            if not os.path.exists('data/'):
-                os.mkdir('data/')
-            self.port = self.cmt.port.split(os.sep)[-1] # /dev/cu.usbserial-143200     
-            file_dir = os.path.join('data', self.packet_type+'_' + self.start_time + '_' + self.port + '.csv')
-            print('Start logging:{0}'.format(file_dir))
-            self.data_file = open(file_dir, 'w')
-
-            header = 'pc_tm, itow, dblItow, roll, pitch,  \
-                    gyro_x, gyro_y, gyro_z, acc_x, acc_y, acc_z, \
-                    v, update'.replace(' ', '')
-            self.data_file.write(header + '\n')
-            self.data_file.flush()
-
-        try:
-            b = struct.pack(len_fmt, *payload)
-            d = struct.unpack(pack_fmt, b)
-        except Exception as e:
-            print("Decode payload error: {0}".format(e)) 
-
-        str = '{0},{1:d},{2:f},{3:f},{4:f},         \
-            {5:f},{6:f},{7:f},{8:f},{9:f},{10:f},   \
-            {11:f},{12:d}'                   \
-            .format(tm_ms,d[0],d[1],d[2],d[3],      \
-                d[4],d[5],d[6],d[7],d[8],d[9],      \
-                d[10],d[11]).replace(' ', '')
-
-        self.data_file.write(str + '\n')
-        self.data_file.flush()
-        self.lines += 1
-
-        if self.lines % 1000 == 0:
+        last = self.lines
+        self.lines += n
+        if self.lines // 1000 != last // 1000:
             print("[{0}]:Log counter of {1}: {2}".format(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), self.port, self.lines))
             sys.stdout.flush()
 
-    def handle_packet_d2(self, frame):
+    def get_port_name(self):
+        ''' short name of .cmt used in file names, eg. 'cu.usbserial-143200' of '/dev/cu.usbserial-143200'.
         '''
-        Parse 'd2' packet.
-        typedef struct {
-            uint32_t itow;          // msec
-            double   dblItow;       // s
-            float    rates[3];      // deg/s
-            float    accels[3];     // "g"
-            float    roll;          // deg
-            float    pitch;         // deg
-            float    vehAccel[3];   // m/s^2
-            BOOL     update;        // flag
-        }aid2_payload_t;
-        '''
-        PAYLOAD_IDX = 5
-        PAYLOAD_LEN = frame[4] #57
-        tm_ms = datetime.datetime.now().strftime('%H:%M:%S.%f')[:-3]
-        
-        pack_fmt = '<Id11fB'
-        len_fmt = '{0}B'.format(PAYLOAD_LEN)
-        payload = frame[PAYLOAD_IDX : -2]
-
-        if self.first_line:
-            self.first_line = False
-            if not os.path.exists('data/'):
-                os.mkdir('data/')
-            self.port = self.cmt.port.split(os.sep)[-1] # /dev/cu.usbserial-143200     
-            file_dir = os.path.join('data', self.packet_type+'_' + self.start_time + '_' + self.port + '.csv')
-            print('Start logging:{0}'.format(file_dir))
-            self.data_file = open(file_dir, 'w')
-
-            header = 'pc_tm, itow, dblItow, gyro_x, gyro_y, gyro_z, \
-                    acc_x, acc_y, acc_z, roll, pitch,\
-                    veh_acc_x, veh_acc_y, veh_acc_z, update'.replace(' ', '')
-            self.data_file.write(header + '\n')
-            self.data_file.flush()
-
-        try:
-            b = struct.pack(len_fmt, *payload)
-            d = struct.unpack(pack_fmt, b)
-        except Exception as e:
-            print("Decode payload error: {0}".format(e)) 
-
-        str = '{0},{1:d},{2:f},{3:f},{4:f},         \
-            {5:f},{6:f},{7:f},{8:f},{9:f},{10:f},   \
-            {11:f},{12:f},{13:f},{14:d}'                   \
-            .format(tm_ms,d[0],d[1],d[2],d[3],      \
-                d[4],d[5],d[6],d[7],d[8],d[9],      \
-                d[10],d[11],d[12],d[13]).replace(' ', '')
-
-        self.data_file.write(str + '\n')
-        self.data_file.flush()
-        self.lines += 1
-
-        if self.lines % 1000 == 0:
-            print("[{0}]:Log counter of {1}: {2}".format(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), self.port, self.lines))
-            sys.stdout.flush()
+        return '{0}'.format(self.cmt.port).split(os.sep)[-1]
 
     def get_data_from_serial_port(self, port, baud):
         self.cmt = communicator.SerialPort()
@@ -1188,8 +657,14 @@ def play_sound(sentence):
         cmd = "say '{0}'".format(sentence)
         os.system(cmd)
 
-def parse_bin_file(data_file):
-    '''wrapper'''
+def parse_bin_file(data_file, offline = False):
+    '''wrapper
+    offline: True to decode the whole file at once with NumPy instead of replaying it through receiver and parser.
+    '''
+    if offline:
+        import bin_decoder
+        return bin_decoder.decode_bin_file(data_file)
+
     logger = IMULogger()
     logger.get_data_from_file(data_file)
     
@@ -1204,54 +679,25 @@ def parse_bin_file(data_file):
 
 def auto_scan_devices():
     '''
+    Request 'ID' of devices on all ports at the same time, print SN and version of found devices
+    and remember them in the device cache by USB serial number.
+    returns: list of (port, baud, sn, version).
     '''
-    logger = IMULogger()
-    logger.cmt = communicator.SerialPort()
-
-    HEADER = [0X55, 0X55, 0X49, 0X44] # 'ID'
-    PACKAGE_TYPE_IDX = 2
-    PAYLOAD_LEN_IDX = 4
-
-    sync_pattern = collections.deque(4*[0], 4)
-    find_header = False
-    frame = []
-    payload_len = 0
-
-    ports = logger.cmt.find_ports()
-
-    for port in ports:
-        for baud in [115200]:
-        # for baud in [115200, 230400, 57600]:
-            logger.cmt.open_serial_port(port, baud, 0.2)  # Assume driver can receive the respose of request 'GP' in 1 second.
-            if logger.cmt.ser:
-                logger.send_packet_GP()
-                serial_data = bytearray(logger.cmt.ser.read(1000))  # Assume driver can receive the respose of request 'GP' within 1000 bytes.
-                logger.cmt.ser.close()
-                sz = len(serial_data)
-                find_header = False
-                logger.port = port
-
-                for d in serial_data:
-                    if find_header:
-                        frame.append(d)
-                        if PAYLOAD_LEN_IDX + 1 == len(frame):
-                            payload_len = frame[PAYLOAD_LEN_IDX]
-                        elif 2 + 2 + 1 + payload_len + 2 == len(frame):  # 2: len of header 'UU'; 2: package type 'a1'; 1: payload len; 2:len of checksum.
-                            find_header = False
-                            # checksum
-                            packet_crc = 256 * frame[-2] + frame[-1]
-                            if packet_crc == logger.calc_crc(frame[PACKAGE_TYPE_IDX : -2]):
-                                # find a whole frame
-                                logger.parse_frame(frame)
-                                break
-                            else:
-                                print("CRC error!")
-                    else:
-                        sync_pattern.append(d)
-                        if operator.eq(list(sync_pattern), HEADER):
-                            frame = HEADER[:]
-                            find_header = True
-                            sync_pattern.append(0)
+    cmt = communicator.SerialPort()
+    candidates = [(port, [115200]) for port in cmt.find_ports()]
+    # for baud in [115200, 230400, 57600]:
+    found = communicator.probe_ports(candidates, communicator.find_id_frame, communicator.GP_REQUEST,
+                                     max_bytes=1000, first_only=False)  # Assume the respose of 'GP' is within 1000 bytes.
+    usb_sns = communicator.usb_serial_numbers()
+    devices = []
+    for port, baud, data in found:
+        logger = IMULogger()
+        logger.port = port
+        logger.parse_frame(communicator.find_id_frame(data))
+        devices.append((port, baud, logger.sn, logger.version))
+        if port in usb_sns:
+            cmt.device_cache.put(usb_sns[port], port, baud, sn=logger.sn, version=logger.version)
+    return devices
 
 '''
 Please check below items:
@@ -1259,9 +705,10 @@ Please check below items:
 2. Config serial port and baud.
 3. 
 '''
-def run(port, baud, b_rst = False, apps = None):
+def run(port, baud, b_rst = False, apps = None, output_mode = 'csv'):
     '''wrapper'''
     logger = IMULogger()
+    logger.set_output_mode(output_mode) # 'csv', 'bin' or 'both'
 
     if apps is not None:
         for app in apps:
@@ -1297,6 +744,7 @@ def main():
     ### Log IMU data by binary data.
     data_file = '/Users/songyang/Desktop/Capture.txt'
     parse_bin_file(data_file)
+    # parse_bin_file(data_file, offline = True) # decode whole file at once.
 
     ### Auto scan all IMU device.
     # auto_scan_devices()
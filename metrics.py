@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*
+"""
+Metrics of logging pipelines: throughput, CRC errors, resyncs, buffer depth and latency.
+Metrics are kept in a Registry and exposed by a local HTTP endpoint in Prometheus text
+format (/metrics, /metrics.json) and by a JSON snapshot file written periodically.
+All loggers in one process share REGISTRY and are told apart by the 'device' label.
+
+Usage:
+    metrics.start(http_port=9100, json_file='data/metrics.json')
+"""
+
+import os
+import json
+import time
+import bisect
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)  # seconds
+SNAPSHOT_INTERVAL = 5.0  # seconds between JSON snapshots.
+
+
+class Counter():
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def get(self):
+        return self.value
+
+
+class Gauge():
+    '''
+    value is set by set() or read from func when collected.
+    '''
+    def __init__(self, func=None):
+        self.value = 0
+        self.func = func
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        if self.func is not None:
+            try:
+                return self.func()
+            except Exception:
+                return 0
+        return self.value
+
+
+class Histogram():
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get(self):
+        '''
+        returns: dict of cumulative bucket counts, sum and count.
+        '''
+        cumulative = []
+        total = 0
+        for n in self.counts:
+            total += n
+            cumulative.append(total)
+        return {
+            'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], cumulative)),
+            'sum': self.sum,
+            'count': self.count,
+            }
+
+
+class Registry():
+    '''
+    Metric families by name, each family has one metric per set of labels.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.families = {}  # name -> [type, help, {labels tuple: metric}]
+
+    def get_metric(self, kind, cls, name, help, labels, *args):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            family = self.families.get(name)
+            if family is None:
+                family = [kind, help, {}]
+                self.families[name] = family
+            elif family[0] != kind:
+                raise ValueError('Metric {0} is a {1}, not a {2}.'.format(name, family[0], kind))
+            metric = family[2].get(key)
+            if metric is None:
+                metric = cls(*args)
+                family[2][key] = metric
+            return metric
+
+    def counter(self, name, help, **labels):
+        return self.get_metric('counter', Counter, name, help, labels)
+
+    def gauge(self, name, help, func=None, **labels):
+        return self.get_metric('gauge', Gauge, name, help, labels, func)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, **labels):
+        return self.get_metric('histogram', Histogram, name, help, labels, buckets)
+
+    def remove(self, **labels):
+        '''
+        remove metrics whose labels contain labels, eg. remove(device='ttyUSB0').
+        '''
+        items = set(labels.items())
+        with self.lock:
+            for family in self.families.values():
+                for key in [k for k in family[2] if items <= set(k)]:
+                    del family[2][key]
+
+    def collect(self):
+        '''
+        returns: list of (name, type, help, [(labels dict, value)]).
+        '''
+        with self.lock:
+            families = [(name, f[0], f[1], list(f[2].items())) for name, f in sorted(self.families.items())]
+        return [(name, kind, help, [(dict(k), m.get()) for k, m in metrics]) for name, kind, help, metrics in families]
+
+    def to_prometheus(self):
+        '''
+        returns: metrics in Prometheus text exposition format.
+        '''
+        lines = []
+        for name, kind, help, samples in self.collect():
+            lines.append('# HELP {0} {1}'.format(name, help))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+            for labels, value in samples:
+                if kind == 'histogram':
+                    for le, n in value['buckets'].items():
+                        lines.append('{0}_bucket{1} {2}'.format(name, format_labels(labels, le=le), n))
+                    lines.append('{0}_sum{1} {2}'.format(name, format_labels(labels), repr(float(value['sum']))))
+                    lines.append('{0}_count{1} {2}'.format(name, format_labels(labels), value['count']))
+                else:
+                    lines.append('{0}{1} {2}'.format(name, format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self):
+        '''
+        returns: dict of name -> list of {'labels': ..., 'value': ...}.
+        '''
+        return {
+            name: [{'labels': labels, 'value': value} for labels, value in samples]
+            for name, kind, help, samples in self.collect()
+            }
+
+
+def format_labels(labels, **extra):
+    items = list(labels.items()) + list(extra.items())
+    if not items:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in items) + '}'
+
+
+REGISTRY = Registry()
+
+
+class IMUMetrics():
+    '''
+    Metrics of one IMULogger, labelled with its device name.
+    '''
+    def __init__(self, device, buffer_depth=None, registry=REGISTRY):
+        self.device = device
+        self.registry = registry
+        self.frames = {}  # packet type -> Counter
+        self.bytes = registry.counter('imu_received_bytes_total', 'Bytes received from device.', device=device)
+        self.crc_errors = registry.counter('imu_crc_errors_total', 'Frames with wrong CRC.', device=device)
+        self.resyncs = registry.counter('imu_resyncs_total', 'Times the scanner skipped bytes to find a frame header.', device=device)
+        self.skipped_bytes = registry.counter('imu_skipped_bytes_total', 'Bytes skipped while searching frame headers.', device=device)
+        self.bad_lengths = registry.counter('imu_bad_lengths_total', 'Headers skipped for an impossible payload length of their packet type.', device=device)
+        self.latency = registry.histogram('imu_read_to_write_latency_seconds', 'Time from receiving the oldest buffered row of a log to writing it to file.', device=device)
+        if buffer_depth is not None:
+            registry.gauge('imu_buffer_bytes', 'Received bytes waiting for the parser.', buffer_depth, device=device)
+
+    def frame(self, packet_type):
+        counter = self.frames.get(packet_type)
+        if counter is None:
+            counter = self.registry.counter('imu_frames_total', 'Good frames by packet type.', device=self.device, type=packet_type)
+            self.frames[packet_type] = counter
+        counter.value += 1
+
+
+class CANMetrics():
+    '''
+    Metrics of one CAN reader, labelled with its channel or file name.
+    '''
+    def __init__(self, device, registry=REGISTRY):
+        self.device = device
+        self.registry = registry
+        self.messages = {}  # PGN -> Counter
+        self.bytes = registry.counter('can_received_bytes_total', 'Payload bytes of CAN messages.', device=device)
+        self.error_frames = registry.counter('can_error_frames_total', 'CAN error frames.', device=device)
+        self.latency = registry.histogram('can_read_to_write_latency_seconds', 'Time from CAN message timestamp to writing its row.', device=device)
+
+    def message(self, pgn, size):
+        counter = self.messages.get(pgn)
+        if counter is None:
+            counter = self.registry.counter('can_messages_total', 'CAN messages by PGN.', device=self.device, pgn=pgn)
+            self.messages[pgn] = counter
+        counter.value += 1
+        self.bytes.value += size
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path in ('/', '/metrics'):
+            body = self.registry.to_prometheus().encode()
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif path == '/metrics.json':
+            body = json.dumps(self.registry.to_dict()).encode()
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # do not print every scrape.
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(port, host='127.0.0.1', registry=REGISTRY):
+    '''
+    serve metrics on http://host:port/metrics in a daemon thread.
+    returns: the server, call .shutdown() to stop it.
+    '''
+    handler = type('Handler', (MetricsHandler,), {'registry': registry})
+    server = MetricsServer((host, port), handler)
+    t = threading.Thread(target=server.serve_forever, name='metrics-http')
+    t.daemon = True
+    t.start()
+    print('Metrics at http://{0}:{1}/metrics'.format(host, server.server_address[1]))
+    return server
+
+
+class SnapshotWriter():
+    '''
+    Write registry to a JSON file every interval seconds, with frames/s and bytes/s since the last snapshot.
+    The file is replaced atomically so readers never see a partial snapshot.
+    '''
+    def __init__(self, file_name, interval=SNAPSHOT_INTERVAL, registry=REGISTRY):
+        self.file_name = file_name
+        self.interval = interval
+        self.registry = registry
+        self.last = {}  # (name, labels) -> (time, value) of counters
+        self.exit_event = threading.Event()
+        self.thread = threading.Thread(target=self.loop, name='metrics-json')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def snapshot(self):
+        now = time.time()
+        metrics = {}
+        rates = {}
+        for name, kind, help, samples in self.registry.collect():
+            metrics[name] = [{'labels': labels, 'value': value} for labels, value in samples]
+            if kind != 'counter':
+                continue
+            for labels, value in samples:
+                key = (name, tuple(sorted(labels.items())))
+                last = self.last.get(key)
+                self.last[key] = (now, value)
+                if last is not None and now > last[0]:
+                    rate_name = name[:-len('_total')] if name.endswith('_total') else name
+                    rates.setdefault(rate_name + '_per_second', []).append(
+                        {'labels': labels, 'value': (value - last[1]) / (now - last[0])})
+        return {'time': now, 'metrics': metrics, 'rates': rates}
+
+    def write(self):
+        data = self.snapshot()
+        folder = os.path.dirname(self.file_name)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        tmp = self.file_name + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmp, self.file_name)
+
+    def loop(self):
+        while not self.exit_event.wait(self.interval):
+            try:
+                self.write()
+            except Exception as e:
+                print('Write metrics snapshot error: {0}'.format(e))
+
+    def stop(self):
+        self.exit_event.set()
+
+
+def start(http_port=None, json_file=None, interval=SNAPSHOT_INTERVAL, host='127.0.0.1', registry=REGISTRY):
+    '''
+    start the HTTP endpoint and/or the JSON snapshot writer.
+    A port which can not be bound, eg. used by another exporter, only disables the HTTP endpoint.
+    returns: (server, snapshot writer), None for the disabled or failed ones.
+    '''
+    server = None
+    if http_port is not None:
+        try:
+            server = start_http_server(http_port, host, registry)
+        except OSError as e:
+            print('Warning: metrics HTTP endpoint disabled, can not bind {0}:{1}: {2}'.format(host, http_port, e))
+    writer = SnapshotWriter(json_file, interval, registry) if json_file else None
+    return server, writer
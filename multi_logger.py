@@ -11,6 +11,11 @@ import threading
 import datetime
 import time
 import imu_logger
+import selector_logger
+import async_logger
+import metrics
+import data_sink
+import record_server
 
 def main():
     '''main'''
@@ -28,6 +33,47 @@ def main():
     #             ('/dev/ttyUSB1', 115200, False, None),    \
     #         ]
 
+    # metrics: Prometheus text at http://127.0.0.1:<metrics_port>/metrics, and a JSON snapshot file.
+    metrics_port = None  # eg. 9108, None: disable
+    metrics_file = os.path.join('data', 'metrics.json')  # None: disable
+    metrics.start(metrics_port, metrics_file)
+
+    # rotation of log files: None for one file per packet type, or segments of max_bytes/max_seconds
+    # compressed with 'gzip' or 'lzma' in a background thread, listed in data/*.manifest.jsonl.
+    data_sink.ROTATION = None  # eg. {'max_bytes': 100*1024*1024, 'max_seconds': 3600, 'compression': 'gzip'}
+
+    # stream decoded records of all devices to local subscribers, eg. viewers and scripts, see record_server.py.
+    # Not supported by engine 'process'.
+    record_socket = None  # eg. '/tmp/imu_records.sock', None: disable
+    record_port = None  # eg. 9000, TCP port on 127.0.0.1, None: disable
+    if record_socket or record_port:
+        publisher = record_server.RecordPublisher()
+        if record_socket:
+            publisher.serve_unix(record_socket)
+        if record_port:
+            publisher.serve_tcp('127.0.0.1', record_port)
+        _args = [(arg[0], arg[1], arg[2], (publisher,) + tuple(arg[3] or ())) for arg in _args]
+
+    # 'thread': start imu_logger.run() in one thread per device, default.
+    # 'selector': log all devices in one thread, requires POSIX.
+    # 'async': log all devices as coroutines on one asyncio event loop.
+    # 'process': log devices in worker processes, for many devices that one process can not keep up with, requires POSIX.
+    engine = 'thread'
+    processes = None  # number of worker processes of engine 'process', None: one per device.
+
+    if engine == 'selector':
+        selector_logger.run(_args)
+        return
+
+    if engine == 'async':
+        async_logger.run(_args)
+        return
+
+    if engine == 'process':
+        import process_logger  # python 3.8+, multiprocessing.shared_memory
+        process_logger.run(_args, processes)
+        return
+
     for arg in _args:
         t = threading.Thread(target=imu_logger.run, args=arg)
         t.start()
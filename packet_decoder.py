@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*
+"""
+Registry of IMU packet schemas and their precompiled decoders, keyed by packet type.
+Payload is unpacked directly from the frame buffer at offset PAYLOAD_IDX.
+"""
+
+import re
+import struct
+import numpy as np
+from numpy.lib import recfunctions
+
+PAYLOAD_IDX = 5
+FRAME_OVERHEAD = 7  # 'UU' + packet type + payload len + crc.
+NP_CODES = {'B': 'u1', 'b': 'i1', 'H': 'u2', 'h': 'i2', 'I': 'u4', 'i': 'i4',
+            'Q': 'u8', 'q': 'i8', 'f': 'f4', 'd': 'f8'}
+
+# scale factors of fixed-point fields.
+ANGLE_SCALE = 360/65536.0  # [360°/2^16], deg
+RATE_SCALE = 1260/65536.0  # [1260°/2^16], deg/sec
+ACCEL_SCALE = 20/65536.0   # [20/2^16], g
+MAG_SCALE = 20/65536.0     # [20/2^16], Gauss
+TEMP_SCALE = 200/65536.0   # [200/2^16], C
+
+
+class PacketFormat():
+    '''
+    Schema of one packet type: struct format (with endianness), field names, scale factors and units.
+    scales is None if no field need to be scaled, otherwise one factor per field,
+    integer 1 keeps the raw value.
+    A decode function, the CSV header and a %-format row template are compiled once from the schema,
+    so each frame costs one unpack and one format.
+    '''
+    def __init__(self, packet_type, fmt, fields, scales=None, units=None):
+        self.packet_type = packet_type
+        self.struct = struct.Struct(fmt)
+        self.fields = fields
+        self.scales = scales
+        self.units = units
+        self.size = self.struct.size
+        self.frame_size = self.size + FRAME_OVERHEAD
+        self.frame_dtype = None  # NumPy dtype of whole frames, built by decode_frames().
+        raw = self.struct.unpack(bytes(self.size))
+        if len(fields) != len(raw):
+            raise ValueError('Fields mismatch format of packet {0}'.format(packet_type))
+        if scales is not None and len(scales) != len(fields):
+            raise ValueError('Scales mismatch fields of packet {0}'.format(packet_type))
+        if units is not None and len(units) != len(fields):
+            raise ValueError('Units mismatch fields of packet {0}'.format(packet_type))
+        self.decode = self.compile_decode()
+        # CSV: floats and scaled fields as '%f', integers as '%d', same as '{:f}' and '{:d}'.
+        is_float = [isinstance(v, float) or (scales is not None and s != 1) for v, s in zip(raw, scales or [1] * len(raw))]
+        self.header = ','.join(('pc_tm',) + tuple(fields))
+        self.row_template = '%s,' + ','.join('%f' if f else '%d' for f in is_float) + '\n'
+
+    def compile_decode(self):
+        '''
+        returns: function(frame, offset=PAYLOAD_IDX) -> tuple of scaled values, with scale factors inlined.
+        '''
+        if self.scales is None:
+            unpack_from = self.struct.unpack_from
+            return lambda frame, offset=PAYLOAD_IDX: unpack_from(frame, offset)
+        items = ', '.join('d[{0}]'.format(i) if s == 1 else 'd[{0}] * {1!r}'.format(i, float(s)) for i, s in enumerate(self.scales))
+        src = 'def decode(frame, offset={0}):\n    d = unpack_from(frame, offset)\n    return ({1},)\n'.format(PAYLOAD_IDX, items)
+        namespace = {'unpack_from': self.struct.unpack_from}
+        exec(compile(src, '<decode {0}>'.format(self.packet_type), 'exec'), namespace)
+        return namespace['decode']
+
+    def dtype(self, offset=0, itemsize=None):
+        '''
+        returns: NumPy structured dtype of the payload, fields start at offset in items of itemsize bytes.
+        '''
+        spec = self.struct.format
+        if isinstance(spec, bytes):
+            spec = spec.decode()
+        endian = '>' if spec[0] in '>!' else '<'
+        codes = []
+        for count, code in re.findall(r'(\d*)([a-zA-Z])', spec):
+            codes += [code] * int(count or 1)
+        offsets = [offset + struct.calcsize(endian + ''.join(codes[:i])) for i in range(len(codes))]
+        return np.dtype({'names': list(self.fields), 'formats': [endian + NP_CODES[c] for c in codes],
+                         'offsets': offsets, 'itemsize': itemsize or offset + self.size})
+
+    def decode_frames(self, frames):
+        '''
+        decode a burst of whole frames of this type at once: one array of raw values, one multiply by the scale vector.
+        returns: float64 array, one row of scaled values per frame.
+        '''
+        if self.frame_dtype is None:
+            self.frame_dtype = self.dtype(PAYLOAD_IDX, self.frame_size)
+            self.scale_vector = np.array(self.scales if self.scales is not None else [1] * len(self.fields), dtype=np.float64)
+        raw = np.frombuffer(b''.join(frames), dtype=self.frame_dtype)
+        return recfunctions.structured_to_unstructured(raw, dtype=np.float64) * self.scale_vector
+
+    def unpack(self, frame, offset=PAYLOAD_IDX):
+        '''
+        returns: tuple of raw values.
+        '''
+        return self.struct.unpack_from(frame, offset)
+
+    def format_row(self, pc_tm, values):
+        '''
+        returns: CSV row of decoded values, ending with '\n'.
+        '''
+        return self.row_template % ((pc_tm,) + tuple(values))
+
+    def format_rows(self, pc_tm, values):
+        '''
+        format rows of decode_frames() which share one pc_tm with a single % operation.
+        returns: CSV rows, each ending with '\n'.
+        '''
+        template = self.row_template.replace('%s', pc_tm.replace('%', '%%'), 1)
+        return (template * len(values)) % tuple(values.ravel().tolist())
+
+
+def _register(*formats):
+    return dict((f.packet_type, f) for f in formats)
+
+_A2_FIELDS = ('roll', 'pitch', 'yaw',
+              'gyro_x', 'gyro_y', 'gyro_z',
+              'acc_x', 'acc_y', 'acc_z',
+              'xRateTemp', 'yRateTemp', 'zRateTemp',
+              'timeITOW', 'BITstatus')
+_A2_SCALES = (ANGLE_SCALE,)*3 + (RATE_SCALE,)*3 + (ACCEL_SCALE,)*3 + (TEMP_SCALE,)*3 + (1, 1)
+_A2_UNITS = ('deg',)*3 + ('deg/s',)*3 + ('g',)*3 + ('C',)*3 + ('ms', '')
+
+# To support a new packet, add its schema here, IMULogger logs it to CSV and binary logs by this entry.
+PACKET_FORMATS = _register(
+    PacketFormat('ID', '>I', ('sn',)),  # followed by version string.
+    PacketFormat('a1', '<Id8f3B',
+                 ('itow', 'dblItow', 'roll', 'pitch',
+                  'gyro_x', 'gyro_y', 'gyro_z',
+                  'acc_x', 'acc_y', 'acc_z',
+                  'ekfOpMode', 'accelLinSwitch', 'turnSwitch'),
+                 units=('ms', 's', 'deg', 'deg') + ('deg/s',)*3 + ('m/s^2',)*3 + ('',)*3),
+    PacketFormat('a2', '<Id9f',
+                 ('itow', 'dblItow', 'roll', 'pitch', 'yaw',
+                  'gyro_x', 'gyro_y', 'gyro_z',
+                  'acc_x', 'acc_y', 'acc_z'),
+                 units=('ms', 's') + ('deg',)*3 + ('deg/s',)*3 + ('m/s^2',)*3),
+    PacketFormat('z1', '<I9f',
+                 ('itow',
+                  'accel_mpss_x', 'accel_mpss_y', 'accel_mpss_z',
+                  'rate_dps_x', 'rate_dps_y', 'rate_dps_z',
+                  'mag_G_x', 'mag_G_y', 'mag_G_z'),
+                 units=('ms',) + ('m/s^2',)*3 + ('deg/s',)*3 + ('G',)*3),
+    PacketFormat('s1', '<Id10f',
+                 ('tstmp', 'dbTstmp',
+                  'acc_x', 'acc_y', 'acc_z',
+                  'gyro_x', 'gyro_y', 'gyro_z',
+                  'mag_x', 'mag_y', 'mag_z', 'temp_C'),
+                 units=('ms', 's') + ('g',)*3 + ('deg/s',)*3 + ('G',)*3 + ('C',)),
+    PacketFormat('S1', '>10h2H',  # Note: Big Endian!
+                 ('acc_x', 'acc_y', 'acc_z',
+                  'gyro_x', 'gyro_y', 'gyro_z',
+                  'xRateTemp', 'yRateTemp', 'zRateTemp', 'boardTemp',
+                  'Counter', 'BITstatus'),
+                 (ACCEL_SCALE,)*3 + (RATE_SCALE,)*3 + (TEMP_SCALE,)*4 + (1, 1),
+                 ('g',)*3 + ('deg/s',)*3 + ('C',)*4 + ('ms', '')),
+    PacketFormat('A1', '>13hIH',  # Note: Big Endian!
+                 ('roll', 'pitch', 'yaw',
+                  'gyro_x', 'gyro_y', 'gyro_z',
+                  'acc_x', 'acc_y', 'acc_z',
+                  'mag_x', 'mag_y', 'mag_z',
+                  'xRateTemp', 'timeITOW', 'BITstatus'),
+                 (ANGLE_SCALE,)*3 + (RATE_SCALE,)*3 + (ACCEL_SCALE,)*3 + (MAG_SCALE,)*3 + (TEMP_SCALE, 1, 1),
+                 ('deg',)*3 + ('deg/s',)*3 + ('g',)*3 + ('G',)*3 + ('C', 'ms', '')),  # OpenIMU335-VG
+    PacketFormat('A2', '>12hIH', _A2_FIELDS, _A2_SCALES, _A2_UNITS),  # Note: Big Endian! MTLT-305, corrected rates
+    PacketFormat('A3', '>12hIH', _A2_FIELDS, _A2_SCALES, _A2_UNITS),  # Note: Big Endian! MTLT-335D, raw rates
+    PacketFormat('e2', '>12hIH', _A2_FIELDS, _A2_SCALES, _A2_UNITS),  # Note: Big Endian!
+    PacketFormat('d1', '<Id9fB',
+                 ('itow', 'dblItow', 'roll', 'pitch',
+                  'gyro_x', 'gyro_y', 'gyro_z',
+                  'acc_x', 'acc_y', 'acc_z',
+                  'v', 'update'),
+                 units=('ms', 's', 'deg', 'deg') + ('deg/s',)*3 + ('g',)*3 + ('m/s', '')),  # Odometer
+    PacketFormat('d2', '<Id11fB',
+                 ('itow', 'dblItow',
+                  'gyro_x', 'gyro_y', 'gyro_z',
+                  'acc_x', 'acc_y', 'acc_z',
+                  'roll', 'pitch',
+                  'veh_acc_x', 'veh_acc_y', 'veh_acc_z', 'update'),
+                 units=('ms', 's') + ('deg/s',)*3 + ('g',)*3 + ('deg', 'deg') + ('m/s^2',)*3 + ('',)),  # Odometer
+    )
+
+
+# packet type as in frames, eg. b'a1' -> payload length. Frames of these types with another length are
+# impossible and rejected by frame_scanner.FrameScanner early. 'ID' is followed by a version string.
+PAYLOAD_LENGTHS = dict((k.encode(), f.size) for k, f in PACKET_FORMATS.items() if k != 'ID')
+
+
+def decode(packet_type, frame):
+    '''
+    Decode payload of frame by the registered format of packet_type.
+    returns: tuple of scaled values.
+    raises: KeyError if packet_type is not registered, struct.error if frame is too short.
+    '''
+    return PACKET_FORMATS[packet_type].decode(frame)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*
+"""
+Low cost PC timestamps of received data.
+The clock is sampled once per received chunk with time.monotonic_ns() and converted to
+wall clock time with a cached offset. The 'HH:MM:SS' part of tm_ms is formatted only
+when the second changes, otherwise only the milliseconds are appended.
+"""
+
+import time
+
+RESYNC_INTERVAL = 10 * 1000000000  # ns, refresh the offset to follow wall clock adjustments, eg. NTP.
+
+
+class PCClock():
+    '''
+    Timestamp of the current chunk as 'HH:MM:SS.mmm' local time or int ns since epoch.
+    '''
+    def __init__(self, resync_interval=RESYNC_INTERVAL):
+        self.resync_interval = resync_interval
+        self.offset_ns = 0  # wall clock - monotonic clock
+        self.last_sync = None
+        self.now_ns = 0
+        self.mono_ns = 0  # time.monotonic_ns() of the last sample
+        # format cache
+        self.last_ms = None
+        self.last_sec = None
+        self.sec_text = ''
+        self.text = ''
+        self.sample()
+
+    def sync(self, mono):
+        self.offset_ns = time.time_ns() - mono
+        self.last_sync = mono
+
+    def sample(self):
+        '''
+        take a timestamp, call it once per received chunk.
+        returns: ns since epoch.
+        '''
+        mono = time.monotonic_ns()
+        self.mono_ns = mono
+        if self.last_sync is None or mono - self.last_sync >= self.resync_interval:
+            self.sync(mono)
+        self.now_ns = mono + self.offset_ns
+        return self.now_ns
+
+    def ns(self):
+        '''
+        returns: int ns since epoch of the last sample, used by binary logs.
+        '''
+        return self.now_ns
+
+    def tm_ms(self):
+        '''
+        returns: local time 'HH:MM:SS.mmm' of the last sample, same as
+                 datetime.datetime.now().strftime('%H:%M:%S.%f')[:-3].
+        '''
+        ms = self.now_ns // 1000000
+        if ms == self.last_ms:
+            return self.text
+        sec = ms // 1000
+        if sec != self.last_sec:
+            self.sec_text = time.strftime('%H:%M:%S', time.localtime(sec))
+            self.last_sec = sec
+        self.last_ms = ms
+        self.text = '%s.%03d' % (self.sec_text, ms - sec * 1000)
+        return self.text
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*
+"""
+Log multi-IMUs data in worker processes.
+Each worker process receives and decodes a group of devices with selector_logger, and
+publishes decoded records into its own shared memory ring buffer. The parent process
+supervises the workers, reads the rings without pickling and hands records to apps such
+as AppPainter. Requires python 3.8+ (multiprocessing.shared_memory).
+"""
+
+import sys
+import time
+import datetime
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import application_base
+import app_dispatcher
+import selector_logger
+
+RETRY_INTERVAL = 1.0  # seconds before restarting a dead worker, same as imu_logger.run().
+POLL_INTERVAL = 0.01  # seconds between reads of the rings in parent process.
+RING_CAPACITY = 8192  # records per ring.
+MAX_FIELDS = 16  # max fields of a record.
+HEADER_SIZE = 64
+
+RECORD_DTYPE = np.dtype([
+    ('seq', '<u8'),          # index of record + 1, 0 while the record is being written.
+    ('pc_time_ns', '<i8'),
+    ('sn', '<u8'),
+    ('packet_type', 'S2'),
+    ('count', '<u2'),        # number of valid values.
+    ('device', '<u4'),       # index of device in ProcessLogger, selects the apps of the record.
+    ('values', '<f8', (MAX_FIELDS,)),
+    ])
+
+
+class SharedRing():
+    '''
+    Single producer process ring buffer of fixed-size records in shared memory.
+    Devices of a worker publish from the threads of their apps, publish() is serialized by a lock of the process.
+    The producer never waits for consumers, a consumer which falls behind more than capacity records loses the oldest ones.
+    Header: write index (uint64), capacity (uint64).
+    '''
+    def __init__(self, capacity=RING_CAPACITY, name=None):
+        self.owner = name is None
+        if self.owner:
+            size = HEADER_SIZE + capacity * RECORD_DTYPE.itemsize
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.lock = threading.Lock()  # not shared, each worker process is the only producer of its ring.
+        self.header = np.ndarray((2,), dtype='<u8', buffer=self.shm.buf)
+        if self.owner:
+            self.header[0] = 0
+            self.header[1] = capacity
+        self.capacity = int(self.header[1])
+        self.records = np.ndarray((self.capacity,), dtype=RECORD_DTYPE, buffer=self.shm.buf, offset=HEADER_SIZE)
+
+    def __getstate__(self):
+        # pickled when worker processes are spawned instead of forked, attach by name then.
+        return {'name': self.name}
+
+    def __setstate__(self, state):
+        self.__init__(name=state['name'])
+
+    def publish(self, pc_time_ns, sn, packet_type, values, device=0):
+        '''
+        append one decoded record.
+        '''
+        count = min(len(values), MAX_FIELDS)
+        with self.lock:
+            n = int(self.header[0])
+            rec = self.records[n % self.capacity]  # a view of the record
+            rec['seq'] = 0
+            rec['pc_time_ns'] = pc_time_ns
+            rec['sn'] = sn
+            rec['packet_type'] = packet_type.encode()
+            rec['count'] = count
+            rec['device'] = device
+            rec['values'][:count] = values[:count]
+            rec['seq'] = n + 1
+            self.header[0] = n + 1
+
+    def read(self, cursor):
+        '''
+        copy records published since cursor.
+        returns: (records, new cursor, number of lost records)
+        '''
+        end = int(self.header[0])
+        lost = 0
+        if end - cursor > self.capacity:
+            lost = end - cursor - self.capacity
+            cursor = end - self.capacity
+        if end == cursor:
+            return self.records[:0].copy(), cursor, lost
+        seq = np.arange(cursor, end, dtype=np.uint64)
+        slots = seq % self.capacity
+        records = self.records[slots]
+        # seqlock: a record is valid if its seq is cursor + 1 before and after the copy,
+        # records overwritten or partly written by the producer meanwhile are dropped.
+        ok = (records['seq'] == seq + 1) & (self.records['seq'][slots] == seq + 1)
+        lost += int(len(ok) - np.count_nonzero(ok))
+        return records[ok], end, lost
+
+    def close(self):
+        self.header = None
+        self.records = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class RingPublisher(application_base.ApplicationBase):
+    '''
+    App running in worker process, publishes messages of a device of IMULogger into a SharedRing.
+    Records keep their PC timestamp, not the time they are published at.
+    '''
+    def __init__(self, ring, device=0):
+        self.ring = ring
+        self.device = device
+        self.last_sec = None  # 'HH:MM:SS' of last record
+        self.sec_ns = 0
+
+    def pc_time_ns(self, pc_tm):
+        '''
+        returns: ns since epoch of pc_tm 'HH:MM:SS.mmm', local time of today or of yesterday before midnight.
+        '''
+        sec = pc_tm[:8]
+        if sec != self.last_sec:
+            now = time.time()
+            t = time.localtime(now)
+            h, m, s = sec.split(':')
+            base = time.mktime((t.tm_year, t.tm_mon, t.tm_mday, int(h), int(m), int(s), 0, 0, -1))
+            if base > now + 43200:
+                base -= 86400
+            self.last_sec = sec
+            self.sec_ns = int(base) * 1000000000
+        return self.sec_ns + int(pc_tm[9:12]) * 1000000
+
+    def on_message(self, *args):
+        msg = args[0]
+        values = [v for k, v in msg['data'].items() if k != 'pc_tm']
+        self.ring.publish(self.pc_time_ns(msg['data']['pc_tm']), msg['sn'], msg['type'], values, self.device)
+
+    def on_messages(self, batch):
+        for record in batch:
+            self.ring.publish(self.pc_time_ns(record.pc_tm), record.sn, record.type, record.values, self.device)
+
+
+def worker_main(args, ring):
+    '''
+    entry of worker process, args: list of (device, port, baud, b_rst) of devices in this worker.
+    '''
+    engine = selector_logger.SelectorLogger()
+    for device, port, baud, b_rst in args:
+        engine.add_serial_port(port, baud, b_rst, (RingPublisher(ring, device),))
+    engine.run()
+
+
+def to_record(record):
+    '''
+    build an app_dispatcher.Record from a ring record.
+    '''
+    packet_type = record['packet_type'].decode()
+    pc_tm = datetime.datetime.fromtimestamp(record['pc_time_ns'] / 1e9).strftime('%H:%M:%S.%f')[:-3]
+    values = tuple(record['values'][:record['count']].tolist())
+    # version is not shared by workers.
+    return app_dispatcher.Record(int(record['sn']), None, packet_type, pc_tm, values, app_dispatcher.field_index(packet_type))
+
+
+class ProcessLogger():
+    '''
+    Supervise worker processes and dispatch their records to apps.
+    '''
+    def __init__(self, groups, apps=None, capacity=RING_CAPACITY):
+        '''
+        groups: list of device groups, each group is a list of (port, baud, b_rst, apps) and runs in one worker.
+                apps of a device get only its records, same as imu_logger.run().
+        apps: apps of all devices.
+        '''
+        self.groups = []  # (device, port, baud, b_rst) of devices in each worker.
+        self.channels = []  # channels of apps of each device, apps run on their own threads.
+        for group in groups:
+            self.groups.append([])
+            for arg in group:
+                device = len(self.channels)
+                self.groups[-1].append((device, arg[0], arg[1], arg[2] if len(arg) > 2 else False))
+                device_apps = list(arg[3]) if len(arg) > 3 and arg[3] else []
+                device_apps += [app for app in apps or [] if app not in device_apps]
+                self.channels.append([app_dispatcher.get_channel(app) for app in device_apps])
+        self.rings = [SharedRing(capacity) for _ in groups]
+        self.processes = [None] * len(groups)
+        self.next_start = [0.0] * len(groups)
+        self.cursors = [0] * len(groups)
+        self.lost = [0] * len(groups)  # records lost because parent falls behind.
+        self.restarts = [0] * len(groups)
+        self.running = False
+
+    def supervise(self):
+        '''
+        start workers which are not running, restart dead workers after RETRY_INTERVAL.
+        '''
+        now = time.time()
+        for i, p in enumerate(self.processes):
+            if p is not None and p.is_alive():
+                continue
+            if p is not None:
+                p.join()
+                self.processes[i] = None
+                self.next_start[i] = now + RETRY_INTERVAL
+                self.restarts[i] += 1
+                print("Worker[{0}] exit with code {1}, retry start_collection ...".format(i, p.exitcode))
+                sys.stdout.flush()
+            if now >= self.next_start[i]:
+                p = multiprocessing.Process(target=worker_main, args=(self.groups[i], self.rings[i]))
+                p.daemon = True
+                p.start()
+                self.processes[i] = p
+                print("Worker[{0}({1})] start at:[{2}].".format(i, p.pid, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+
+    def read_records(self, i):
+        '''
+        returns: new records of worker i.
+        '''
+        records, self.cursors[i], lost = self.rings[i].read(self.cursors[i])
+        self.lost[i] += lost
+        return records
+
+    def dispatch(self):
+        for i in range(len(self.rings)):
+            records = self.read_records(i)
+            for record in records:
+                channels = self.channels[record['device']]
+                if not channels:
+                    continue
+                record = to_record(record)
+                for channel in channels:
+                    channel.publish(record)
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        '''
+        returns False when user trigger KeyboardInterrupt to stop this program.
+        otherwise returns True.
+        '''
+        self.running = True
+        try:
+            while self.running:
+                self.supervise()
+                self.dispatch()
+                time.sleep(POLL_INTERVAL)
+        except KeyboardInterrupt:  # response for KeyboardInterrupt such as Ctrl+C
+            print('User stop this program by KeyboardInterrupt! File:[{0}], Line:[{1}]'.format(__file__, sys._getframe().f_lineno))
+            return False
+        finally:
+            self.close()
+        return True
+
+    def close(self):
+        for p in self.processes:
+            if p is not None and p.is_alive():
+                p.terminate()
+                p.join()
+        self.processes = [None] * len(self.groups)
+        for ring in self.rings:
+            ring.close()
+        self.rings = []
+
+
+def run(args, processes=None):
+    '''
+    wrapper, args: list of (port, baud, b_rst, apps) same as imu_logger.run().
+    processes: number of worker processes, default one per device. Devices are assigned round robin.
+    Apps run in the parent process and get the records of their own devices.
+    '''
+    processes = len(args) if processes is None else max(1, min(processes, len(args)))
+    groups = [[] for _ in range(processes)]
+    for i, arg in enumerate(args):
+        groups[i % processes].append(arg)
+    return ProcessLogger(groups).run()
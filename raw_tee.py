@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*
+"""
+Raw byte tee of live sessions with a frame index.
+Every received byte is appended to a .bin file, so sessions can be re-decoded later,
+eg. with bin_decoder.py, even when frames had CRC or decode errors.
+The sidecar .idx file has one fixed-width record per good frame:
+    offset of 'UU' in the .bin file (uint64) + pc_time_ns (int64) + packet type (2 bytes) + frame len (uint16)
+all little endian, after an 8 bytes MAGIC. It is loaded with numpy, and find_offset() seeks by time.
+With rotation, see data_sink.open_sink(), .bin and .idx are split into segments together, eg.
+data/raw.0001.bin.gz and data/raw.0001.idx.gz, listed in data/raw.manifest.jsonl. Offsets of an index
+segment are in its .bin segment, and a frame cut by rotation is repeated at the start of the next
+segment, so each segment can be decoded alone.
+"""
+
+import os
+import re
+import time
+import struct
+import numpy as np
+import data_sink
+
+MAGIC = b'IMUIDX1\n'
+EXTENSION = '.idx'
+RAW_FLUSH_BYTES = 1024*1024  # raw bytes are written in large blocks.
+INDEX_DTYPE = np.dtype([('offset', '<u8'), ('pc_time_ns', '<i8'), ('packet_type', 'S2'), ('length', '<u2')])
+
+_RECORD = struct.Struct('<Qq2sH')
+_SEGMENT = re.compile(r'(.*\.\d{4})\.bin((?:\.gz|\.xz)?)$')
+
+
+def index_name(bin_name):
+    '''
+    data/raw.bin -> data/raw.bin.idx, segments: data/raw.0001.bin.gz -> data/raw.0001.idx.gz
+    '''
+    m = _SEGMENT.match(bin_name)
+    if m:
+        return m.group(1) + EXTENSION + m.group(2)
+    return bin_name + EXTENSION
+
+
+def open_file(file_name):
+    '''
+    open a plain or compressed segment for reading.
+    '''
+    for open_func, suffix in data_sink.COMPRESSIONS.values():
+        if suffix and file_name.endswith(suffix):
+            return open_func(file_name, 'rb')
+    return open(file_name, 'rb')
+
+
+class RawTee():
+    '''
+    Append raw bytes to a .bin file and good frames to its index, both through the sinks of data_sink.
+    mode: 'wb', or 'ab' to continue a tee closed before, eg. when the device reconnects.
+    rotation: None for one .bin and .idx, or the rotation of data_sink.open_sink(), the tee starts the
+              next segments of both when the .bin segment exceeds max_bytes or max_seconds.
+    '''
+    def __init__(self, file_name, flush_bytes=RAW_FLUSH_BYTES, flush_interval=data_sink.FLUSH_INTERVAL, rotation=None, mode='wb'):
+        self.file_name = file_name
+        self.rotation = rotation
+        self.offset = 0  # bytes written to .bin, or to the current .bin segment
+        self.frames = 0
+        if rotation is None:
+            if 'a' in mode and os.path.exists(file_name):
+                self.offset = os.path.getsize(file_name)
+            index_file = index_name(file_name)
+            new_index = 'a' not in mode or not os.path.exists(index_file) or os.path.getsize(index_file) == 0
+            self.raw = data_sink.BufferedSink(file_name, mode, flush_bytes, flush_interval)
+            self.index = data_sink.BufferedSink(index_file, mode, flush_bytes, flush_interval)
+            if new_index:
+                self.index.write(MAGIC)
+            return
+        self.max_bytes = rotation.get('max_bytes', data_sink.ROTATE_BYTES)
+        self.max_seconds = rotation.get('max_seconds', data_sink.ROTATE_SECONDS)
+        self.segment_start = time.time()
+        # segments are started by the tee, not by size or age of each sink, so they stay aligned.
+        sink_rotation = dict(rotation, max_bytes=float('inf'), max_seconds=0)
+        root = os.path.splitext(file_name)[0]  # .bin and .idx share root.manifest.jsonl
+        self.raw = data_sink.open_sink(file_name, mode, flush_bytes, flush_interval, dict(sink_rotation, header=False))
+        self.index = data_sink.open_sink(root + EXTENSION, mode, flush_bytes, flush_interval, sink_rotation)
+        self.index.write(MAGIC)  # repeated at the start of every index segment.
+
+    def rotation_due(self):
+        '''
+        returns: True if the current segments should be closed before more bytes are written.
+        '''
+        if self.rotation is None or not self.offset:
+            return False
+        return self.offset >= self.max_bytes or (self.max_seconds and time.time() - self.segment_start >= self.max_seconds)
+
+    def next_segment(self, pending=b''):
+        '''
+        close the current segments of .bin and .idx and start the next ones.
+        pending: bytes of a frame cut by rotation, repeated at the start of the next .bin segment.
+        '''
+        self.raw.next_segment()
+        self.index.next_segment()
+        self.segment_start = time.time()
+        self.offset = 0
+        if pending:
+            self.write(pending)
+
+    def write(self, data):
+        self.raw.write(data)
+        self.offset += len(data)
+
+    def add_frame(self, offset, frame, pc_time_ns):
+        '''
+        index a good frame which starts at offset of the .bin file.
+        '''
+        self.index.write(_RECORD.pack(offset, pc_time_ns, frame[2:4], len(frame)))
+        self.frames += 1
+
+    def poll(self):
+        self.raw.poll()
+        self.index.poll()
+
+    def flush(self):
+        self.raw.flush()
+        self.index.flush()
+
+    def close(self):
+        self.raw.close()
+        self.index.close()
+
+
+def load_index(bin_name):
+    '''
+    returns: structured array of INDEX_DTYPE, empty if the index does not exist.
+    '''
+    name = index_name(bin_name)
+    if not os.path.exists(name):
+        return np.zeros(0, dtype=INDEX_DTYPE)
+    with open_file(name) as f:
+        data = f.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError('{0} is not a frame index.'.format(name))
+    count = (len(data) - len(MAGIC)) // INDEX_DTYPE.itemsize  # ignore a partly written last record.
+    return np.frombuffer(data, dtype=INDEX_DTYPE, count=count, offset=len(MAGIC))
+
+
+def find_offset(index, pc_time_ns):
+    '''
+    returns: offset of the first indexed frame at or after pc_time_ns, None if there is none.
+    '''
+    i = np.searchsorted(index['pc_time_ns'], pc_time_ns)
+    return int(index['offset'][i]) if i < len(index) else None
+
+
+def read_range(bin_name, index, start_ns, end_ns=None):
+    '''
+    returns: raw bytes of the .bin file from the first frame at or after start_ns
+             up to the first frame at or after end_ns (or the end of file).
+    '''
+    start = find_offset(index, start_ns)
+    if start is None:
+        return b''
+    end = find_offset(index, end_ns) if end_ns is not None else None
+    with open_file(bin_name) as f:
+        f.seek(start)
+        return f.read() if end is None else f.read(end - start)
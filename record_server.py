@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*
+"""
+Fan out decoded records of IMULoggers to local subscribers over a Unix or TCP socket.
+RecordPublisher is an app: add it to one or more loggers, the parser only queues records on its
+AppChannel, and each record is encoded once on the channel thread and queued to every subscriber.
+Every subscriber has a bounded queue and its own sender thread; one which can not keep up is
+sampled (records are skipped while its queue is full) or dropped, it never slows the parser.
+
+Protocol, integers are little endian:
+    subscriber -> server, once after connect, one JSON line, eg. {"rate": 10, "types": ["A1"], "policy": "sample"}
+        rate: max records/s of each stream, decimated by the server, 0: all records.
+        types: packet types to receive, empty: all.
+        policy: 'sample' skips records while the subscriber is behind, 'drop' disconnects it.
+    server -> subscriber, messages of kind(B) + body len(H) + body:
+        SCHEMA(1): JSON {"stream", "sn", "version", "type", "fields", "units"}, before the first record of a stream.
+        RECORD(2): stream(H) + PC time in ms of day(I) + one float64 per field.
+
+Usage:
+    publisher = record_server.RecordPublisher()
+    publisher.serve_unix('/tmp/imu_records.sock')  # and/or publisher.serve_tcp('127.0.0.1', 9000)
+    logger.add_app(publisher)
+
+    python record_server.py /tmp/imu_records.sock --rate 10 --types A1
+"""
+
+import os
+import sys
+import json
+import socket
+import struct
+import argparse
+import threading
+import collections
+import application_base
+import app_dispatcher
+import packet_decoder
+
+SCHEMA = 1
+RECORD = 2
+POLICIES = ('sample', 'drop')
+MAX_SUBSCRIBER_BYTES = 1024*1024  # bytes queued per subscriber before it is sampled or dropped.
+HELLO_TIMEOUT = 1.0  # seconds to wait for the subscribe line, defaults are used after it.
+MAX_HELLO_BYTES = 4096
+_MESSAGE = struct.Struct('<BH')  # kind, body len
+_RECORD = struct.Struct('<HI')  # stream, ms of day
+
+
+def pc_tm_ms(pc_tm):
+    '''
+    'HH:MM:SS.mmm' -> ms of day.
+    '''
+    return ((int(pc_tm[0:2]) * 60 + int(pc_tm[3:5])) * 60 + int(pc_tm[6:8])) * 1000 + int(pc_tm[9:12])
+
+
+def ms_pc_tm(ms):
+    '''
+    ms of day -> 'HH:MM:SS.mmm'.
+    '''
+    sec, ms = divmod(ms, 1000)
+    return '%02d:%02d:%02d.%03d' % (sec // 3600, sec // 60 % 60, sec % 60, ms)
+
+
+class Stream():
+    '''
+    Records of one (sn, version, packet type), with its precompiled record struct and schema message.
+    '''
+    def __init__(self, stream_id, sn, version, packet_type, fields):
+        self.id = stream_id
+        self.packet_type = packet_type
+        self.record = struct.Struct('<BHHI{0}d'.format(len(fields)))
+        self.body_len = self.record.size - _MESSAGE.size
+        fmt = packet_decoder.PACKET_FORMATS.get(packet_type)
+        body = json.dumps({
+            'stream': stream_id,
+            'sn': sn,
+            'version': version,
+            'type': packet_type,
+            'fields': list(fields),
+            'units': list(fmt.units) if fmt is not None and fmt.units is not None else None,
+            }).encode()
+        self.schema = _MESSAGE.pack(SCHEMA, len(body)) + body
+
+    def encode(self, ms, values):
+        return self.record.pack(RECORD, self.body_len, self.id, ms, *values)
+
+
+class Subscriber():
+    '''
+    One connected subscriber: its filter, decimation state and a bounded byte queue written by its own thread.
+    '''
+    def __init__(self, publisher, conn, name, max_bytes=MAX_SUBSCRIBER_BYTES):
+        self.publisher = publisher
+        self.conn = conn
+        self.name = name
+        self.max_bytes = max_bytes
+        self.interval = 0  # ms between records of a stream, 0: all records
+        self.types = None  # set of packet types, None: all
+        self.policy = 'sample'
+        self.last_ms = {}  # stream id -> ms of the last record queued
+        self.schemas = set()  # stream ids whose schema was queued
+        self.chunks = collections.deque()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.alive = True
+        # statistics
+        self.queued_records = 0
+        self.skipped_records = 0  # skipped while the queue was full
+        self.sent_bytes = 0
+        self.thread = threading.Thread(target=self.run, name='subscriber-' + name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def hello(self):
+        '''
+        read the subscribe line, keep defaults if none comes within HELLO_TIMEOUT.
+        '''
+        self.conn.settimeout(HELLO_TIMEOUT)
+        line = b''
+        try:
+            while not line.endswith(b'\n') and len(line) < MAX_HELLO_BYTES:
+                data = self.conn.recv(MAX_HELLO_BYTES - len(line))
+                if not data:
+                    break
+                line += data
+        except socket.timeout:
+            pass
+        self.conn.settimeout(None)
+        if not line.strip():
+            return
+        request = json.loads(line.decode())
+        rate = float(request.get('rate') or 0)
+        self.interval = 1000.0 / rate if rate > 0 else 0
+        self.types = set(request['types']) if request.get('types') else None
+        self.policy = request.get('policy', 'sample')
+        if self.policy not in POLICIES:
+            raise ValueError('Unknown policy {0}, must be one of {1}.'.format(self.policy, POLICIES))
+
+    def put(self, data, records=0):
+        '''
+        queue encoded messages, schemas are always queued (records=0).
+        returns: False if records were skipped or the subscriber was dropped because its queue is full.
+        '''
+        with self.lock:
+            if not self.alive:
+                return False
+            if not records or self.size + len(data) <= self.max_bytes:
+                self.chunks.append(data)
+                self.size += len(data)
+                self.queued_records += records
+                self.not_empty.notify()
+                return True
+            if self.policy == 'sample':
+                self.skipped_records += records
+                return False
+        print('Subscriber {0} is too slow, dropped.'.format(self.name))
+        self.close()
+        return False
+
+    def run(self):
+        try:
+            self.hello()
+            self.publisher.add_subscriber(self)
+            while True:
+                with self.lock:
+                    while self.alive and not self.chunks:
+                        self.not_empty.wait()
+                    if not self.alive:
+                        return
+                    data = b''.join(self.chunks)
+                    self.chunks.clear()
+                    self.size = 0
+                self.conn.sendall(data)
+                self.sent_bytes += len(data)
+        except Exception as e:
+            print('Subscriber {0} closed: {1}'.format(self.name, e))
+        finally:
+            self.close()
+
+    def close(self):
+        with self.lock:
+            self.alive = False
+            self.not_empty.notify_all()
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)  # wake the sender thread if it is blocked in sendall().
+        except Exception:
+            pass
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+
+    def stats(self):
+        return {
+            'name': self.name,
+            'rate': 1000.0 / self.interval if self.interval else 0,
+            'types': sorted(self.types) if self.types else None,
+            'policy': self.policy,
+            'queued_records': self.queued_records,
+            'skipped_records': self.skipped_records,
+            'queued_bytes': self.size,
+            'sent_bytes': self.sent_bytes,
+            }
+
+
+class RecordPublisher(application_base.ApplicationBase):
+    '''
+    App which streams the records of its loggers to subscribers of serve_unix() and serve_tcp().
+    '''
+    def __init__(self, max_subscriber_bytes=MAX_SUBSCRIBER_BYTES):
+        self.max_subscriber_bytes = max_subscriber_bytes
+        self.subscribers = []
+        self.streams = {}  # (sn, version, packet type) -> Stream
+        self.servers = []  # (listening socket, unix path or None)
+        self.lock = threading.Lock()
+        self.running = True
+        self.last_pc_tm = None  # records of one chunk share pc_tm, it is parsed once.
+        self.last_ms = 0
+        # statistics
+        self.published = 0
+
+    def serve_unix(self, path):
+        '''
+        accept subscribers on Unix socket path, requires POSIX.
+        returns: path.
+        '''
+        if os.path.exists(path):
+            os.unlink(path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(16)
+        self.start_server(server, path)
+        print('Publish records on unix://{0}'.format(path))
+        return path
+
+    def serve_tcp(self, host='127.0.0.1', port=0):
+        '''
+        accept subscribers on a TCP port, 0: any free port.
+        returns: the listening port.
+        '''
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host, port))
+        server.listen(16)
+        self.start_server(server, None)
+        port = server.getsockname()[1]
+        print('Publish records on tcp://{0}:{1}'.format(host, port))
+        return port
+
+    def start_server(self, server, path):
+        self.servers.append((server, path))
+
+        def accept():
+            while self.running:
+                try:
+                    conn, addr = server.accept()
+                except OSError:
+                    return  # closed by close()
+                if conn.family != socket.AF_UNIX:
+                    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    name = '{0}:{1}'.format(*addr)
+                else:
+                    name = '{0}#{1}'.format(path, conn.fileno())
+                Subscriber(self, conn, name, self.max_subscriber_bytes)
+
+        t = threading.Thread(target=accept, name='publisher-accept')
+        t.daemon = True
+        t.start()
+
+    def add_subscriber(self, subscriber):
+        with self.lock:
+            self.subscribers.append(subscriber)
+        print('Subscriber {0} connected, rate: {1}, types: {2}, policy: {3}.'.format(
+            subscriber.name, 1000.0 / subscriber.interval if subscriber.interval else 'all',
+            sorted(subscriber.types) if subscriber.types else 'all', subscriber.policy))
+
+    def stream_of(self, record):
+        key = (record[0], record[1], record[2])
+        stream = self.streams.get(key)
+        if stream is None:
+            stream = Stream(len(self.streams), record[0], record[1], record[2], tuple(record[5]))
+            self.streams[key] = stream
+        return stream
+
+    def on_message(self, *args):
+        msg = args[0]
+        data = msg['data']
+        values = tuple(v for k, v in data.items() if k != 'pc_tm')
+        self.on_messages([app_dispatcher.Record(msg['sn'], msg['version'], msg['type'], data['pc_tm'], values,
+                                                app_dispatcher.field_index(msg['type']))])
+
+    def on_messages(self, batch):
+        '''
+        encode each record at most once, decimate and filter it per subscriber, queue one block per subscriber.
+        '''
+        self.published += len(batch)
+        with self.lock:
+            self.subscribers = [s for s in self.subscribers if s.alive]
+            subscribers = list(self.subscribers)
+        if not subscribers:
+            return
+        blocks = dict((s, []) for s in subscribers)
+        for record in batch:
+            pc_tm = record[3]
+            if pc_tm != self.last_pc_tm:
+                self.last_pc_tm = pc_tm
+                self.last_ms = pc_tm_ms(pc_tm)
+            ms = self.last_ms
+            stream = self.stream_of(record)
+            message = None
+            for s in subscribers:
+                if s.types is not None and stream.packet_type not in s.types:
+                    continue
+                if s.interval:
+                    last = s.last_ms.get(stream.id)
+                    if last is not None and 0 <= ms - last < s.interval:
+                        continue
+                    s.last_ms[stream.id] = ms
+                if stream.id not in s.schemas:
+                    s.schemas.add(stream.id)
+                    s.put(stream.schema)
+                if message is None:
+                    message = stream.encode(ms, record[4])
+                blocks[s].append(message)
+        for s, messages in blocks.items():
+            if messages:
+                s.put(b''.join(messages), len(messages))
+
+    def close(self):
+        self.running = False
+        for server, path in self.servers:
+            server.close()
+            if path and os.path.exists(path):
+                os.unlink(path)
+        self.servers = []
+        with self.lock:
+            subscribers, self.subscribers = self.subscribers, []
+        for s in subscribers:
+            s.close()
+
+    def stats(self):
+        return {
+            'published': self.published,
+            'streams': len(self.streams),
+            'subscribers': [s.stats() for s in self.subscribers],
+            }
+
+
+def connect(address):
+    '''
+    address: path of a Unix socket, 'host:port' or (host, port).
+    '''
+    if isinstance(address, str) and ':' in address and not os.path.exists(address):
+        host, _, port = address.rpartition(':')
+        address = (host, int(port))
+    if isinstance(address, tuple):
+        return socket.create_connection(address)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(address)
+    return sock
+
+
+def subscribe(address, rate=0, types=None, policy='sample'):
+    '''
+    connect to a RecordPublisher and iterate its records as app_dispatcher.Record,
+    pc_tm is rebuilt as 'HH:MM:SS.mmm' and all values are floats.
+    '''
+    sock = connect(address)
+    sock.sendall(json.dumps({'rate': rate, 'types': types or [], 'policy': policy}).encode() + b'\n')
+    f = sock.makefile('rb')
+    streams = {}  # stream id -> (sn, version, type, field index, struct of values)
+    try:
+        while True:
+            head = f.read(_MESSAGE.size)
+            if len(head) < _MESSAGE.size:
+                return
+            kind, n = _MESSAGE.unpack(head)
+            body = f.read(n)
+            if len(body) < n:
+                return
+            if kind == SCHEMA:
+                s = json.loads(body.decode())
+                index = collections.OrderedDict((name, i) for i, name in enumerate(s['fields']))
+                streams[s['stream']] = (s['sn'], s['version'], s['type'], index, struct.Struct('<{0}d'.format(len(index))))
+            elif kind == RECORD:
+                stream_id, ms = _RECORD.unpack_from(body)
+                sn, version, packet_type, index, values = streams[stream_id]
+                yield app_dispatcher.Record(sn, version, packet_type, ms_pc_tm(ms), values.unpack_from(body, _RECORD.size), index)
+    finally:
+        f.close()
+        sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print records of a RecordPublisher.')
+    parser.add_argument('address', help='path of Unix socket or host:port')
+    parser.add_argument('--rate', type=float, default=0, help='max records/s per stream, 0: all')
+    parser.add_argument('--types', default='', help='packet types, eg. A1,S1, empty: all')
+    parser.add_argument('--policy', default='sample', choices=POLICIES)
+    args = parser.parse_args()
+    types = [t for t in args.types.split(',') if t]
+    try:
+        for record in subscribe(args.address, args.rate, types, args.policy):
+            print('{0} {1} {2}'.format(record.pc_tm, record.type, ','.join('%g' % v for v in record.values)))
+            sys.stdout.flush()
+    except KeyboardInterrupt:  # response for KeyboardInterrupt such as Ctrl+C
+        print('User stop this program by KeyboardInterrupt! File:[{0}], Line:[{1}]'.format(__file__, sys._getframe().f_lineno))
+
+
+if __name__ == '__main__':
+    main()
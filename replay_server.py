@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*
+"""
+Replay a recorded capture over local TCP and/or pseudo terminals.
+
+Captures:
+    .imubin     binary logs of imu_logger, frames are rebuilt and timed by pc_time_ns.
+    'UU' .bin   raw IMU captures, timed by the ITOW/Counter field of frames,
+                or by --rate when frames have no time field.
+    other       raw captures, eg. of cpt7_short.py, replayed in chunks at --bps bytes/s.
+
+Speed: 1 is real time, N is N times real time, 0 is as fast as possible.
+Every client gets the same stream from the current position. At speed 0 the replay waits for
+the slowest client, so no data is lost; in timed modes a client which can not keep up loses data
+instead of slowing down others. Captures are memory mapped, so multi-GB files can be replayed.
+Rates are reported every second.
+
+Usage:
+    python replay_server.py capture.bin --tcp 8888 --speed 10
+    python replay_server.py capture.imubin --pty 3 --loop
+"""
+
+import os
+import sys
+import time
+import socket
+import argparse
+import threading
+import collections
+import array
+import numpy as np
+import frame_scanner
+import crc16
+import packet_decoder
+import frame_generator
+import binary_log
+
+TIME_FIELDS = ('itow', 'timeITOW', 'Counter')  # ms fields used to time frames, in order of preference.
+MAX_GAP = 10.0  # seconds, larger or negative jumps of frame time are replaced by the nominal interval.
+RAW_CHUNK = 1024  # bytes per chunk of raw captures.
+SCAN_BLOCK = 1024*1024  # bytes of a capture scanned at once when it is loaded.
+BATCH_BYTES = 64*1024  # max bytes sent in one write.
+MAX_CLIENT_BYTES = 4*1024*1024  # bytes queued per client before dropping, or waiting at speed 0.
+REPORT_INTERVAL = 1.0
+
+
+class Timeline():
+    '''
+    Chunks of a memory mapped capture: timeline[i] is (seconds since start, bytes of data[ends[i-1]:ends[i]]).
+    Only times and end offsets are kept in memory, 16 bytes per chunk, so multi-GB captures can be replayed.
+    '''
+    def __init__(self, data, times, ends):
+        self.data = data
+        self.times = times
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.ends)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.ends)
+        start = self.ends[i - 1] if i else 0
+        return float(self.times[i]), self.data[start:self.ends[i]].tobytes()
+
+
+class ImubinTimeline():
+    '''
+    Frames rebuilt on demand from the memory mapped records of a binary log, timed by their pc_time_ns.
+    '''
+    def __init__(self, packet_type, records):
+        self.packet_type = packet_type
+        self.records = records
+        # records are pc_time_ns + the raw payload of the frame.
+        self.payloads = np.asarray(records).view(np.uint8).reshape(len(records), -1)[:, records.dtype[binary_log.TIME_FIELD].itemsize:]
+        self.start_ns = int(records[binary_log.TIME_FIELD][0]) if len(records) else 0
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.records)
+        t = (int(self.records[binary_log.TIME_FIELD][i]) - self.start_ns) / 1e9
+        return t, frame_generator.build_frame(self.packet_type, self.payloads[i].tobytes())
+
+
+def frame_time_ms(frame, fmt):
+    '''
+    returns: ms time of frame from its first time field, None if it has none.
+    '''
+    for name in TIME_FIELDS:
+        if name in fmt.fields:
+            try:
+                return fmt.unpack(frame)[fmt.fields.index(name)]
+            except Exception:
+                return None
+    return None
+
+
+def load_uu_capture(data, rate):
+    '''
+    split a 'UU' capture, eg. a numpy.memmap, into frames with times in seconds, scanning it block by block.
+    Bytes between frames are kept in front of the next frame.
+    returns: Timeline, None if most candidate frames fail CRC, ie. not an IMU capture.
+    '''
+    scanner = frame_scanner.FrameScanner(payload_lengths=packet_decoder.PAYLOAD_LENGTHS)
+    times = array.array('d')
+    ends = array.array('q')
+    t = 0.0
+    last_ms = None
+    interval = 1.0 / rate
+    good = bad = 0
+    for block_start in range(0, len(data), SCAN_BLOCK):
+        scanner.feed(data[block_start:block_start + SCAN_BLOCK].tobytes())
+        while True:
+            frame = scanner.next_frame()
+            if frame is None:
+                break
+            if not crc16.check_frame(frame):
+                bad += 1
+                scanner.reject()
+                continue  # keep bad frames in front of the next frame, with its time.
+            good += 1
+            fmt = packet_decoder.PACKET_FORMATS.get(frame[2:4].decode('latin-1'))
+            ms = frame_time_ms(frame, fmt) if fmt is not None else None
+            if ends:
+                dt = (ms - last_ms) / 1000.0 if ms is not None and last_ms is not None else interval
+                t += dt if 0 <= dt <= MAX_GAP else interval
+            if ms is not None:
+                last_ms = ms
+            times.append(t)
+            ends.append(scanner.base + scanner.pos)
+        if good <= bad:  # decided by the first block, a raw capture is not scanned to its end.
+            return None
+    if not ends:
+        return None
+    if ends[-1] < len(data):
+        times.append(t)
+        ends.append(len(data))
+    return Timeline(data, np.frombuffer(times, dtype=np.float64), np.frombuffer(ends, dtype=np.int64))
+
+
+def load_raw_capture(data, bps):
+    ends = np.append(np.arange(RAW_CHUNK, len(data), RAW_CHUNK, dtype=np.int64), np.int64(len(data)))
+    return Timeline(data, (ends - np.minimum(ends, RAW_CHUNK)) / float(bps), ends)
+
+
+def load_imubin(file_name):
+    header, records = binary_log.load(file_name)
+    return ImubinTimeline(header['packet_type'], records)
+
+
+def load_capture(file_name, rate=100.0, bps=11520, raw=False):
+    '''
+    returns: Timeline of (seconds since start, bytes), empty if the capture is empty.
+    '''
+    if file_name.endswith(binary_log.EXTENSION):
+        return load_imubin(file_name)
+    if os.path.getsize(file_name) == 0:
+        return []
+    data = np.memmap(file_name, dtype=np.uint8, mode='r')
+    timeline = None if raw else load_uu_capture(data, rate)
+    return timeline if timeline is not None else load_raw_capture(data, bps)
+
+
+class Output():
+    '''
+    One client of the replay: a bounded byte queue and a thread writing it with send.
+    block: when the queue is full, put() waits for the client, used at speed 0 so every client gets the
+           whole capture at the pace of the slowest one. Otherwise new data is dropped and counted, so a
+           slow client can not delay the timing of others.
+    '''
+    def __init__(self, name, send, close, block=False):
+        self.name = name
+        self.send = send
+        self.close_func = close
+        self.block = block
+        self.chunks = collections.deque()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.alive = True
+        self.sent_bytes = 0
+        self.dropped_bytes = 0
+        self.thread = threading.Thread(target=self.loop, name='replay-' + name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, data):
+        with self.lock:
+            if self.size and self.size + len(data) > MAX_CLIENT_BYTES:
+                if not self.block:
+                    self.dropped_bytes += len(data)
+                    return
+                while self.alive and self.size and self.size + len(data) > MAX_CLIENT_BYTES:
+                    self.not_full.wait()
+            if not self.alive:
+                return
+            self.chunks.append(data)
+            self.size += len(data)
+            self.not_empty.notify()
+
+    def loop(self):
+        try:
+            while True:
+                with self.lock:
+                    while self.alive and not self.chunks:
+                        self.not_empty.wait()
+                    if not self.alive:
+                        return
+                    data = b''.join(self.chunks)
+                    self.chunks.clear()
+                    self.size = 0
+                    self.not_full.notify_all()
+                self.send(data)
+                self.sent_bytes += len(data)
+        except Exception as e:
+            print('Client {0} closed: {1}'.format(self.name, e))
+        finally:
+            self.close()
+
+    def close(self):
+        with self.lock:
+            if not self.alive:
+                return
+            self.alive = False
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+        try:
+            self.close_func()
+        except Exception:
+            pass
+
+
+class ReplayServer():
+    def __init__(self, timeline, speed=1.0, loop=False):
+        self.timeline = timeline
+        self.speed = speed
+        self.loop = loop
+        self.outputs = []
+        self.lock = threading.Lock()
+        self.exit_event = threading.Event()
+        self.sent_frames = 0
+        self.sent_bytes = 0
+
+    def add_output(self, output):
+        with self.lock:
+            self.outputs.append(output)
+        print('Client {0} connected.'.format(output.name))
+
+    def serve_tcp(self, host, port):
+        '''
+        accept TCP clients in a daemon thread.
+        returns: the listening port.
+        '''
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host, port))
+        server.listen(16)
+
+        def accept():
+            while not self.exit_event.is_set():
+                conn, addr = server.accept()
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.add_output(Output('{0}:{1}'.format(*addr), conn.sendall, conn.close, self.speed <= 0))
+
+        t = threading.Thread(target=accept, name='replay-accept')
+        t.daemon = True
+        t.start()
+        print('Replay on tcp://{0}:{1}'.format(host, server.getsockname()[1]))
+        return server.getsockname()[1]
+
+    def open_pty(self):
+        '''
+        create a pseudo terminal, open its slave name with communicator.SerialPort.
+        returns: slave name.
+        '''
+        import pty
+        import tty
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        name = os.ttyname(slave)
+        self.add_output(Output(name, lambda data: os.write(master, data), lambda: os.close(master), self.speed <= 0))
+        print('Replay on {0}'.format(name))
+        return name
+
+    def broadcast(self, data):
+        with self.lock:
+            self.outputs = [o for o in self.outputs if o.alive]
+            outputs = list(self.outputs)
+        for o in outputs:
+            o.put(data)
+
+    def wait_clients(self, n):
+        while len(self.outputs) < n and not self.exit_event.is_set():
+            time.sleep(0.05)
+
+    def report(self, start, media_time, last):
+        now = time.time()
+        frames, nbytes, t = last
+        dt = now - t
+        dropped = sum(o.dropped_bytes for o in self.outputs)
+        print('[{0}] clients: {1}, {2:.0f} frames/s, {3:.1f} KB/s, speed: {4:.2f}x, dropped: {5} bytes'.format(
+            time.strftime('%H:%M:%S'), len(self.outputs),
+            (self.sent_frames - frames) / dt, (self.sent_bytes - nbytes) / dt / 1024.0,
+            media_time / (now - start) if now > start else 0.0, dropped))
+        sys.stdout.flush()
+        return self.sent_frames, self.sent_bytes, now
+
+    def run(self):
+        '''
+        replay the timeline once, or forever if loop, until stop().
+        '''
+        while not self.exit_event.is_set():
+            start = time.time()
+            last = (self.sent_frames, self.sent_bytes, start)
+            batch = []
+            batch_bytes = 0
+            i = 0
+            n = len(self.timeline)
+            while i < n and not self.exit_event.is_set():
+                t, data = self.timeline[i]
+                if self.speed > 0:
+                    due = start + t / self.speed
+                    delay = due - time.time()
+                    if delay > 0:
+                        if batch:  # send frames which are due before sleeping.
+                            self.broadcast(b''.join(batch))
+                            batch, batch_bytes = [], 0
+                        self.exit_event.wait(min(delay, REPORT_INTERVAL))
+                        if time.time() - last[2] >= REPORT_INTERVAL:
+                            last = self.report(start, t, last)
+                        continue
+                batch.append(data)
+                batch_bytes += len(data)
+                self.sent_frames += 1
+                self.sent_bytes += len(data)
+                i += 1
+                if batch_bytes >= BATCH_BYTES:
+                    self.broadcast(b''.join(batch))
+                    batch, batch_bytes = [], 0
+                if time.time() - last[2] >= REPORT_INTERVAL:
+                    last = self.report(start, t, last)
+            if batch:
+                self.broadcast(b''.join(batch))
+            self.report(start, self.timeline[-1][0] if self.timeline else 0.0, last)
+            if not self.loop:
+                break
+
+    def stop(self):
+        self.exit_event.set()
+        for o in list(self.outputs):
+            o.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recorded capture over TCP or pty.')
+    parser.add_argument('capture', help='.bin, .imubin or raw capture')
+    parser.add_argument('--tcp', type=int, help='TCP port to listen on, 0: any free port')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--pty', type=int, default=0, help='number of pseudo terminals to create')
+    parser.add_argument('--speed', type=float, default=1.0, help='1: real time, N: N times, 0: as fast as possible')
+    parser.add_argument('--rate', type=float, default=100.0, help='frames/s of frames without a time field')
+    parser.add_argument('--bps', type=float, default=11520, help='bytes/s of raw captures at speed 1')
+    parser.add_argument('--raw', action='store_true', help='do not split the capture into frames')
+    parser.add_argument('--clients', type=int, default=1, help='wait for this many clients before start')
+    parser.add_argument('--loop', action='store_true', help='repeat the capture until Ctrl+C')
+    args = parser.parse_args()
+
+    timeline = load_capture(args.capture, args.rate, args.bps, args.raw)
+    if not timeline:
+        print('{0} is empty.'.format(args.capture))
+        return
+    print('Loaded {0} frames/chunks, {1:.1f} seconds.'.format(len(timeline), timeline[-1][0]))
+
+    server = ReplayServer(timeline, args.speed, args.loop)
+    if args.tcp is not None:
+        server.serve_tcp(args.host, args.tcp)
+    for _ in range(args.pty):
+        server.open_pty()
+    if args.tcp is None and args.pty == 0:
+        print('No output, use --tcp and/or --pty.')
+        return
+    try:
+        server.wait_clients(args.clients)
+        server.run()
+        time.sleep(0.5)  # let clients drain.
+    except KeyboardInterrupt:  # response for KeyboardInterrupt such as Ctrl+C
+        print('User stop this program by KeyboardInterrupt! File:[{0}], Line:[{1}]'.format(__file__, sys._getframe().f_lineno))
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
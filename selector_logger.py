@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*
+"""
+Log multi-IMUs data in one thread.
+All serial ports and TCP connections are multiplexed with selectors on one I/O thread.
+Each device keeps its own IMULogger for sn, version, packet handlers and output files,
+but starts no receiver or parser thread, so adding a device costs one file descriptor.
+Requires POSIX, serial ports can not be selected on Windows.
+"""
+
+import sys
+import time
+import datetime
+import threading
+import selectors
+import communicator
+import imu_logger
+
+RETRY_INTERVAL = 1.0  # seconds between retries of opening a device, same as imu_logger.run().
+SELECT_TIMEOUT = 0.5  # max seconds to wait for data, buffered rows are flushed while idle.
+READ_SIZE = 4096  # max bytes read from a device per event.
+
+
+class Device():
+    '''
+    State of one endpoint in SelectorLogger.
+    '''
+    def __init__(self, logger):
+        self.logger = logger
+        self.fd = None  # registered file descriptor, None if closed.
+        self.next_open = 0.0
+
+
+class SelectorLogger():
+    '''
+    Multiplex many communicator.SerialPort/TCPIP endpoints on one thread.
+    '''
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.devices = []
+        self.exit_event = threading.Event()
+
+    def add_logger(self, logger):
+        '''
+        add an IMULogger whose .cmt is configured but not opened.
+        '''
+        self.devices.append(Device(logger))
+        return logger
+
+    def add_serial_port(self, port, baud, b_rst = False, apps = None, output_mode = 'csv'):
+        logger = self.new_logger(b_rst, apps, output_mode)
+        logger.get_data_from_serial_port(port, baud)
+        return self.add_logger(logger)
+
+    def add_tcpip(self, host, port, b_rst = False, apps = None, output_mode = 'csv'):
+        logger = self.new_logger(b_rst, apps, output_mode)
+        logger.cmt = communicator.TCPIP(host, port)
+        return self.add_logger(logger)
+
+    def new_logger(self, b_rst, apps, output_mode):
+        logger = imu_logger.IMULogger()
+        if apps is not None:
+            for app in apps:
+                logger.add_app(app)
+        logger.set_reset_flag(b_rst) # True: reset IMU when receive the first packet.
+        logger.set_output_mode(output_mode)
+        return logger
+
+    def open_device(self, dev):
+        '''
+        open the endpoint of dev and register it.
+        returns: True when successful.
+        '''
+        logger = dev.logger
+        logger.reinit()
+        dev.next_open = time.time() + RETRY_INTERVAL
+        try:
+            if not logger.cmt.open():
+                return False
+        except Exception as e:
+            print(e)
+            dev.next_open = time.time() + (logger.cmt.retry_delay() or RETRY_INTERVAL)
+            return False
+
+        fd = logger.cmt.fileno()
+        if fd is None:
+            print('{0} can not be multiplexed, it is not a serial port or socket on POSIX.'.format(logger.cmt.port))
+            logger.cmt.close()
+            return False
+
+        self.selector.register(fd, selectors.EVENT_READ, dev)
+        dev.fd = fd
+        print("Device[{0}] start at:[{1}].".format(logger.cmt.port, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        return True
+
+    def close_device(self, dev):
+        '''
+        unregister and close dev, flush its output files. It will be reopened after RETRY_INTERVAL.
+        '''
+        if dev.fd is not None:
+            self.selector.unregister(dev.fd)
+            dev.fd = None
+        dev.logger.reinit()  # close port, flush files and clear buffers.
+        dev.next_open = time.time() + RETRY_INTERVAL
+        print("Device[{0}] stop at:[{1}].".format(dev.logger.cmt.port, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+
+    def handle_event(self, dev):
+        '''
+        read available bytes of dev and parse them.
+        '''
+        logger = dev.logger
+        try:
+            data = logger.cmt.read_some(READ_SIZE)
+            if not data: # ready to read but no data, the peer has closed.
+                raise IOError('Device[{0}] is disconnected.'.format(logger.cmt.port))
+            logger.process_data(data)
+        except Exception as e:
+            print(e)
+            self.close_device(dev)
+            print("retry start_collection ...")
+            sys.stdout.flush()
+            return
+
+        if logger.exit_event.is_set(): # eg. failed to send command to device.
+            self.close_device(dev)
+
+    def stop(self):
+        self.exit_event.set()
+
+    def run(self):
+        '''
+        returns False when user trigger KeyboardInterrupt to stop this program.
+        otherwise returns True.
+        '''
+        last_poll = time.time()
+        try:
+            while not self.exit_event.is_set():
+                now = time.time()
+                for dev in self.devices:
+                    if dev.fd is None and now >= dev.next_open:
+                        self.open_device(dev)
+
+                if self.selector.get_map():
+                    events = self.selector.select(SELECT_TIMEOUT)
+                else:
+                    events = []
+                    self.exit_event.wait(SELECT_TIMEOUT)
+
+                for key, mask in events:
+                    self.handle_event(key.data)
+
+                now = time.time()
+                if now - last_poll >= SELECT_TIMEOUT:
+                    last_poll = now
+                    for dev in self.devices:
+                        dev.logger.poll_data_files()
+        except KeyboardInterrupt:  # response for KeyboardInterrupt such as Ctrl+C
+            print('User stop this program by KeyboardInterrupt! File:[{0}], Line:[{1}]'.format(__file__, sys._getframe().f_lineno))
+            return False
+        finally:
+            for dev in self.devices:
+                if dev.fd is not None:
+                    self.close_device(dev)
+        return True
+
+
+def run(args):
+    '''
+    wrapper, args: list of (port, baud, b_rst, apps) same as imu_logger.run().
+    '''
+    engine = SelectorLogger()
+    for arg in args:
+        engine.add_serial_port(*arg)
+    return engine.run()
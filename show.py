@@ -1,10 +1,12 @@
 
 # -*- coding: utf-8 -*
 
+import os
 import threading
 import app_painter
 import pyqtgraph as pg
 import imu_logger
+import selector_logger
 
 def main():
     '''main'''
@@ -21,8 +23,14 @@ def main():
             ('/dev/cu.usbserial', 115200, False, (painter,))
             ]
 
-    for arg in _args:
-        threading.Thread(target=imu_logger.run, args=arg).start()
+    # Qt event loop runs in main thread, devices are logged in background threads.
+    # 'thread': one thread per device, default, same as multi_logger.py. 'selector': all devices in one thread, requires POSIX.
+    engine = 'thread'
+    if engine == 'selector' and os.name == 'posix':
+        threading.Thread(target=selector_logger.run, args=(_args,)).start()
+    else:
+        for arg in _args:
+            threading.Thread(target=imu_logger.run, args=arg).start()
 
     app.exec_()
 
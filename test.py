@@ -32,10 +32,13 @@ def play_sound(sentence):
 def test():
     logger = imu_logger.IMULogger()
     # frame = bytearray(b'\x55\x55\x41\x32\x1E\x00\x51\xFF\xC9\xFF\x67\x00\x00\x00\x00\x00\x00\xFF\xEB\xFF\xEC\xF3\x3D\x1D\x70\x1D\x70\x1D\x70\x00\x06\x5A\x54\x00\x00\x6D\xC9\x55\x55\x41\x32\x1E\x00\x51\xFF\xC9\xFF\x67\xFF\xFE\x00\x00\x00\x01\xFF\xEB\xFF\xEC\xF3\x3E\x1D\x70\x1D\x70\x1D\x70\x00\x06\x5A\x5E\x00\x00\x31\x33')
-    # logger.handle_packet_A2(frame)
+    # logger.parse_frame(frame)
 
+    logger.get_data_from_file('test.bin')  # rows go to data/S1_<time>_file.csv
     frame = bytearray(b'\x55\x55\x53\x31\x18\x00\x00\xFF\xFE\xF3\x32\xFF\xF3\x00\x01\xFF\xF8\x23\xB9\x24\x26\x24\xCA\x2A\xFF\x96\x81\x03\x00\x24\x8A')
-    logger.handle_packet_S1(frame)
+    logger.parse_frame(frame)
+    logger.flush_batches()
+    logger.flush_data_file()
 
 def crc_test():
     logger = imu_logger.IMULogger()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*
+"""
+Tests of process_logger: records of several devices in one worker must all reach their apps.
+Run with: python -m pytest -q test_process_logger.py
+"""
+
+import os
+import sys
+import time
+import threading
+import pytest
+
+pytestmark = pytest.mark.skipif(os.name != 'posix' or sys.version_info < (3, 8), reason='requires POSIX and python 3.8+')
+
+import application_base
+import frame_generator
+
+FRAMES = 2000  # frames per device
+PUBLISHES = 50000  # records per thread of the ring test
+
+
+class Counter(application_base.ApplicationBase):
+    def __init__(self):
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def on_messages(self, batch):
+        with self.lock:
+            for record in batch:
+                self.counts[record.type] = self.counts.get(record.type, 0) + 1
+
+    def total(self):
+        with self.lock:
+            return sum(self.counts.values())
+
+
+def test_ring_with_concurrent_publishers():
+    import process_logger
+    ring = process_logger.SharedRing(2 * PUBLISHES)
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)  # switch threads often, as apps of devices do under load.
+    try:
+        def publish(device):
+            for i in range(PUBLISHES):
+                ring.publish(i, 1, 'A1', (float(i),), device)
+        threads = [threading.Thread(target=publish, args=(device,)) for device in (0, 1)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        records, cursor, lost = ring.read(0)
+        assert cursor == 2 * PUBLISHES
+        assert lost == 0
+        assert [int((records['device'] == device).sum()) for device in (0, 1)] == [PUBLISHES, PUBLISHES]
+    finally:
+        sys.setswitchinterval(interval)
+        ring.close()
+
+
+def test_two_devices_in_one_worker(tmp_path, monkeypatch):
+    import pty
+    import tty
+    import process_logger
+    monkeypatch.chdir(tmp_path)  # logs of workers go to tmp_path/data
+    masters = []
+    args = []
+    apps = []
+    for packet_type in ('A1', 'a1'):
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        app = Counter()
+        masters.append(master)
+        apps.append(app)
+        args.append((os.ttyname(slave), 115200, False, (app,)))
+    logger = process_logger.ProcessLogger([args])  # both devices in one worker
+    t = threading.Thread(target=logger.run)
+    t.start()
+    try:
+        time.sleep(1.5)  # worker opens the devices
+        streams = [frame_generator.FrameGenerator({'A1': 1}).generate(FRAMES),
+                   frame_generator.FrameGenerator({'a1': 1}).generate(FRAMES)]
+        for i in range(0, max(len(s) for s in streams), 4096):
+            for master, stream in zip(masters, streams):
+                os.write(master, stream[i:i + 4096])
+            time.sleep(0.005)
+        deadline = time.time() + 10
+        while time.time() < deadline and any(app.total() < FRAMES for app in apps):
+            time.sleep(0.1)
+    finally:
+        logger.stop()
+        t.join()
+        for master in masters:
+            os.close(master)
+    assert apps[0].counts == {'A1': FRAMES}
+    assert apps[1].counts == {'a1': FRAMES}
+    assert logger.lost == [0]